@@ -1,137 +1,358 @@
 # --api_client.py--
+import asyncio
 import aiohttp
-from config import BASE_URL, HEADERS
-from typing import List, Dict, Any
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing, contextmanager
+from config import (
+    API_PAGE_SIZE,
+    API_PAGE_CONCURRENCY,
+    API_RATE_LIMIT,
+    API_RATE_BURST,
+    API_MAX_RETRIES,
+    API_BACKOFF_BASE,
+    API_BACKOFF_MAX,
+    API_BREAKER_THRESHOLD,
+    API_BREAKER_RESET,
+    BASE_URL,
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_TIMEOUT,
+)
+from typing import List, Dict, Any, Optional, AsyncIterator, Awaitable, Callable, Deque, Iterator
 import datetime
+from metrics import Counter, Histogram, tenant_label
+from tracing import span
+from resilience import (
+    CircuitBreaker,
+    SharedRateLimits,
+    TokenBucket,
+    backoff_delay,
+    parse_retry_after,
+)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+API_REQUEST_SECONDS = Histogram("report_api_request_seconds", "Длительность HTTP-запросов к Report.Finance", ["endpoint"])
+API_REQUESTS = Counter("report_api_requests_total", "HTTP-запросы к Report.Finance по статусу", ["endpoint", "status"])
+API_FETCH_ALL_SECONDS = Histogram(
+    "report_api_fetch_all_seconds", "Полная загрузка справочника (все страницы)", ["kind", "tenant"]
+)
+MAX_LIMITERS = 1000
+
+class PaymentRejectedError(RuntimeError):
+    """API отклонило платежи (4xx): ни один платёж из запроса не создан."""
+
+class PaymentOutcomeUnknownError(RuntimeError):
+    """Запрос ушёл, но ответа нет (таймаут, обрыв, 5xx): платёж мог быть создан."""
 
 class ReportFinanceAPI:
-    def __init__(self, api_key: str):
+    """Клиент Report.Finance с одной keep-alive сессией на процесс.
+
+    API-ключ пользователя передаётся в каждый вызов, поэтому один экземпляр
+    обслуживает всех пользователей.
+    """
+
+    def __init__(self):
         self.base_url = BASE_URL.rstrip()
-        self.headers = {
-            "accept": "application/json",
-            "X-API-KEY": api_key,
-            "Content-Type": "application/json"
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Свой ограничитель частоты на каждый API-ключ, общий предохранитель на сервис
+        self._limiters: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._shared_limits: Optional[SharedRateLimits] = None
+        self.rate = API_RATE_LIMIT
+        self.burst = API_RATE_BURST
+        self.breaker = CircuitBreaker(API_BREAKER_THRESHOLD, API_BREAKER_RESET, name="Report.Finance")
+        self._stats = {"retries": 0, "throttled": 0, "throttle_wait_total": 0.0}
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+                headers={
+                    "accept": "application/json",
+                    "Content-Type": "application/json"
+                }
+            )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("HTTP-сессия не запущена: вызовите ReportFinanceAPI.start()")
+        return self._session
+
+    @staticmethod
+    def _headers(api_key: str) -> Dict[str, str]:
+        return {"X-API-KEY": api_key}
+
+    def use_shared_limits(self, limits: SharedRateLimits):
+        """Ограничители ключей — в общей памяти воркеров супервизора.
+
+        Чаты распределены по воркерам без учёта ключа, поэтому лимит ключа
+        считается общим счётчиком: каждому воркеру доступен весь лимит, а вместе
+        они его не превышают.
+        """
+        self._shared_limits = limits
+        self.rate = limits.rate
+        self.burst = limits.burst
+        self._limiters.clear()
+
+    def _limiter(self, api_key: str) -> TokenBucket:
+        limiter = self._limiters.get(api_key)
+        if limiter is None:
+            if self._shared_limits is not None:
+                limiter = self._shared_limits.bucket(api_key)
+            else:
+                limiter = TokenBucket(self.rate, self.burst)
+            self._limiters[api_key] = limiter
+            while len(self._limiters) > MAX_LIMITERS:
+                self._limiters.popitem(last=False)
+        else:
+            self._limiters.move_to_end(api_key)
+        return limiter
+
+    async def _throttle(self, api_key: str):
+        self.breaker.check()
+        waited = await self._limiter(api_key).acquire()
+        if waited:
+            self._stats["throttled"] += 1
+            self._stats["throttle_wait_total"] += waited
+        return waited
+
+    async def _get_json(self, path: str, api_key: str, auth_error: str, params: Dict[str, Any] = None):
+        """GET с ограничением частоты; 429/5xx и сетевые ошибки повторяются с backoff."""
+        attempt = 0
+        while True:
+            waited = await self._throttle(api_key)
+            retry_after = None
+            # offset/limit страницы, номер попытки и ожидание лимита — в спан трассы
+            attrs = {**(params or {}), "attempt": attempt, "throttle_ms": round(waited * 1000, 1)}
+            with self._measure(path, **attrs) as outcome:
+                try:
+                    async with self.session.get(
+                        f"{self.base_url}{path}",
+                        headers=self._headers(api_key),
+                        params=params
+                    ) as resp:
+                        outcome["status"] = str(resp.status)
+                        if resp.status == 200:
+                            self.breaker.record_success()
+                            return await resp.json()
+                        elif resp.status == 401:
+                            self.breaker.record_success()
+                            raise PermissionError(auth_error)
+                        elif resp.status not in RETRYABLE_STATUSES:
+                            self.breaker.record_success()
+                            resp.raise_for_status()
+                        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        if resp.status == 429:
+                            # Лимит на ключ исчерпан — придерживаем все запросы этого ключа
+                            self._limiter(api_key).pause(retry_after or backoff_delay(attempt, API_BACKOFF_BASE, API_BACKOFF_MAX))
+                        else:
+                            self.breaker.record_failure()
+                        if attempt >= API_MAX_RETRIES:
+                            resp.raise_for_status()
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    self.breaker.record_failure()
+                    if attempt >= API_MAX_RETRIES:
+                        raise
+            attempt += 1
+            self._stats["retries"] += 1
+            await asyncio.sleep(backoff_delay(attempt, API_BACKOFF_BASE, API_BACKOFF_MAX, retry_after))
+
+    @contextmanager
+    def _measure(self, endpoint: str, **attrs: Any) -> Iterator[Dict[str, str]]:
+        """Метрики и спан одного HTTP-запроса; статус выставляет вызывающий код.
+
+        attrs (offset страницы, попытка, ожидание лимита) попадают в спан трассы.
+        """
+        outcome = {"status": "error"}
+        started = time.perf_counter()
+        with span("api", endpoint, **attrs) as span_attrs:
+            try:
+                yield outcome
+            finally:
+                API_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+                API_REQUESTS.inc(endpoint=endpoint, status=outcome["status"])
+                if span_attrs is not None:
+                    span_attrs["status"] = outcome["status"]
+
+    def spare_capacity(self, api_key: str) -> float:
+        """Доля свободного всплеска лимита ключа (1.0 — ключ сейчас не используется)."""
+        if self._shared_limits is not None:
+            # Ключ мог расходовать лимит в других воркерах
+            return self._shared_limits.available(api_key) / self.burst
+        limiter = self._limiters.get(api_key)
+        return 1.0 if limiter is None else limiter.available() / limiter.burst
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "breaker_state": self.breaker.state,
+            "breaker_failures": self.breaker.failures,
+            "limited_keys": len(self._limiters),
         }
 
-    async def get_projects(self, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
-        params = {"offset": offset, "limit": limit}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/api/Projects",
-                headers=self.headers,
-                params=params
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                elif resp.status == 401:
-                    raise PermissionError("Ошибка авторизации: проверьте API-ключ")
-                else:
-                    resp.raise_for_status()
-
-    async def fetch_all_projects(self) -> List[Dict[str, Any]]:
-        all_projects = []
-        offset = 0
-        limit = 100
+    async def _iter_pages(
+        self,
+        get_page: Callable[..., Awaitable[Dict[str, Any]]],
+        api_key: str,
+        list_field: str,
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Отдаёт страницы по порядку, подгружая следующие параллельно.
+
+        Первая страница сообщает totalLineCount; остальные запрашиваются окном
+        не более API_PAGE_CONCURRENCY запросов. Если потребитель прекращает
+        итерацию (лучше через contextlib.aclosing), незагруженные страницы
+        отменяются.
+        """
+        limit = API_PAGE_SIZE
+        first = await get_page(api_key, offset=0, limit=limit)
+        items = first.get(list_field, [])
+        total = first.get("totalLineCount", 0)
+        if not items or limit >= total:
+            yield items
+            return
+
+        offsets = iter(range(limit, total, limit))
+        window: Deque[asyncio.Task] = deque()
+
+        def schedule_next():
+            offset = next(offsets, None)
+            if offset is not None:
+                window.append(asyncio.create_task(get_page(api_key, offset=offset, limit=limit)))
+
+        for _ in range(max(1, API_PAGE_CONCURRENCY)):
+            schedule_next()
+        try:
+            yield items
+            while window:
+                data = await window.popleft()
+                page = data.get(list_field, [])
+                if not page:
+                    break
+                schedule_next()
+                yield page
+        finally:
+            for task in window:
+                task.cancel()
+            if window:
+                await asyncio.gather(*window, return_exceptions=True)
+
+    async def get_projects(self, api_key: str, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+        return await self._get_json(
+            "/api/Projects", api_key,
+            "Ошибка авторизации: проверьте API-ключ",
+            params={"offset": offset, "limit": limit}
+        )
+
+    async def iter_projects(self, api_key: str) -> AsyncIterator[Dict[str, Any]]:
         today = datetime.date.today()
-        while True:
-            data = await self.get_projects(offset=offset, limit=limit)
-            raw_projects = data.get("listProject", [])
-            # Фильтруем только активные проекты (endDate >= сегодня)
-            active_projects = [
-                p for p in raw_projects
-                if p.get("endDate") and datetime.date.fromisoformat(p["endDate"].split("T")[0]) >= today
-            ]
-            all_projects.extend(active_projects)
-            total = data.get("totalLineCount", 0)
-            if not raw_projects or offset + limit >= total:
-                break
-            offset += limit
-        return all_projects
-
-    async def get_accounts(self, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
-        params = {"offset": offset, "limit": limit}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/api/Accounts",
-                headers=self.headers,
-                params=params
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                elif resp.status == 401:
-                    raise PermissionError("Ошибка авторизации при загрузке счетов")
-                else:
-                    resp.raise_for_status()
-
-    async def fetch_all_accounts(self) -> List[Dict[str, Any]]:
-        all_accounts = []
-        offset = 0
-        limit = 100
-        while True:
-            data = await self.get_accounts(offset=offset, limit=limit)
-            accounts = data.get("listAccount", [])
-            all_accounts.extend(accounts)
-            total = data.get("totalLineCount", 0)
-            if not accounts or offset + limit >= total:
-                break
-            offset += limit
-        return all_accounts
-
-    async def get_organisations(self, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
-        params = {"offset": offset, "limit": limit}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/api/Organisations",
-                headers=self.headers,
-                params=params
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                elif resp.status == 401:
-                    raise PermissionError("Ошибка авторизации при загрузке организаций")
-                else:
-                    resp.raise_for_status()
-
-    async def fetch_all_organisations(self) -> List[Dict[str, Any]]:
-        all_orgs = []
-        offset = 0
-        limit = 100
-        while True:
-            data = await self.get_organisations(offset=offset, limit=limit)
-            orgs = data.get("listOrganisation", [])
-            all_orgs.extend(orgs)
-            total = data.get("totalLineCount", 0)
-            if not orgs or offset + limit >= total:
-                break
-            offset += limit
-        return all_orgs
-
-    async def get_fact_streams(self) -> List[Dict[str, Any]]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/api/FactStreams",
-                headers=self.headers
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                elif resp.status == 401:
-                    raise PermissionError("Ошибка авторизации при загрузке фактических статей")
-                else:
-                    resp.raise_for_status()
-
-    async def fetch_all_fact_streams(self) -> List[Dict[str, Any]]:
-        return await self.get_fact_streams()
-
-    async def create_payment(self, payment_data: Dict[str, Any]) -> str:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/api/Payments",
-                headers=self.headers,
-                json=[payment_data],
-                params={"isRunRules": "false"}
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Ошибка API ({resp.status}): {error_text}")
\ No newline at end of file
+        async with aclosing(self._iter_pages(self.get_projects, api_key, "listProject")) as pages:
+            async for page in pages:
+                # Фильтруем только активные проекты (endDate >= сегодня)
+                for p in page:
+                    if p.get("endDate") and datetime.date.fromisoformat(p["endDate"].split("T")[0]) >= today:
+                        yield p
+
+    async def fetch_all_projects(self, api_key: str) -> List[Dict[str, Any]]:
+        with API_FETCH_ALL_SECONDS.time(kind="projects", tenant=tenant_label(api_key)), span("pagination", "projects"):
+            return [p async for p in self.iter_projects(api_key)]
+
+    async def get_accounts(self, api_key: str, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+        return await self._get_json(
+            "/api/Accounts", api_key,
+            "Ошибка авторизации при загрузке счетов",
+            params={"offset": offset, "limit": limit}
+        )
+
+    async def iter_accounts(self, api_key: str) -> AsyncIterator[Dict[str, Any]]:
+        async with aclosing(self._iter_pages(self.get_accounts, api_key, "listAccount")) as pages:
+            async for page in pages:
+                for account in page:
+                    yield account
+
+    async def fetch_all_accounts(self, api_key: str) -> List[Dict[str, Any]]:
+        with API_FETCH_ALL_SECONDS.time(kind="accounts", tenant=tenant_label(api_key)), span("pagination", "accounts"):
+            return [a async for a in self.iter_accounts(api_key)]
+
+    async def get_organisations(self, api_key: str, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+        return await self._get_json(
+            "/api/Organisations", api_key,
+            "Ошибка авторизации при загрузке организаций",
+            params={"offset": offset, "limit": limit}
+        )
+
+    async def iter_organisations(self, api_key: str) -> AsyncIterator[Dict[str, Any]]:
+        async with aclosing(self._iter_pages(self.get_organisations, api_key, "listOrganisation")) as pages:
+            async for page in pages:
+                for org in page:
+                    yield org
+
+    async def fetch_all_organisations(self, api_key: str) -> List[Dict[str, Any]]:
+        with API_FETCH_ALL_SECONDS.time(kind="organisations", tenant=tenant_label(api_key)), span("pagination", "organisations"):
+            return [o async for o in self.iter_organisations(api_key)]
+
+    async def get_fact_streams(self, api_key: str) -> List[Dict[str, Any]]:
+        return await self._get_json(
+            "/api/FactStreams", api_key,
+            "Ошибка авторизации при загрузке фактических статей"
+        )
+
+    async def fetch_all_fact_streams(self, api_key: str) -> List[Dict[str, Any]]:
+        return await self.get_fact_streams(api_key)
+
+    async def create_payment(self, api_key: str, payment_data: Dict[str, Any]) -> str:
+        return await self.create_payments(api_key, [payment_data])
+
+    async def create_payments(self, api_key: str, payments: List[Dict[str, Any]]) -> str:
+        # POST не идемпотентен — без повторов, но с лимитом и предохранителем
+        waited = await self._throttle(api_key)
+        with self._measure("/api/Payments", payments=len(payments), throttle_ms=round(waited * 1000, 1)) as outcome:
+            try:
+                async with self.session.post(
+                    f"{self.base_url}/api/Payments",
+                    headers=self._headers(api_key),
+                    json=payments,
+                    params={"isRunRules": "false"}
+                ) as resp:
+                    outcome["status"] = str(resp.status)
+                    if resp.status == 200:
+                        self.breaker.record_success()
+                        return await resp.text()
+                    else:
+                        if resp.status >= 500:
+                            self.breaker.record_failure()
+                        else:
+                            self.breaker.record_success()
+                        error_text = await resp.text()
+                        if resp.status >= 500:
+                            error = PaymentOutcomeUnknownError
+                        elif resp.status == 429:
+                            error = RuntimeError  # запрос не обработан — повтор безопасен
+                        else:
+                            error = PaymentRejectedError
+                        raise error(f"Ошибка API ({resp.status}): {error_text}")
+            except aiohttp.ClientConnectorError:
+                # Соединение не установлено — запрос не ушёл, повтор безопасен
+                self.breaker.record_failure()
+                raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.breaker.record_failure()
+                raise PaymentOutcomeUnknownError(f"Ответ API не получен: {e!r}") from e
+
+# Общий экземпляр: запускается и закрывается вместе с ботом в main.py
+report_api = ReportFinanceAPI()
@@ -0,0 +1,155 @@
+# bench/fake_services.py
+"""Локальная замена Report.Finance и Telegram Bot API для нагрузочного теста.
+
+Справочники генерируются детерминированно из размеров в FakeConfig, поэтому
+драйвер знает id записей для нажатий кнопок, не обращаясь к серверу. Каждый ответ
+задерживается на latency ± jitter секунд. Сообщения бота запоминаются по чатам
+(FakeStats.replies), чтобы драйвер проверял ответы на каждом шаге.
+"""
+import asyncio
+import datetime
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+from aiohttp import web
+
+@dataclass
+class FakeConfig:
+    projects: int = 20
+    organisations: int = 3
+    accounts: int = 30  # на каждую организацию
+    fact_streams: int = 50
+    latency: float = 0.05
+    jitter: float = 0.02
+    telegram_latency: float = 0.0
+
+@dataclass
+class FakeStats:
+    requests: Dict[str, int] = field(default_factory=dict)
+    payments: int = 0
+    payment_batches: int = 0
+    telegram_calls: int = 0
+    # chat_id -> [(метод в нижнем регистре, текст, reply_markup в JSON)], драйвер забирает их после шага
+    replies: Dict[int, List[Tuple[str, str, str]]] = field(default_factory=dict)
+
+def project_name(i: int) -> str:
+    return f"Проект {i}"
+
+def organisation_name(i: int) -> str:
+    return f"Организация {i}"
+
+def account_name(org: int, i: int) -> str:
+    return f"Счёт {org}-{i}"
+
+def account_number(org: int, i: int) -> str:
+    return f"40702810{org:04d}{i:08d}"
+
+def project_id(i: int) -> int:
+    return 1000 + i
+
+def organisation_id(o: int) -> int:
+    return 2000 + o
+
+def account_id(org: int, i: int) -> int:
+    return 100000 + org * 1000 + i
+
+def build_catalog(config: FakeConfig) -> Dict[str, List[Dict[str, Any]]]:
+    end_date = (datetime.date.today() + datetime.timedelta(days=365)).isoformat() + "T00:00:00"
+    projects = [
+        {"id": project_id(i), "projectName": project_name(i), "endDate": end_date}
+        for i in range(1, config.projects + 1)
+    ]
+    organisations = [
+        {"id": organisation_id(o), "organisationName": organisation_name(o)}
+        for o in range(1, config.organisations + 1)
+    ]
+    accounts = [
+        {
+            "id": account_id(o, i),
+            "accountName": account_name(o, i),
+            "number": account_number(o, i),
+            "organisationId": organisation_id(o),
+        }
+        for o in range(1, config.organisations + 1)
+        for i in range(1, config.accounts + 1)
+    ]
+    fact_streams = [{"id": 3000 + i, "name": f"Статья {i}"} for i in range(1, config.fact_streams + 1)]
+    return {"projects": projects, "organisations": organisations, "accounts": accounts, "fact_streams": fact_streams}
+
+def build_fake_app(config: FakeConfig, stats: FakeStats) -> web.Application:
+    catalog = build_catalog(config)
+
+    async def delay(name: str):
+        stats.requests[name] = stats.requests.get(name, 0) + 1
+        if config.latency or config.jitter:
+            await asyncio.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+
+    def paged(kind: str, list_field: str):
+        async def handler(request: web.Request) -> web.Response:
+            if not request.headers.get("X-API-KEY"):
+                return web.Response(status=401)
+            await delay(kind)
+            offset = int(request.query.get("offset", 0))
+            limit = int(request.query.get("limit", 100))
+            items = catalog[kind]
+            return web.json_response({list_field: items[offset:offset + limit], "totalLineCount": len(items)})
+        return handler
+
+    async def fact_streams(request: web.Request) -> web.Response:
+        await delay("fact_streams")
+        return web.json_response(catalog["fact_streams"])
+
+    async def payments(request: web.Request) -> web.Response:
+        await delay("payments")
+        body = await request.json()
+        stats.payments += len(body)
+        stats.payment_batches += 1
+        return web.Response(text=json.dumps([p.get("externalId") for p in body]))
+
+    async def telegram(request: web.Request) -> web.Response:
+        # Bot API: /bot<token>/<method>, параметры — форма
+        stats.telegram_calls += 1
+        if config.telegram_latency:
+            await asyncio.sleep(config.telegram_latency)
+        method = request.match_info["method"]
+        form = await request.post()
+        if "chat_id" in form:
+            # aiogram экранирует не-ASCII в JSON клавиатуры — храним читаемый вид
+            markup = form.get("reply_markup", "")
+            stats.replies.setdefault(int(form["chat_id"]), []).append((
+                method.lower(),
+                form.get("text", ""),
+                json.dumps(json.loads(markup), ensure_ascii=False) if markup else "",
+            ))
+        if method.lower() in ("sendmessage", "editmessagetext"):
+            chat_id = int(form.get("chat_id", 0))
+            result: Any = {
+                "message_id": stats.telegram_calls,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": form.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_get("/api/Projects", paged("projects", "listProject"))
+    app.router.add_get("/api/Accounts", paged("accounts", "listAccount"))
+    app.router.add_get("/api/Organisations", paged("organisations", "listOrganisation"))
+    app.router.add_get("/api/FactStreams", fact_streams)
+    app.router.add_post("/api/Payments", payments)
+    app.router.add_post("/bot{token}/{method}", telegram)
+    return app
+
+async def start_fake_services(config: FakeConfig, host: str = "127.0.0.1", port: int = 0):
+    """Запускает сервер; возвращает (runner, base_url, stats)."""
+    stats = FakeStats()
+    runner = web.AppRunner(build_fake_app(config, stats), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}", stats
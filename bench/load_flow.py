@@ -0,0 +1,254 @@
+# bench/load_flow.py
+"""Нагрузочный прогон полного сценария «➕ Добавить расход».
+
+Поднимает локальные Report.Finance и Telegram Bot API (bench/fake_services.py),
+регистрирует N синтетических пользователей и гоняет их параллельно через
+Dispatcher.feed_update — те же роутеры, middleware, кэши и outbox, что в боте.
+Сценарий засчитывается, только если на каждом шаге бот ответил ожидаемым текстом
+и клавиатурой (ответы берутся из фейкового Bot API).
+
+Нужна отдельная тестовая база Postgres: DATABASE_URL из .env, в неё пишутся
+пользователи с telegram_id от --user-id-base, платежи outbox и статистика.
+
+    python -m bench.load_flow --users 200 --flows 5 --latency 0.05 --accounts 300
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import statistics
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+from bench.fake_services import (
+    FakeConfig,
+    FakeStats,
+    account_id,
+    account_name,
+    organisation_id,
+    organisation_name,
+    project_id,
+    project_name,
+    start_fake_services,
+)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сценария добавления расхода")
+    parser.add_argument("--users", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--flows", type=int, default=3, help="сценариев на пользователя")
+    parser.add_argument("--tenants", type=int, default=5, help="разных API-ключей")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза между шагами, с")
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--organisations", type=int, default=3)
+    parser.add_argument("--accounts", type=int, default=30, help="счетов на организацию")
+    parser.add_argument("--fact-streams", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка Report.Finance, с")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--user-id-base", type=int, default=9_000_000_000)
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="ожидание отправки outbox, с")
+    parser.add_argument("--tracemalloc", action="store_true", help="пик памяти Python-объектов (медленнее)")
+    return parser.parse_args()
+
+# Ожидаемый ответ бота: (метод Bot API в нижнем регистре, фрагмент текста, фрагмент reply_markup)
+Expected = Tuple[str, str, str]
+
+class UnexpectedReply(Exception):
+    """Бот ответил на шаг не тем, что ждёт сценарий."""
+
+def _pick(kind: str, item: int) -> Dict[str, str]:
+    from keyboards import CatalogCallback
+    return {"data": CatalogCallback(kind=kind, action="pick", item=item).pack()}
+
+def _catalog(kind: str) -> str:
+    # Кнопки справочника: callback_data вида cat:<kind>:...
+    return f'"cat:{kind}:'
+
+def flow_steps(
+    config: FakeConfig, user_index: int, flow_index: int
+) -> List[Tuple[str, Dict[str, str], List[Expected]]]:
+    """Шаги сценария: текстовое сообщение ({"text": ...}) или нажатие инлайн-кнопки ({"data": ...})
+    и ответы бота, которых ждём после шага."""
+    org = user_index % config.organisations + 1
+    account = flow_index % config.accounts + 1
+    organisation_prompt = ("sendmessage", "Выберите организацию", _catalog("organisations"))
+    if config.projects:
+        project = user_index % config.projects + 1
+        steps = [
+            ("start", {"text": "➕ Добавить расход"}, [("sendmessage", "Выберите проект", _catalog("projects"))]),
+            ("project", _pick("projects", project_id(project)), [
+                ("editmessagetext", f"Проект: {project_name(project)}", ""),
+                organisation_prompt,
+            ]),
+        ]
+    else:
+        # Только «Без проекта» — бот сразу спрашивает организацию
+        steps = [("start", {"text": "➕ Добавить расход"}, [organisation_prompt])]
+    steps += [
+        ("organisation", _pick("organisations", organisation_id(org)), [
+            ("editmessagetext", f"Организация: {organisation_name(org)}", ""),
+            ("sendmessage", "Выберите счёт", _catalog("accounts")),
+        ]),
+        ("account", _pick("accounts", account_id(org, account)), [
+            ("editmessagetext", f"Счёт: {account_name(org, account)}", ""),
+            ("sendmessage", "Введите сумму", ""),
+        ]),
+        ("amount", {"text": f"{100 + flow_index}"}, [("sendmessage", "Введите назначение платежа", "")]),
+        ("purpose", {"text": "Нагрузочный тест"}, [("sendmessage", "Подтвердите ввод", "✅ Да")]),
+        ("confirm", {"text": "✅ Да"}, [("sendmessage", "принят и отправляется", "")]),
+    ]
+    return steps
+
+def check_replies(step: str, replies: List[Tuple[str, str, str]], expected: List[Expected]):
+    """Каждый ожидаемый ответ должен найтись среди вызовов Bot API за шаг."""
+    for method, text, markup in expected:
+        if not any(
+            sent_method == method and text in sent_text and markup in sent_markup
+            for sent_method, sent_text, sent_markup in replies
+        ):
+            sent = "; ".join(f"{m}: {t[:80]!r}" for m, t, _ in replies) or "ничего"
+            raise UnexpectedReply(f"шаг {step}: нет {method} с {text!r}, бот отправил: {sent}")
+
+class Driver:
+    def __init__(self, dp, bot, args: argparse.Namespace, config: FakeConfig, fake_stats: FakeStats):
+        self.dp = dp
+        self.bot = bot
+        self.args = args
+        self.config = config
+        self.fake_stats = fake_stats
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.completed = 0
+        self.errors = 0
+        self.unexpected = 0
+        self._update_id = 0
+
+    def _update(self, user_id: int, payload: Dict[str, str]) -> Update:
+        self._update_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": "bench"}
+        message = {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": payload.get("text", ""),
+        }
+        if "data" in payload:
+            # Нажатие кнопки под сообщением бота
+            update = {
+                "callback_query": {
+                    "id": str(self._update_id),
+                    "from": user,
+                    "chat_instance": str(user_id),
+                    "message": message,
+                    "data": payload["data"],
+                },
+            }
+        else:
+            update = {"message": message}
+        return Update.model_validate({"update_id": self._update_id, **update}, context={"bot": self.bot})
+
+    async def run_user(self, user_index: int):
+        user_id = self.args.user_id_base + user_index
+        for flow_index in range(self.args.flows):
+            try:
+                for step, payload, expected in flow_steps(self.config, user_index, flow_index):
+                    # Уведомления outbox о прошлых платежах тоже попадают сюда — они не мешают проверке
+                    self.fake_stats.replies.pop(user_id, None)
+                    started = time.perf_counter()
+                    await self.dp.feed_update(self.bot, self._update(user_id, payload))
+                    self.latencies[step].append(time.perf_counter() - started)
+                    check_replies(step, self.fake_stats.replies.pop(user_id, []), expected)
+                    if self.args.think:
+                        await asyncio.sleep(self.args.think)
+                self.completed += 1
+            except UnexpectedReply as e:
+                logging.error("Сценарий пользователя %s: %s", user_id, e)
+                self.unexpected += 1
+            except Exception:
+                logging.exception("Сценарий пользователя %s прерван", user_id)
+                self.errors += 1
+
+def _percentiles(values: List[float]) -> Tuple[float, float, float]:
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+def print_report(driver: Driver, elapsed: float, delivered: int, delivery_elapsed: float, fake_stats, traced_peak):
+    print(f"\nСценариев завершено: {driver.completed}, прервано: {driver.errors}, "
+          f"с неожиданным ответом бота: {driver.unexpected}, за {elapsed:.2f} с")
+    print(f"Пропускная способность: {driver.completed / elapsed:.1f} операций/с")
+    print(f"Доставлено в /api/Payments: {delivered} платежей за {delivery_elapsed:.2f} с "
+          f"({fake_stats.payment_batches} пакетов)")
+    print(f"\n{'шаг':<14}{'n':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    all_steps: List[float] = []
+    for step, values in driver.latencies.items():
+        all_steps.extend(values)
+        p50, p95, p99 = _percentiles(values)
+        print(f"{step:<14}{len(values):>8}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}{p99 * 1000:>10.1f}")
+    p50, p95, p99 = _percentiles(all_steps)
+    print(f"{'все шаги':<14}{len(all_steps):>8}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}{p99 * 1000:>10.1f}")
+    print(f"\nЗапросы к Report.Finance: {dict(fake_stats.requests)}; вызовов Bot API: {fake_stats.telegram_calls}")
+    # На Linux ru_maxrss в килобайтах
+    print(f"Пиковая память процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ")
+    if traced_peak is not None:
+        print(f"Пик памяти Python-объектов (tracemalloc): {traced_peak / 2**20:.1f} МБ")
+
+async def run(args: argparse.Namespace):
+    config = FakeConfig(
+        projects=args.projects,
+        organisations=args.organisations,
+        accounts=args.accounts,
+        fact_streams=args.fact_streams,
+        latency=args.latency,
+        jitter=args.jitter,
+        telegram_latency=args.telegram_latency,
+    )
+    fake_runner, base_url, fake_stats = await start_fake_services(config)
+    # Синтетические пользователи нажимают кнопки без пауз — защита от флуда им
+    # не мешает, если её не включили явно через окружение
+    os.environ.setdefault("FLOOD_RATE", "1000")
+    os.environ.setdefault("FLOOD_BURST", "1000")
+    os.environ.setdefault("FLOOD_DEBOUNCE", "0")
+    # Модули бота читают .env при импорте — импортируем после разбора аргументов
+    from api_client import report_api
+    from database import register_user
+    from main import bot_services, build_dispatcher
+
+    report_api.base_url = base_url
+    session = AiohttpSession(api=TelegramAPIServer.from_base(base_url))
+    try:
+        async with bot_services(metrics_port=0, session=session) as bot:
+            for i in range(args.users):
+                await register_user(args.user_id_base + i, f"bench-key-{i % args.tenants}", "bench")
+            dp = build_dispatcher()
+            driver = Driver(dp, bot, args, config, fake_stats)
+
+            if args.tracemalloc:
+                tracemalloc.start()
+            started = time.perf_counter()
+            await asyncio.gather(*(driver.run_user(i) for i in range(args.users)))
+            elapsed = time.perf_counter() - started
+
+            # Платежи уходят из outbox в фоне — ждём, пока фейк их получит
+            deadline = time.perf_counter() + args.drain_timeout
+            while fake_stats.payments < driver.completed and time.perf_counter() < deadline:
+                await asyncio.sleep(0.1)
+            delivery_elapsed = time.perf_counter() - started
+            traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+            if args.tracemalloc:
+                tracemalloc.stop()
+            print_report(driver, elapsed, fake_stats.payments, delivery_elapsed, fake_stats, traced_peak)
+    finally:
+        await fake_runner.cleanup()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    arguments = parse_args()
+    asyncio.run(run(arguments))
@@ -11,7 +11,8 @@ if not TELEGRAM_BOT_TOKEN:
 if not REPORT_FINANCE_API_KEY:
     raise ValueError("REPORT_FINANCE_API_KEY не задан в .env")
 
-BASE_URL = "https://rest.api.report.finance"
+# Переопределяется для стендов и нагрузочного теста (bench/)
+BASE_URL = os.getenv("REPORT_FINANCE_BASE_URL", "https://rest.api.report.finance")
 HEADERS = {
     "accept": "application/json",
     "X-API-KEY": REPORT_FINANCE_API_KEY,
@@ -29,4 +30,169 @@ if admin_ids_raw.strip():
     try:
         TELEGRAM_ADMIN_IDS = {int(x.strip()) for x in admin_ids_raw.split(",") if x.strip()}
     except ValueError:
-        raise ValueError("Некорректный формат TELEGRAM_ADMIN_IDS")
\ No newline at end of file
+        raise ValueError("Некорректный формат TELEGRAM_ADMIN_IDS")
+
+def _int_env(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        raise ValueError(f"Некорректное значение {name}: ожидается целое число")
+
+
+def _float_env(name: str, default: float) -> float:
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        raise ValueError(f"Некорректное значение {name}: ожидается число")
+
+
+# Пул соединений с Postgres
+DB_POOL_MIN_SIZE = _int_env("DB_POOL_MIN_SIZE", 2)
+DB_POOL_MAX_SIZE = _int_env("DB_POOL_MAX_SIZE", 10)
+DB_STATEMENT_CACHE_SIZE = _int_env("DB_STATEMENT_CACHE_SIZE", 100)
+DB_COMMAND_TIMEOUT = _int_env("DB_COMMAND_TIMEOUT", 30)
+
+if DB_POOL_MIN_SIZE < 0 or DB_POOL_MAX_SIZE < 1 or DB_POOL_MIN_SIZE > DB_POOL_MAX_SIZE:
+    raise ValueError("Некорректные размеры пула: нужно 0 <= DB_POOL_MIN_SIZE <= DB_POOL_MAX_SIZE")
+
+# HTTP-клиент Report.Finance (общая сессия на процесс)
+HTTP_POOL_LIMIT = _int_env("HTTP_POOL_LIMIT", 100)
+HTTP_POOL_LIMIT_PER_HOST = _int_env("HTTP_POOL_LIMIT_PER_HOST", 20)
+HTTP_DNS_CACHE_TTL = _int_env("HTTP_DNS_CACHE_TTL", 300)
+HTTP_KEEPALIVE_TIMEOUT = _int_env("HTTP_KEEPALIVE_TIMEOUT", 30)
+HTTP_TIMEOUT = _int_env("HTTP_TIMEOUT", 30)
+
+# Пагинация: размер страницы и число страниц, загружаемых параллельно
+API_PAGE_SIZE = _int_env("API_PAGE_SIZE", 100)
+API_PAGE_CONCURRENCY = _int_env("API_PAGE_CONCURRENCY", 4)
+
+# Ограничение частоты запросов к Report.Finance (на API-ключ), повторы и предохранитель
+API_RATE_LIMIT = _float_env("API_RATE_LIMIT", 5.0)
+API_RATE_BURST = _int_env("API_RATE_BURST", 10)
+API_MAX_RETRIES = _int_env("API_MAX_RETRIES", 3)
+API_BACKOFF_BASE = _float_env("API_BACKOFF_BASE", 0.5)
+API_BACKOFF_MAX = _float_env("API_BACKOFF_MAX", 10.0)
+API_BREAKER_THRESHOLD = _int_env("API_BREAKER_THRESHOLD", 5)
+API_BREAKER_RESET = _float_env("API_BREAKER_RESET", 30.0)
+
+# Кэш справочников (проекты, организации, счета) по API-ключу
+REF_CACHE_TTL = _int_env("REF_CACHE_TTL", 3600)
+REF_CACHE_MAX_ENTRIES = _int_env("REF_CACHE_MAX_ENTRIES", 300)
+
+# Инлайн-клавиатуры справочников: кнопок на странице и число закэшированных страниц
+CATALOG_PAGE_SIZE = _int_env("CATALOG_PAGE_SIZE", 10)
+CATALOG_CACHE_MAX_PAGES = _int_env("CATALOG_CACHE_MAX_PAGES", 5000)
+
+# Поиск по справочникам: число результатов и минимальная доля совпавших триграмм
+SEARCH_RESULTS_LIMIT = _int_env("SEARCH_RESULTS_LIMIT", 8)
+SEARCH_MIN_SIMILARITY = _float_env("SEARCH_MIN_SIMILARITY", 0.4)
+
+# Прогрев справочников: сколько ключей, за какой период активности, параллельность
+# и как часто обновлять горячие справочники (0 — прогрев выключен)
+WARMUP_TENANTS = _int_env("WARMUP_TENANTS", 100)
+WARMUP_ACTIVE_DAYS = _int_env("WARMUP_ACTIVE_DAYS", 14)
+WARMUP_CONCURRENCY = _int_env("WARMUP_CONCURRENCY", 4)
+WARMUP_REFRESH_INTERVAL = _int_env("WARMUP_REFRESH_INTERVAL", 300)
+
+# Объединение платежей одного API-ключа в один POST /api/Payments
+PAYMENT_BATCH_WINDOW = _float_env("PAYMENT_BATCH_WINDOW", 0.2)
+PAYMENT_BATCH_MAX = _int_env("PAYMENT_BATCH_MAX", 50)
+
+# Очередь платежей (outbox): отправка в фоне с повторами
+OUTBOX_POLL_INTERVAL = _float_env("OUTBOX_POLL_INTERVAL", 1.0)
+OUTBOX_CLAIM_SIZE = _int_env("OUTBOX_CLAIM_SIZE", 50)
+OUTBOX_MAX_ATTEMPTS = _int_env("OUTBOX_MAX_ATTEMPTS", 8)
+OUTBOX_LEASE_SECONDS = _int_env("OUTBOX_LEASE_SECONDS", 120)
+
+# Очереди обновлений: одновременно обрабатываемых обновлений, всего ожидающих
+# и ожидающих в одном чате (сверх лимитов новые обновления отбрасываются)
+UPDATE_CONCURRENCY = _int_env("UPDATE_CONCURRENCY", 64)
+UPDATE_MAX_BACKLOG = _int_env("UPDATE_MAX_BACKLOG", 5000)
+UPDATE_CHAT_BACKLOG = _int_env("UPDATE_CHAT_BACKLOG", 20)
+
+# Защита от флуда: обновлений в секунду на пользователя и всплеск, пауза для
+# превысивших, окно, в котором повторный старт сценария склеивается с первым.
+# Листание списков ◀️/▶️ расходует отдельный лимит и паузу не вызывает
+FLOOD_RATE = _float_env("FLOOD_RATE", 1.0)
+FLOOD_BURST = _int_env("FLOOD_BURST", 8)
+FLOOD_NAVIGATION_RATE = _float_env("FLOOD_NAVIGATION_RATE", 5.0)
+FLOOD_NAVIGATION_BURST = _int_env("FLOOD_NAVIGATION_BURST", 20)
+FLOOD_COOLDOWN = _int_env("FLOOD_COOLDOWN", 30)
+FLOOD_DEBOUNCE = _float_env("FLOOD_DEBOUNCE", 2.0)
+FLOOD_MAX_USERS = _int_env("FLOOD_MAX_USERS", 10000)
+
+# Незавершённые сценарии (FSM) удаляются после этого времени бездействия, сек
+FSM_FLOW_TTL = _int_env("FSM_FLOW_TTL", 1800)
+
+# Хранилище сценариев: postgres (переживает перезапуск, общее для экземпляров) или memory.
+# Записи копятся FSM_FLUSH_INTERVAL секунд и пишутся одним upsert, чтения идут из кэша
+# процесса; брошенные сценарии удаляются раз в FSM_CLEANUP_INTERVAL секунд.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres").strip().lower()
+FSM_FLUSH_INTERVAL = _float_env("FSM_FLUSH_INTERVAL", 0.1)
+FSM_FLUSH_BATCH = _int_env("FSM_FLUSH_BATCH", 500)
+FSM_CACHE_MAX_ENTRIES = _int_env("FSM_CACHE_MAX_ENTRIES", 10000)
+FSM_CLEANUP_INTERVAL = _int_env("FSM_CLEANUP_INTERVAL", 300)
+FSM_CHANNEL = os.getenv("FSM_CHANNEL", "fsm_states")
+
+if FSM_STORAGE not in ("postgres", "memory"):
+    raise ValueError("FSM_STORAGE должен быть postgres или memory")
+
+# Кэш пользователей (telegram_id -> api_key, организация)
+USER_CACHE_MAX_ENTRIES = _int_env("USER_CACHE_MAX_ENTRIES", 10000)
+USER_CACHE_TTL = _int_env("USER_CACHE_TTL", 300)
+USER_CACHE_NEGATIVE_TTL = _int_env("USER_CACHE_NEGATIVE_TTL", 30)
+USER_REGISTRY_CHANNEL = os.getenv("USER_REGISTRY_CHANNEL", "user_registry")
+
+# Отложенная пакетная запись user_operations
+OPLOG_BATCH_SIZE = _int_env("OPLOG_BATCH_SIZE", 500)
+OPLOG_FLUSH_INTERVAL = _int_env("OPLOG_FLUSH_INTERVAL", 2)
+OPLOG_MAX_PENDING = _int_env("OPLOG_MAX_PENDING", 100000)
+
+# Выгрузка статистики: размер пачки курсора и порог, после которого файл уходит на диск
+EXPORT_FETCH_SIZE = _int_env("EXPORT_FETCH_SIZE", 5000)
+EXPORT_SPOOL_MAX_SIZE = _int_env("EXPORT_SPOOL_MAX_SIZE", 8 * 1024 * 1024)
+
+# Секционирование user_operations: на сколько месяцев вперёд создавать секции
+OPERATIONS_PARTITIONS_AHEAD = _int_env("OPERATIONS_PARTITIONS_AHEAD", 3)
+
+# Режим получения обновлений: polling (для разработки) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = _int_env("WEBHOOK_PORT", 8080)
+HEALTH_PATH = os.getenv("HEALTH_PATH", "/health")
+WEBHOOK_MAX_CONNECTIONS = _int_env("WEBHOOK_MAX_CONNECTIONS", 40)
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError("BOT_MODE должен быть polling или webhook")
+if BOT_MODE == "webhook" and not WEBHOOK_BASE_URL:
+    raise ValueError("WEBHOOK_BASE_URL не задан в .env (обязателен при BOT_MODE=webhook)")
+
+# Многопроцессный режим (supervisor.py)
+WORKERS = _int_env("WORKERS", os.cpu_count() or 1)
+WORKER_INTERNAL_PORT_BASE = _int_env("WORKER_INTERNAL_PORT_BASE", WEBHOOK_PORT + 1)
+WORKER_SHUTDOWN_TIMEOUT = _int_env("WORKER_SHUTDOWN_TIMEOUT", 30)
+
+# Метрики в формате Prometheus (0 — не запускать HTTP-эндпоинт)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = _int_env("METRICS_PORT", 9108)
+
+# Профилирование из админки: период сэмплирования стека и предельная длительность, сек
+PROFILE_SAMPLE_INTERVAL = _float_env("PROFILE_SAMPLE_INTERVAL", 0.005)
+PROFILE_MAX_SECONDS = _int_env("PROFILE_MAX_SECONDS", 300)
+
+# Журнал медленных обновлений (JSON-строки со спанами): порог, сек (0 — выключен),
+# файл с ротацией по размеру и предел спанов на обновление
+SLOW_UPDATE_THRESHOLD = _float_env("SLOW_UPDATE_THRESHOLD", 2.0)
+SLOW_LOG_PATH = os.getenv("SLOW_LOG_PATH", "slow_updates.jsonl")
+SLOW_LOG_MAX_BYTES = _int_env("SLOW_LOG_MAX_BYTES", 10 * 1024 * 1024)
+SLOW_LOG_BACKUPS = _int_env("SLOW_LOG_BACKUPS", 5)
+TRACE_MAX_SPANS = _int_env("TRACE_MAX_SPANS", 500)
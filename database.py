@@ -1,73 +1,691 @@
 # database.py
+import asyncio
 import asyncpg
-from typing import Optional, Dict, Any, List, Tuple
-from config import DATABASE_URL
+import datetime
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, Callable, Iterable
+from config import (
+    DATABASE_URL,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_STATEMENT_CACHE_SIZE,
+    DB_COMMAND_TIMEOUT,
+    USER_CACHE_MAX_ENTRIES,
+    USER_CACHE_TTL,
+    USER_CACHE_NEGATIVE_TTL,
+    USER_REGISTRY_CHANNEL,
+    OPERATIONS_PARTITIONS_AHEAD,
+)
+from metrics import Counter, Gauge, Histogram
+from tracing import span
 
-async def init_db():
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id BIGINT PRIMARY KEY,
-            api_key TEXT NOT NULL,
-            organisation_name TEXT
+logger = logging.getLogger(__name__)
+
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Длительность запросов к Postgres", ["query"])
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Ошибки запросов к Postgres", ["query"])
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Ожидание свободного соединения в пуле")
+Gauge("db_pool_size", "Открытых соединений в пуле", lambda: get_pool_stats()["size"])
+Gauge("db_pool_in_use", "Занятых соединений в пуле", lambda: get_pool_stats()["in_use"])
+
+_pool: Optional[asyncpg.Pool] = None
+_pool_stats = {
+    "acquisitions": 0,
+    "wait_total": 0.0,
+    "wait_max": 0.0,
+}
+
+async def create_pool() -> asyncpg.Pool:
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+        )
+    return _pool
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+@asynccontextmanager
+async def acquire() -> AsyncIterator[asyncpg.Connection]:
+    if _pool is None:
+        raise RuntimeError("Пул соединений не инициализирован: вызовите create_pool()")
+    started = time.perf_counter()
+    async with _pool.acquire() as conn:
+        waited = time.perf_counter() - started
+        DB_POOL_WAIT_SECONDS.observe(waited)
+        _pool_stats["acquisitions"] += 1
+        _pool_stats["wait_total"] += waited
+        _pool_stats["wait_max"] = max(_pool_stats["wait_max"], waited)
+        yield conn
+
+@asynccontextmanager
+async def _query(name: str) -> AsyncIterator[asyncpg.Connection]:
+    """acquire() с метриками и спаном трассы: длительность (включая ожидание пула) и ошибки по имени запроса."""
+    started = time.perf_counter()
+    try:
+        with span("db", name):
+            async with acquire() as conn:
+                yield conn
+    except Exception:
+        DB_QUERY_ERRORS.inc(query=name)
+        raise
+    finally:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started, query=name)
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Размер, загрузка пула и время ожидания соединения (для подбора min/max)."""
+    acquisitions = _pool_stats["acquisitions"]
+    stats = {
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": DB_POOL_MAX_SIZE,
+        "size": 0,
+        "in_use": 0,
+        "utilization": 0.0,
+        "acquisitions": acquisitions,
+        "wait_avg_ms": (_pool_stats["wait_total"] / acquisitions * 1000) if acquisitions else 0.0,
+        "wait_max_ms": _pool_stats["wait_max"] * 1000,
+    }
+    if _pool is not None:
+        size = _pool.get_size()
+        in_use = size - _pool.get_idle_size()
+        stats.update(
+            size=size,
+            in_use=in_use,
+            utilization=in_use / DB_POOL_MAX_SIZE,
+        )
+    return stats
+
+# user_operations секционирована по месяцам (RANGE по operation_date).
+# Старую несекционированную таблицу переводит migrate_v2.py.
+OPERATIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS user_operations (
+        id BIGSERIAL,
+        telegram_id BIGINT NOT NULL,
+        operation_type TEXT NOT NULL CHECK (operation_type IN ('income', 'expense')),
+        operation_date DATE NOT NULL,
+        PRIMARY KEY (id, operation_date)
+    ) PARTITION BY RANGE (operation_date)
+"""
+OPERATIONS_INDEXES_SQL = (
+    "CREATE INDEX IF NOT EXISTS user_operations_user_date_idx ON user_operations (telegram_id, operation_date)",
+    "CREATE INDEX IF NOT EXISTS user_operations_date_id_idx ON user_operations (operation_date, id)",
+)
+# Дневные агрегаты: пополняются вместе с каждой пачкой вставок (insert_operations)
+DAILY_ROLLUP_SQL = """
+    CREATE TABLE IF NOT EXISTS user_operations_daily (
+        operation_date DATE NOT NULL,
+        telegram_id BIGINT NOT NULL,
+        operation_type TEXT NOT NULL,
+        operations_count INTEGER NOT NULL,
+        PRIMARY KEY (operation_date, telegram_id, operation_type)
+    )
+"""
+
+# Платежи, ожидающие отправки в Report.Finance (см. payment_outbox.py).
+# sending + next_attempt_at — аренда: если процесс умер, строку заберут повторно.
+# reconcile — исход отправки неизвестен (платёж мог быть создан), повторно не
+# отправляется, пока администратор не сверит его с Report.Finance.
+OUTBOX_STATUSES = ("pending", "sending", "sent", "failed", "reconcile")
+_OUTBOX_STATUSES_SQL = ", ".join(f"'{status}'" for status in OUTBOX_STATUSES)
+OUTBOX_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS payment_outbox (
+        external_id UUID PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        chat_id BIGINT NOT NULL,
+        api_key TEXT NOT NULL,
+        payload JSONB NOT NULL,
+        operation_type TEXT NOT NULL CHECK (operation_type IN ('income', 'expense')),
+        operation_date DATE NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ({statuses})),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        finished_at TIMESTAMPTZ
+    )
+""".format(statuses=_OUTBOX_STATUSES_SQL)
+OUTBOX_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS payment_outbox_due_idx ON payment_outbox (next_attempt_at)
+    WHERE status IN ('pending', 'sending')
+"""
+
+# Состояния сценариев aiogram (см. fsm_storage.PostgresStorage): ключ — строка
+# DefaultKeyBuilder, данные — JSONB. Брошенные сценарии удаляются по updated_at.
+FSM_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        storage_key TEXT PRIMARY KEY,
+        state TEXT,
+        data JSONB NOT NULL DEFAULT '{}',
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+FSM_INDEX_SQL = "CREATE INDEX IF NOT EXISTS fsm_states_updated_idx ON fsm_states (updated_at)"
+
+# Секции существуют для дат < _partitions_until; None — таблица не секционирована
+_partitions_until: Optional[datetime.date] = None
+
+def _add_months(day: datetime.date, months: int) -> datetime.date:
+    month_index = day.year * 12 + day.month - 1 + months
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+async def is_operations_partitioned(conn: asyncpg.Connection) -> bool:
+    return await conn.fetchval("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = 'user_operations' AND pg_table_is_visible(c.oid)
         )
     """)
-    await conn.execute("""
-        CREATE TABLE IF NOT EXISTS user_operations (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT NOT NULL,
-            operation_type TEXT NOT NULL CHECK (operation_type IN ('income', 'expense')),
-            operation_date DATE NOT NULL
+
+async def ensure_operation_partitions(conn: asyncpg.Connection, until: datetime.date):
+    """Создаёт месячные секции от текущего месяца до until (не включая)."""
+    global _partitions_until
+    async with conn.transaction():
+        # Воркеры создают секции одновременно — CREATE IF NOT EXISTS от гонки не спасает
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('user_operations_partitions'))")
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_operations_default PARTITION OF user_operations DEFAULT"
         )
+        month = _add_months(datetime.date.today(), 0)
+        while month < until:
+            next_month = _add_months(month, 1)
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS user_operations_y{month.year}m{month.month:02d} "
+                f"PARTITION OF user_operations "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}')"
+            )
+            month = next_month
+    _partitions_until = max(until, _partitions_until or until)
+
+async def _update_outbox_status_check(conn: asyncpg.Connection):
+    """Таблицы, созданные до статуса reconcile, получают новый CHECK."""
+    definition = await conn.fetchval("""
+        SELECT pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = 'payment_outbox'::regclass AND conname = 'payment_outbox_status_check'
     """)
-    await conn.close()
+    if definition is not None and all(f"'{status}'" in definition for status in OUTBOX_STATUSES):
+        return
+    async with conn.transaction():
+        await conn.execute("ALTER TABLE payment_outbox DROP CONSTRAINT IF EXISTS payment_outbox_status_check")
+        await conn.execute(
+            f"ALTER TABLE payment_outbox ADD CONSTRAINT payment_outbox_status_check "
+            f"CHECK (status IN ({_OUTBOX_STATUSES_SQL}))"
+        )
+
+async def _sync_operation_partitions(conn: asyncpg.Connection):
+    global _partitions_until
+    if await is_operations_partitioned(conn):
+        await ensure_operation_partitions(
+            conn, _add_months(datetime.date.today(), OPERATIONS_PARTITIONS_AHEAD + 1)
+        )
+    else:
+        _partitions_until = None
+        logger.warning("user_operations не секционирована — выполните migrate_v2.py")
+
+async def init_operation_partitions():
+    """Без полной инициализации схемы (воркеры супервизора): секции вперёд и их горизонт.
+
+    Без горизонта insert_operations не создавал бы новые секции, и строки
+    следующих месяцев копились бы в user_operations_default.
+    """
+    async with _query("init_operation_partitions") as conn:
+        await _sync_operation_partitions(conn)
+
+async def init_db():
+    async with _query("init_db") as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                telegram_id BIGINT PRIMARY KEY,
+                api_key TEXT NOT NULL,
+                organisation_name TEXT
+            )
+        """)
+        await conn.execute(OPERATIONS_TABLE_SQL)
+        await _sync_operation_partitions(conn)
+        for sql in OPERATIONS_INDEXES_SQL:
+            await conn.execute(sql)
+        await conn.execute(DAILY_ROLLUP_SQL)
+        await conn.execute(OUTBOX_TABLE_SQL)
+        await conn.execute(OUTBOX_INDEX_SQL)
+        await _update_outbox_status_check(conn)
+        await conn.execute(FSM_TABLE_SQL)
+        await conn.execute(FSM_INDEX_SQL)
+        # Первичное заполнение агрегатов, если таблица агрегатов только что появилась
+        await conn.execute("""
+            INSERT INTO user_operations_daily (operation_date, telegram_id, operation_type, operations_count)
+            SELECT operation_date, telegram_id, operation_type, COUNT(*)
+            FROM user_operations
+            WHERE NOT EXISTS (SELECT 1 FROM user_operations_daily)
+            GROUP BY operation_date, telegram_id, operation_type
+        """)
+
+# Кэш пользователей: telegram_id -> (истекает в, запись или None для незарегистрированных).
+# Сбрасывается при register_user и по NOTIFY от других экземпляров бота.
+_user_cache: "OrderedDict[int, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+_user_cache_stats = {"hits": 0, "negative_hits": 0, "misses": 0, "invalidations": 0}
+# Растёт при каждом сбросе: ответ БД, полученный до сброса, в кэш не кладётся
+_user_cache_generation = 0
+_listener_conn: Optional[asyncpg.Connection] = None
+_listener_task: Optional[asyncio.Task] = None
+_listener_stopping = False
+# Другие подписчики того же LISTEN-соединения: канал -> (уведомление, сброс при потере связи)
+_notify_handlers: Dict[str, Tuple[Callable[[str], None], Callable[[], None]]] = {}
+
+def _user_cache_put(telegram_id: int, info: Optional[Dict[str, Any]]):
+    ttl = USER_CACHE_TTL if info is not None else USER_CACHE_NEGATIVE_TTL
+    _user_cache[telegram_id] = (time.monotonic() + ttl, info)
+    _user_cache.move_to_end(telegram_id)
+    while len(_user_cache) > USER_CACHE_MAX_ENTRIES:
+        _user_cache.popitem(last=False)
+
+def invalidate_user_cache(telegram_id: Optional[int] = None):
+    global _user_cache_generation
+    _user_cache_generation += 1
+    _user_cache_stats["invalidations"] += 1
+    if telegram_id is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(telegram_id, None)
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    return {
+        **_user_cache_stats,
+        "entries": len(_user_cache),
+        "max_entries": USER_CACHE_MAX_ENTRIES,
+        "listening": _listener_conn is not None and not _listener_conn.is_closed(),
+    }
+
+def _on_user_notify(conn, pid, channel, payload):
+    # payload: telegram_id или "*" — сбросить всё
+    try:
+        invalidate_user_cache(None if payload == "*" else int(payload))
+    except ValueError:
+        logger.warning("Некорректное уведомление %s: %r", channel, payload)
+
+def _on_notify(conn, pid, channel, payload):
+    handlers = _notify_handlers.get(channel)
+    if handlers is not None:
+        handlers[0](payload)
+
+def _reset_notified_caches():
+    invalidate_user_cache()
+    for _, on_reset in _notify_handlers.values():
+        on_reset()
+
+async def add_notify_handler(channel: str, on_notify: Callable[[str], None], on_reset: Callable[[], None]):
+    """Подписывает кэш на канал NOTIFY; on_reset — уведомления могли потеряться."""
+    _notify_handlers[channel] = (on_notify, on_reset)
+    if _listener_conn is not None and not _listener_conn.is_closed():
+        await _listener_conn.add_listener(channel, _on_notify)
+
+def _on_listener_lost(conn):
+    global _listener_conn, _listener_task
+    _listener_conn = None
+    # Пока соединения нет, уведомления теряются — кэшам доверять нельзя
+    _reset_notified_caches()
+    if not _listener_stopping:
+        _listener_task = asyncio.get_running_loop().create_task(_connect_listener(retry_delay=5))
+
+async def _connect_listener(retry_delay: float = 0):
+    global _listener_conn
+    while not _listener_stopping:
+        if retry_delay:
+            await asyncio.sleep(retry_delay)
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            await conn.add_listener(USER_REGISTRY_CHANNEL, _on_user_notify)
+            channels = list(_notify_handlers)
+            for channel in channels:
+                await conn.add_listener(channel, _on_notify)
+            conn.add_termination_listener(_on_listener_lost)
+            _listener_conn = conn
+            # Подписчики, добавленные, пока шло подключение
+            for channel in set(_notify_handlers) - set(channels):
+                await conn.add_listener(channel, _on_notify)
+            _reset_notified_caches()
+            return
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+            logger.warning("Не удалось подписаться на %s: %s", USER_REGISTRY_CHANNEL, e)
+            retry_delay = retry_delay or 5
+
+async def start_user_listener():
+    """Подключает LISTEN в фоне: сброс кэшей по NOTIFY — оптимизация и запуск бота
+    не задерживает. Пока соединения нет, кэши живут по своему TTL."""
+    global _listener_stopping, _listener_task
+    _listener_stopping = False
+    _listener_task = asyncio.get_running_loop().create_task(_connect_listener())
+
+async def stop_user_listener():
+    global _listener_conn, _listener_stopping, _listener_task
+    _listener_stopping = True
+    if _listener_task is not None:
+        _listener_task.cancel()
+        _listener_task = None
+    if _listener_conn is not None:
+        conn, _listener_conn = _listener_conn, None
+        await conn.close()
 
 async def get_user_api_key(telegram_id: int) -> Optional[str]:
-    conn = await asyncpg.connect(DATABASE_URL)
-    row = await conn.fetchrow("SELECT api_key FROM users WHERE telegram_id = $1", telegram_id)
-    await conn.close()
-    return row["api_key"] if row else None
+    info = await get_user_info(telegram_id)
+    return info["api_key"] if info else None
 
 async def get_user_info(telegram_id: int) -> Optional[Dict[str, Any]]:
-    conn = await asyncpg.connect(DATABASE_URL)
-    row = await conn.fetchrow(
-        "SELECT api_key, organisation_name FROM users WHERE telegram_id = $1",
-        telegram_id
-    )
-    await conn.close()
-    return dict(row) if row else None
+    cached = _user_cache.get(telegram_id)
+    if cached is not None and cached[0] > time.monotonic():
+        _user_cache.move_to_end(telegram_id)
+        info = cached[1]
+        _user_cache_stats["hits" if info is not None else "negative_hits"] += 1
+        return dict(info) if info is not None else None
+
+    _user_cache_stats["misses"] += 1
+    generation = _user_cache_generation
+    async with _query("get_user_info") as conn:
+        row = await conn.fetchrow(
+            "SELECT api_key, organisation_name FROM users WHERE telegram_id = $1",
+            telegram_id
+        )
+    info = dict(row) if row else None
+    if generation == _user_cache_generation:
+        _user_cache_put(telegram_id, info)
+    return dict(info) if info is not None else None
 
 async def register_user(telegram_id: int, api_key: str, organisation_name: str = None) -> bool:
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        await conn.execute(
-            """
-            INSERT INTO users (telegram_id, api_key, organisation_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (telegram_id) DO UPDATE
-            SET api_key = $2, organisation_name = $3
-            """,
-            telegram_id, api_key, organisation_name
-        )
-        await conn.close()
+        async with _query("register_user") as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    INSERT INTO users (telegram_id, api_key, organisation_name)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (telegram_id) DO UPDATE
+                    SET api_key = $2, organisation_name = $3
+                    """,
+                    telegram_id, api_key, organisation_name
+                )
+                # Уведомление уходит другим экземплярам только после коммита
+                await conn.execute("SELECT pg_notify($1, $2)", USER_REGISTRY_CHANNEL, str(telegram_id))
+        invalidate_user_cache(telegram_id)
         return True
     except Exception:
         return False
 
-async def log_simple_operation(telegram_id: int, operation_type: str, operation_date):
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute("""
-        INSERT INTO user_operations (telegram_id, operation_type, operation_date)
-        VALUES ($1, $2, $3)
-    """, telegram_id, operation_type, operation_date)
-    await conn.close()
-
-async def get_all_operations() -> List[Tuple[int, str, str]]:
-    conn = await asyncpg.connect(DATABASE_URL)
-    rows = await conn.fetch("""
-        SELECT telegram_id, operation_type, operation_date::TEXT
-        FROM user_operations
-        ORDER BY operation_date DESC, id DESC
-    """)
-    await conn.close()
-    return [(r["telegram_id"], r["operation_type"], r["operation_date"]) for r in rows]
\ No newline at end of file
+OPERATION_COLUMNS = ("telegram_id", "operation_type", "operation_date")
+
+async def insert_operations(records: List[Tuple[int, str, Any]]):
+    """Пакетная вставка строк (telegram_id, operation_type, operation_date) через COPY.
+
+    В той же транзакции увеличиваются счётчики user_operations_daily.
+    """
+    daily: Dict[Tuple[Any, int, str], int] = {}
+    for telegram_id, operation_type, operation_date in records:
+        key = (operation_date, telegram_id, operation_type)
+        daily[key] = daily.get(key, 0) + 1
+
+    async with _query("insert_operations") as conn:
+        if _partitions_until is not None:
+            latest = max(r[2] for r in records)
+            if latest >= _partitions_until:
+                await ensure_operation_partitions(
+                    conn, _add_months(latest, OPERATIONS_PARTITIONS_AHEAD + 1)
+                )
+        async with conn.transaction():
+            await conn.copy_records_to_table(
+                "user_operations",
+                records=records,
+                columns=OPERATION_COLUMNS,
+            )
+            await conn.executemany("""
+                INSERT INTO user_operations_daily (operation_date, telegram_id, operation_type, operations_count)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (operation_date, telegram_id, operation_type)
+                DO UPDATE SET operations_count = user_operations_daily.operations_count + EXCLUDED.operations_count
+            """, [(*key, count) for key, count in daily.items()])
+
+async def enqueue_outbox_payment(
+    external_id: str,
+    telegram_id: int,
+    chat_id: int,
+    api_key: str,
+    payload: Dict[str, Any],
+    operation_type: str,
+    operation_date: datetime.date,
+):
+    async with _query("enqueue_outbox_payment") as conn:
+        await conn.execute("""
+            INSERT INTO payment_outbox
+                (external_id, telegram_id, chat_id, api_key, payload, operation_type, operation_date)
+            VALUES ($1, $2, $3, $4, $5::JSONB, $6, $7)
+            ON CONFLICT (external_id) DO NOTHING
+        """, external_id, telegram_id, chat_id, api_key, json.dumps(payload, ensure_ascii=False),
+            operation_type, operation_date)
+
+async def claim_outbox_payments(limit: int, lease_seconds: int) -> List[Dict[str, Any]]:
+    """Забирает готовые к отправке платежи; SKIP LOCKED — безопасно для нескольких экземпляров.
+
+    previous_status = 'sending' — аренда истекла: прошлая отправка могла дойти до API.
+    """
+    async with _query("claim_outbox_payments") as conn:
+        rows = await conn.fetch("""
+            WITH due AS (
+                SELECT external_id, status FROM payment_outbox
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= now()
+                ORDER BY next_attempt_at
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE payment_outbox p
+            SET status = 'sending',
+                attempts = p.attempts + 1,
+                next_attempt_at = now() + make_interval(secs => $2)
+            FROM due
+            WHERE p.external_id = due.external_id
+            RETURNING p.external_id::TEXT, p.telegram_id, p.chat_id, p.api_key, p.payload::TEXT,
+                      p.operation_type, p.operation_date, p.attempts, p.created_at,
+                      due.status AS previous_status
+        """, limit, lease_seconds)
+    result = []
+    for r in rows:
+        item = dict(r)
+        item["payload"] = json.loads(item["payload"])
+        result.append(item)
+    return result
+
+async def finish_outbox_payment(external_id: str, status: str, error: Optional[str] = None):
+    async with _query("finish_outbox_payment") as conn:
+        await conn.execute("""
+            UPDATE payment_outbox
+            SET status = $2, last_error = $3, finished_at = now()
+            WHERE external_id = $1::UUID
+        """, external_id, status, error)
+
+async def retry_outbox_payment(external_id: str, delay_seconds: float, error: str):
+    async with _query("retry_outbox_payment") as conn:
+        await conn.execute("""
+            UPDATE payment_outbox
+            SET status = 'pending', last_error = $3,
+                next_attempt_at = now() + make_interval(secs => $2)
+            WHERE external_id = $1::UUID
+        """, external_id, delay_seconds, error)
+
+async def reconcile_outbox_payment(external_id: str, error: str):
+    async with _query("reconcile_outbox_payment") as conn:
+        await conn.execute("""
+            UPDATE payment_outbox SET status = 'reconcile', last_error = $2
+            WHERE external_id = $1::UUID
+        """, external_id, error)
+
+async def get_reconcile_payments(limit: int = 20) -> List[Dict[str, Any]]:
+    async with _query("get_reconcile_payments") as conn:
+        rows = await conn.fetch("""
+            SELECT external_id::TEXT, telegram_id, api_key, payload::TEXT, attempts, last_error, created_at
+            FROM payment_outbox
+            WHERE status = 'reconcile'
+            ORDER BY created_at
+            LIMIT $1
+        """, limit)
+    result = []
+    for r in rows:
+        item = dict(r)
+        item["payload"] = json.loads(item["payload"])
+        result.append(item)
+    return result
+
+async def resolve_outbox_payment(external_id: str, status: str) -> Optional[Dict[str, Any]]:
+    """Итог сверки платежа в reconcile: sent, failed или pending (отправить ещё раз)."""
+    async with _query("resolve_outbox_payment") as conn:
+        row = await conn.fetchrow("""
+            UPDATE payment_outbox
+            SET status = $2,
+                next_attempt_at = now(),
+                finished_at = CASE WHEN $2 = 'pending' THEN NULL ELSE now() END
+            WHERE external_id = $1::UUID AND status = 'reconcile'
+            RETURNING telegram_id, chat_id, operation_type, operation_date
+        """, external_id, status)
+    return dict(row) if row else None
+
+async def get_outbox_stats() -> Dict[str, Any]:
+    async with _query("get_outbox_stats") as conn:
+        row = await conn.fetchrow("""
+            SELECT
+                COUNT(*) FILTER (WHERE status IN ('pending', 'sending')) AS queued,
+                COALESCE(EXTRACT(EPOCH FROM now() - MIN(created_at)
+                    FILTER (WHERE status IN ('pending', 'sending'))), 0) AS oldest_age,
+                COUNT(*) FILTER (WHERE status = 'failed' AND finished_at > now() - INTERVAL '1 day') AS failed_day,
+                COUNT(*) FILTER (WHERE status = 'reconcile') AS reconcile
+            FROM payment_outbox
+            WHERE status <> 'sent'
+        """)
+    return dict(row)
+
+async def load_fsm_record(storage_key: str) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+    async with _query("load_fsm_record") as conn:
+        row = await conn.fetchrow("SELECT state, data FROM fsm_states WHERE storage_key = $1", storage_key)
+    return (row["state"], json.loads(row["data"])) if row else None
+
+async def save_fsm_records(
+    records: List[Tuple[str, Optional[str], str]],
+    channel: Optional[str] = None,
+    notify_payloads: Iterable[str] = (),
+):
+    """Пакетная запись состояний (ключ, state, JSON data); пустые записи удаляются.
+
+    Уведомления в channel уходят в той же транзакции, т. е. только после коммита.
+    """
+    upserts = [(key, state, data) for key, state, data in records if state is not None or data != "{}"]
+    deletes = [key for key, state, data in records if state is None and data == "{}"]
+    async with _query("save_fsm_records") as conn:
+        async with conn.transaction():
+            if upserts:
+                keys, states, datas = zip(*upserts)
+                await conn.execute("""
+                    INSERT INTO fsm_states (storage_key, state, data, updated_at)
+                    SELECT k, s, d::jsonb, now() FROM unnest($1::text[], $2::text[], $3::text[]) AS t(k, s, d)
+                    ON CONFLICT (storage_key) DO UPDATE
+                    SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+                """, list(keys), list(states), list(datas))
+            if deletes:
+                await conn.execute("DELETE FROM fsm_states WHERE storage_key = ANY($1::text[])", deletes)
+            if channel:
+                for payload in notify_payloads:
+                    await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+async def delete_expired_fsm_records(ttl_seconds: float, batch_size: int = 1000) -> int:
+    """Удаляет сценарии без изменений дольше ttl_seconds — пачками, чтобы не держать блокировки."""
+    deleted = 0
+    while True:
+        async with _query("delete_expired_fsm_records") as conn:
+            result = await conn.execute("""
+                DELETE FROM fsm_states WHERE storage_key IN (
+                    SELECT storage_key FROM fsm_states
+                    WHERE updated_at < now() - make_interval(secs => $1)
+                    LIMIT $2
+                )
+            """, float(ttl_seconds), batch_size)
+        count = int(result.split()[-1])
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+async def get_month_user_summary(month_start: datetime.date) -> List[Dict[str, Any]]:
+    """Операции по пользователям за месяц — из дневных агрегатов."""
+    async with _query("get_month_user_summary") as conn:
+        rows = await conn.fetch("""
+            SELECT d.telegram_id,
+                   u.organisation_name,
+                   SUM(d.operations_count) FILTER (WHERE d.operation_type = 'expense') AS expenses,
+                   SUM(d.operations_count) FILTER (WHERE d.operation_type = 'income') AS incomes,
+                   SUM(d.operations_count) AS total
+            FROM user_operations_daily d
+            LEFT JOIN users u ON u.telegram_id = d.telegram_id
+            WHERE d.operation_date >= $1 AND d.operation_date < $2
+            GROUP BY d.telegram_id, u.organisation_name
+            ORDER BY total DESC
+        """, month_start, _add_months(month_start, 1))
+    return [dict(r) for r in rows]
+
+async def get_daily_activity(days: int = 30) -> List[Dict[str, Any]]:
+    """Активность по дням за последние days дней — из дневных агрегатов."""
+    async with _query("get_daily_activity") as conn:
+        rows = await conn.fetch("""
+            SELECT operation_date,
+                   COUNT(DISTINCT telegram_id) AS users,
+                   SUM(operations_count) FILTER (WHERE operation_type = 'expense') AS expenses,
+                   SUM(operations_count) FILTER (WHERE operation_type = 'income') AS incomes
+            FROM user_operations_daily
+            WHERE operation_date > CURRENT_DATE - $1::INTEGER
+            GROUP BY operation_date
+            ORDER BY operation_date DESC
+        """, days)
+    return [dict(r) for r in rows]
+
+async def get_active_api_keys(days: int, limit: int, workers: int = 1, worker_index: int = 0) -> List[str]:
+    """API-ключи самых активных пользователей за последние days дней — для прогрева кэша.
+
+    В многопроцессном режиме — только пользователей, чьи чаты закреплены за воркером.
+    """
+    async with _query("get_active_api_keys") as conn:
+        rows = await conn.fetch("""
+            SELECT u.api_key
+            FROM user_operations_daily d
+            JOIN users u ON u.telegram_id = d.telegram_id
+            WHERE d.operation_date > CURRENT_DATE - $1::INTEGER AND u.api_key IS NOT NULL
+              AND d.telegram_id % $3 = $4
+            GROUP BY u.api_key
+            ORDER BY SUM(d.operations_count) DESC
+            LIMIT $2
+        """, days, limit, workers, worker_index)
+    return [r["api_key"] for r in rows]
+
+async def iter_operations(
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    telegram_id: Optional[int] = None,
+    batch_size: int = 5000,
+) -> AsyncIterator[List[Tuple[int, str, str]]]:
+    """Операции пачками через серверный курсор — память не растёт с размером таблицы."""
+    async with _query("iter_operations") as conn:
+        async with conn.transaction():
+            cursor = await conn.cursor("""
+                SELECT telegram_id, operation_type, operation_date::TEXT
+                FROM user_operations
+                WHERE ($1::DATE IS NULL OR operation_date >= $1)
+                  AND ($2::DATE IS NULL OR operation_date <= $2)
+                  AND ($3::BIGINT IS NULL OR telegram_id = $3)
+                ORDER BY operation_date DESC, id DESC
+            """, date_from, date_to, telegram_id)
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if not rows:
+                    break
+                yield [(r["telegram_id"], r["operation_type"], r["operation_date"]) for r in rows]
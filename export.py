@@ -0,0 +1,72 @@
+# export.py
+import csv
+import datetime
+import gzip
+import io
+import tempfile
+import zipfile
+from contextlib import aclosing
+from typing import IO, AsyncGenerator, Optional, Tuple
+from aiogram.types import InputFile
+from config import EXPORT_FETCH_SIZE, EXPORT_SPOOL_MAX_SIZE
+from database import iter_operations
+
+EXPORT_FILENAMES = {"csv": "operations.csv", "gz": "operations.csv.gz", "zip": "operations.zip"}
+CSV_HEADER = ["telegram_id", "operation_type", "operation_date"]
+
+class SpooledInputFile(InputFile):
+    """Загрузка в Telegram из уже записанного (временного) файла кусками."""
+
+    def __init__(self, file: IO[bytes], filename: str):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+async def export_operations(
+    fmt: str = "csv",
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    telegram_id: Optional[int] = None,
+) -> Tuple[SpooledInputFile, int]:
+    """Пишет операции в CSV (опционально gzip/zip) во временный файл.
+
+    Строки читаются серверным курсором и сразу пишутся в файл, поэтому память
+    не зависит от числа строк. Вызывающий должен закрыть input_file.file.
+    """
+    if fmt not in EXPORT_FILENAMES:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
+    archive = None
+    if fmt == "gz":
+        binary = gzip.GzipFile(filename="operations.csv", fileobj=spool, mode="wb")
+    elif fmt == "zip":
+        archive = zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_DEFLATED)
+        binary = archive.open("operations.csv", "w", force_zip64=True)
+    else:
+        binary = spool
+
+    rows = 0
+    try:
+        text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(CSV_HEADER)
+        async with aclosing(iter_operations(date_from, date_to, telegram_id, EXPORT_FETCH_SIZE)) as batches:
+            async for batch in batches:
+                writer.writerows(batch)
+                rows += len(batch)
+        text.flush()
+        text.detach()
+        if binary is not spool:
+            binary.close()
+        if archive is not None:
+            archive.close()
+    except BaseException:
+        spool.close()
+        raise
+
+    return SpooledInputFile(spool, filename=EXPORT_FILENAMES[fmt]), rows
@@ -0,0 +1,336 @@
+# fsm_storage.py
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from config import (
+    FSM_FLOW_TTL,
+    FSM_FLUSH_INTERVAL,
+    FSM_FLUSH_BATCH,
+    FSM_CACHE_MAX_ENTRIES,
+    FSM_CLEANUP_INTERVAL,
+    FSM_CHANNEL,
+)
+from database import add_notify_handler, delete_expired_fsm_records, load_fsm_record, save_fsm_records
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+FSM_FLUSH_SECONDS = Histogram("fsm_flush_seconds", "Запись пачки состояний сценариев в Postgres")
+# Полезная нагрузка NOTIFY ограничена 8000 байт
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+class TTLMemoryStorage(MemoryStorage):
+    """MemoryStorage, который забывает брошенные сценарии.
+
+    Каждое обращение к ключу продлевает его жизнь; не чаще раза в
+    sweep_interval секунд удаляются записи, к которым не обращались дольше ttl,
+    а также пустые записи (без состояния и данных).
+    """
+
+    def __init__(self, ttl: float, sweep_interval: float = 60):
+        super().__init__()
+        self._ttl = ttl
+        self._sweep_interval = sweep_interval
+        self._touched: Dict[StorageKey, float] = {}
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.evicted = 0
+
+    def _touch(self, key: StorageKey):
+        now = time.monotonic()
+        self._touched[key] = now
+        if now >= self._next_sweep:
+            self._next_sweep = now + self._sweep_interval
+            self.sweep(now)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        expired = [
+            key for key, touched in self._touched.items()
+            if now - touched > self._ttl
+        ]
+        for key in expired:
+            del self._touched[key]
+            if self.storage.pop(key, None) is not None:
+                self.evicted += 1
+        empty = [
+            key for key, record in self.storage.items()
+            if record.state is None and not record.data
+        ]
+        for key in empty:
+            del self.storage[key]
+            self._touched.pop(key, None)
+        return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"records": len(self.storage), "evicted": self.evicted, "ttl": self._ttl}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._touch(key)
+        await super().set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        self._touch(key)
+        return await super().get_state(key)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._touch(key)
+        await super().set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        self._touch(key)
+        return await super().get_data(key)
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        self._touch(storage_key)
+        return await super().get_value(storage_key, dict_key, default)
+
+# Запись в кэше процесса: (состояние, данные, время последнего обращения)
+_CachedRecord = Tuple[Optional[str], Dict[str, Any], float]
+
+class PostgresStorage(BaseStorage):
+    """Хранилище сценариев aiogram в Postgres (таблица fsm_states).
+
+    Сценарии переживают перезапуск и видны всем экземплярам бота. Чтения идут
+    из кэша процесса, а в БД — только при первом обращении к ключу. Записи
+    сразу попадают в кэш и копятся flush_interval секунд (или до batch_size
+    ключей), затем уходят одним upsert; несколько изменений одного ключа
+    схлопываются в одно. Данные хранятся в JSONB. После записи другие
+    экземпляры получают NOTIFY и сбрасывают эти ключи в своём кэше. Сценарии
+    без изменений дольше ttl раз в cleanup_interval секунд удаляются.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        flush_interval: float,
+        batch_size: int,
+        cache_max_entries: int,
+        cleanup_interval: float,
+        channel: str,
+    ):
+        self._ttl = ttl
+        self._flush_interval = flush_interval
+        self._batch_size = max(1, batch_size)
+        self._cache_max_entries = cache_max_entries
+        self._cleanup_interval = cleanup_interval
+        self._channel = channel
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._instance = uuid.uuid4().hex
+        self._cache: "OrderedDict[str, _CachedRecord]" = OrderedDict()
+        # ключ -> (состояние, данные, данные в JSON); пишутся при следующем сбросе
+        self._pending: Dict[str, Tuple[Optional[str], Dict[str, Any], str]] = {}
+        # Растёт при каждом сбросе кэша: ответ БД, полученный до сброса, в кэш не кладётся
+        self._generation = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "flushes": 0,
+            "flushed": 0,
+            "failures": 0,
+            "expired": 0,
+            "invalidations": 0,
+        }
+
+    async def start(self):
+        if self._tasks:
+            return
+        await add_notify_handler(self._channel, self._on_notify, self._on_reset)
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._flush_loop())]
+        if self._cleanup_interval > 0 and self._ttl > 0:
+            self._tasks.append(asyncio.create_task(self._cleanup_loop()))
+
+    async def stop(self):
+        """Останавливает фоновые задачи и дописывает отложенные изменения.
+
+        Цикл записи не отменяется: он заканчивает текущий upsert и выходит сам,
+        иначе уже снятые с _pending изменения потерялись бы.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks[1:]:  # первая — цикл записи
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+        if self._pending:
+            logger.error("При остановке не записано состояний сценариев: %d", len(self._pending))
+
+    async def close(self) -> None:
+        # Вызывается при остановке Dispatcher; задачи останавливает stop() в bot_services
+        await self.flush()
+
+    async def _load(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        storage_key = self._key_builder.build(key)
+        pending = self._pending.get(storage_key)
+        cached = self._cache.get(storage_key)
+        if cached is not None:
+            self._cache[storage_key] = (cached[0], cached[1], time.monotonic())
+            self._cache.move_to_end(storage_key)
+            self._stats["hits"] += 1
+            return cached[0], cached[1]
+        if pending is not None:
+            # Вытеснена из кэша, но ещё не записана — БД пока отстаёт
+            self._stats["hits"] += 1
+            return pending[0], pending[1]
+
+        self._stats["misses"] += 1
+        generation = self._generation
+        record = await load_fsm_record(storage_key) or (None, {})
+        if generation == self._generation and storage_key not in self._pending:
+            self._cache_put(storage_key, *record)
+            return record
+        return await self._load(key)
+
+    def _cache_put(self, storage_key: str, state: Optional[str], data: Dict[str, Any]):
+        self._cache[storage_key] = (state, data, time.monotonic())
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self._cache_max_entries:
+            self._cache.popitem(last=False)
+
+    def _store(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        storage_key = self._key_builder.build(key)
+        # Сериализуем сразу: несериализуемые данные — ошибка в обработчике, а не в фоне
+        encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        self._pending[storage_key] = (state, data, encoded)
+        self._cache_put(storage_key, state, data)
+        self._stats["writes"] += 1
+        if len(self._pending) >= self._batch_size:
+            self._wakeup.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self._load(key)
+        self._store(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        state, _ = await self._load(key)
+        self._store(key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key)
+        return data.copy()
+
+    async def _flush_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                keys = list(self._pending)[:self._batch_size]
+                batch = {key: self._pending.pop(key) for key in keys}
+                started = time.perf_counter()
+                try:
+                    await save_fsm_records(
+                        [(key, state, encoded) for key, (state, _, encoded) in batch.items()],
+                        channel=self._channel,
+                        notify_payloads=self._notify_payloads(keys),
+                    )
+                except asyncio.CancelledError:
+                    # Отменили посреди записи — изменения возвращаются для финального сброса
+                    for key, record in batch.items():
+                        self._pending.setdefault(key, record)
+                    raise
+                except Exception as e:
+                    self._stats["failures"] += 1
+                    logger.warning("Не удалось записать %d состояний сценариев: %s", len(batch), e)
+                    # Более новые изменения, пришедшие во время записи, не затираем
+                    for key, record in batch.items():
+                        self._pending.setdefault(key, record)
+                    return
+                FSM_FLUSH_SECONDS.observe(time.perf_counter() - started)
+                self._stats["flushes"] += 1
+                self._stats["flushed"] += len(batch)
+
+    def _notify_payloads(self, keys: List[str]) -> List[str]:
+        """«экземпляр:ключ\nключ…», порезанные под лимит NOTIFY."""
+        payloads: List[str] = []
+        chunk: List[str] = []
+        size = 0
+        for key in keys:
+            key_size = len(key.encode("utf-8")) + 1
+            if chunk and size + key_size > NOTIFY_PAYLOAD_LIMIT:
+                payloads.append(f"{self._instance}:" + "\n".join(chunk))
+                chunk, size = [], 0
+            chunk.append(key)
+            size += key_size
+        if chunk:
+            payloads.append(f"{self._instance}:" + "\n".join(chunk))
+        return payloads
+
+    def _on_notify(self, payload: str):
+        instance, _, keys = payload.partition(":")
+        if instance == self._instance:
+            return
+        for key in keys.split("\n"):
+            # Своё незаписанное изменение новее — его и оставляем
+            if key not in self._pending and self._cache.pop(key, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def _on_reset(self):
+        self._generation += 1
+        self._cache.clear()
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self._cleanup_interval)
+            self.sweep_cache()
+            try:
+                self._stats["expired"] += await delete_expired_fsm_records(self._ttl)
+            except Exception as e:
+                logger.warning("Не удалось удалить брошенные сценарии: %s", e)
+
+    def sweep_cache(self) -> int:
+        """Убирает из кэша процесса записи, к которым не обращались дольше ttl."""
+        deadline = time.monotonic() - self._ttl
+        removed = 0
+        # Кэш упорядочен по последнему обращению — старые в начале
+        while self._cache:
+            key, (_, _, touched) = next(iter(self._cache.items()))
+            if touched > deadline:
+                break
+            del self._cache[key]
+            removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "cached": len(self._cache),
+            "max_cached": self._cache_max_entries,
+            "pending": len(self._pending),
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+            "ttl": self._ttl,
+        }
+
+postgres_storage = PostgresStorage(
+    ttl=FSM_FLOW_TTL,
+    flush_interval=FSM_FLUSH_INTERVAL,
+    batch_size=FSM_FLUSH_BATCH,
+    cache_max_entries=FSM_CACHE_MAX_ENTRIES,
+    cleanup_interval=FSM_CLEANUP_INTERVAL,
+    channel=FSM_CHANNEL,
+)
+Gauge("fsm_pending_writes", "Состояний сценариев, ждущих записи в Postgres", lambda: postgres_storage.stats()["pending"])
@@ -1,12 +1,34 @@
 # handlers/admin.py
 from aiogram import Router, F, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage
 from config import TELEGRAM_ADMIN_IDS
-from database import register_user, get_all_operations
-import csv
-import io
+from database import (
+    register_user,
+    get_pool_stats,
+    get_user_cache_stats,
+    get_month_user_summary,
+    get_daily_activity,
+    get_reconcile_payments,
+)
+from export import export_operations, EXPORT_FILENAMES
+from api_client import report_api
+from reference_cache import reference_cache
+from keyboards import catalog_keyboards
+from search_index import catalog_search
+from warmup import reference_warmup
+from update_queue import QueuedDispatcher
+from middlewares import FloodControlMiddleware
+from profiler import update_profiler, PROFILE_MODES
+from tracing import slow_update_log
+from fsm_storage import TTLMemoryStorage, PostgresStorage
+from operation_log import operation_log
+from payment_batcher import payment_batcher
+from payment_outbox import payment_outbox
+from typing import Any, Dict, Optional
+import datetime
 
 router = Router()
 
@@ -24,6 +46,9 @@ ADMIN_MENU = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="➕ Зарегистрировать пользователя")],
         [KeyboardButton(text="📊 Выгрузить статистику (CSV)")],
+        [KeyboardButton(text="📈 Операции по пользователям (месяц)"), KeyboardButton(text="📅 Активность по дням")],
+        [KeyboardButton(text="🩺 Состояние бота"), KeyboardButton(text="🔬 Профилирование (30 с)")],
+        [KeyboardButton(text="🔄 Сбросить кэш справочников")],
         [KeyboardButton(text="⬅️ Назад")]
     ],
     resize_keyboard=True,
@@ -44,31 +69,304 @@ async def start_register_flow(message: types.Message, state: FSMContext):
     await message.answer("Введите Telegram ID пользователя:")
     await state.set_state(RegisterForm.waiting_for_telegram_id)
 
+def _parse_export_args(args: Optional[str]) -> Dict[str, Any]:
+    """Разбирает «from=2024-01-01 to=2024-01-31 user=123 format=gz»."""
+    params: Dict[str, Any] = {"fmt": "csv"}
+    for token in (args or "").split():
+        name, _, value = token.partition("=")
+        if name == "from":
+            params["date_from"] = datetime.date.fromisoformat(value)
+        elif name == "to":
+            params["date_to"] = datetime.date.fromisoformat(value)
+        elif name == "user":
+            params["telegram_id"] = int(value)
+        elif name == "format" and value in EXPORT_FILENAMES:
+            params["fmt"] = value
+        else:
+            raise ValueError(f"непонятный параметр «{token}»")
+    return params
+
+async def _send_operations_export(message: types.Message, params: Dict[str, Any]):
+    input_file, rows = await export_operations(**params)
+    try:
+        if not rows:
+            await message.answer("Нет данных об операциях.")
+            return
+        await message.answer_document(
+            input_file,
+            caption=f"📊 Файл с операциями ({rows} шт.; только факт: тип, дата, пользователь)."
+        )
+    finally:
+        input_file.file.close()
+
 @router.message(AdminMenu.main, F.text == "📊 Выгрузить статистику (CSV)")
 async def trigger_stats(message: types.Message, state: FSMContext):
     if message.from_user.id not in TELEGRAM_ADMIN_IDS:
         await message.answer("❌ У вас нет прав администратора.")
         return
     try:
-        operations = await get_all_operations()
-        if not operations:
-            await message.answer("Нет данных об операциях.")
-            return
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(["telegram_id", "operation_type", "operation_date"])
-        writer.writerows(operations)
-        csv_data = output.getvalue()
-        output.close()
-        csv_bytes = io.BytesIO(csv_data.encode("utf-8"))
-        csv_bytes.name = "operations.csv"
-        await message.answer_document(
-            types.BufferedInputFile(csv_bytes.getvalue(), filename="operations.csv"),
-            caption="📊 Файл со всеми операциями (только факт: тип, дата, пользователь)."
+        await _send_operations_export(message, {"fmt": "csv"})
+    except Exception as e:
+        await message.answer(f"❌ Ошибка при генерации отчёта: {e}")
+
+@router.message(Command("export"))
+async def export_stats(message: types.Message, command: CommandObject):
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    try:
+        params = _parse_export_args(command.args)
+    except ValueError as e:
+        await message.answer(
+            f"❌ Ошибка в параметрах: {e}\n"
+            "Формат: /export from=ГГГГ-ММ-ДД to=ГГГГ-ММ-ДД user=ID format=csv|gz|zip"
         )
+        return
+    try:
+        await _send_operations_export(message, params)
     except Exception as e:
         await message.answer(f"❌ Ошибка при генерации отчёта: {e}")
 
+@router.message(AdminMenu.main, F.text == "📈 Операции по пользователям (месяц)")
+async def show_month_user_summary(message: types.Message, state: FSMContext):
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    month_start = datetime.date.today().replace(day=1)
+    try:
+        rows = await get_month_user_summary(month_start)
+    except Exception as e:
+        await message.answer(f"❌ Ошибка при получении статистики: {e}")
+        return
+    if not rows:
+        await message.answer("В этом месяце операций нет.")
+        return
+    lines = [f"📈 Операции с {month_start.strftime('%d.%m.%Y')}:"]
+    for r in rows[:50]:
+        lines.append(
+            f"{r['telegram_id']} ({r['organisation_name'] or '—'}): "
+            f"{r['total']} (расходы {r['expenses'] or 0}, приходы {r['incomes'] or 0})"
+        )
+    if len(rows) > 50:
+        lines.append(f"…и ещё пользователей: {len(rows) - 50}")
+    await message.answer("\n".join(lines))
+
+@router.message(AdminMenu.main, F.text == "📅 Активность по дням")
+async def show_daily_activity(message: types.Message, state: FSMContext):
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    try:
+        rows = await get_daily_activity(30)
+    except Exception as e:
+        await message.answer(f"❌ Ошибка при получении статистики: {e}")
+        return
+    if not rows:
+        await message.answer("За последние 30 дней операций нет.")
+        return
+    lines = ["📅 Активность за 30 дней (дата: пользователи, расходы/приходы):"]
+    for r in rows:
+        lines.append(
+            f"{r['operation_date'].strftime('%d.%m')}: {r['users']} чел., "
+            f"{r['expenses'] or 0}/{r['incomes'] or 0}"
+        )
+    await message.answer("\n".join(lines))
+
+@router.message(AdminMenu.main, F.text == "🩺 Состояние бота")
+async def show_health(
+    message: types.Message,
+    state: FSMContext,
+    fsm_storage: BaseStorage,
+    update_queue: Optional[QueuedDispatcher] = None,
+    flood_control: Optional[FloodControlMiddleware] = None,
+):
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    pool = get_pool_stats()
+    ref = reference_cache.stats()
+    catalog = catalog_keyboards.stats()
+    search = catalog_search.stats()
+    warm = reference_warmup.stats()
+    users = get_user_cache_stats()
+    oplog = operation_log.stats()
+    api = report_api.stats()
+    payments = payment_batcher.stats()
+    slow = slow_update_log.stats()
+    lines = [
+        "🩺 Состояние бота\n",
+        f"Пул БД: {pool['in_use']}/{pool['size']} занято "
+        f"(min {pool['min_size']}, max {pool['max_size']}), "
+        f"загрузка {pool['utilization']:.0%}",
+        f"Ожидание соединения: среднее {pool['wait_avg_ms']:.1f} мс, "
+        f"макс {pool['wait_max_ms']:.1f} мс ({pool['acquisitions']} выдач)",
+        f"Кэш справочников: {ref['entries']}/{ref['max_entries']} записей, "
+        f"попаданий {ref['hits']}, устаревших {ref['stale_hits']}, промахов {ref['misses']}, "
+        f"ошибок обновления {ref['refresh_errors']}",
+        f"Клавиатуры справочников: {catalog['pages']}/{catalog['max_pages']} страниц, "
+        f"попаданий {catalog['hits']}, построено {catalog['misses']}, сбросов {catalog['invalidations']}",
+        f"Поиск по справочникам: {search['indexes']} индексов, {search['documents']} записей, "
+        f"запросов {search['searches']}, обновлений {search['updates']}",
+        f"Прогрев справочников: {'работает' if warm['running'] else 'остановлен'}, кругов {warm['rounds']} "
+        f"(последний {warm['last_round_s']:.1f} с), загружено {warm['loaded']}, "
+        f"пропущено занятых ключей {warm['skipped_busy']}, ошибок {warm['errors']}",
+        f"Кэш пользователей: {users['entries']}/{users['max_entries']} записей, "
+        f"попаданий {users['hits']} (+{users['negative_hits']} незарегистрированных), "
+        f"промахов {users['misses']}, сбросов {users['invalidations']}, "
+        f"LISTEN {'активен' if users['listening'] else 'не активен'}",
+        f"Журнал операций: в очереди {oplog['queue_depth']}, записано {oplog['written']} "
+        f"за {oplog['flushes']} сбросов (среднее {oplog['flush_avg_ms']:.1f} мс, "
+        f"макс {oplog['flush_max_ms']:.1f} мс), ошибок {oplog['failures']}, отброшено {oplog['dropped']}",
+        f"Report.Finance: предохранитель {api['breaker_state']} (отказов подряд {api['breaker_failures']}), "
+        f"повторов {api['retries']}, ожиданий лимита {api['throttled']} "
+        f"({api['throttle_wait_total']:.1f} с), ключей {api['limited_keys']}",
+        f"Платежи: {payments['payments']} за {payments['requests']} запросов "
+        f"(в среднем {payments['avg_batch']:.1f} в запросе), ждут отправки {payments['waiting']}, "
+        f"разбитых пачек {payments['split_batches']}",
+        f"Медленные обновления (> {slow['threshold']:g} с): {slow['written']} из {slow['traced']} "
+        f"в {slow['path'] or '—'}, самое долгое {slow['slowest_ms'] / 1000:.1f} с",
+    ]
+    try:
+        outbox = await payment_outbox.stats()
+        lines.append(
+            f"Outbox: в очереди {outbox['queued']} (старейший {outbox['oldest_age']:.0f} с), "
+            f"отправляется {outbox['in_flight']}, отправлено {outbox['sent']} "
+            f"(задержка средняя {outbox['lag_avg']:.1f} с, макс {outbox['lag_max']:.1f} с), "
+            f"повторов {outbox['retried']}, ошибок за сутки {outbox['failed_day']}, "
+            f"требуют сверки {outbox['reconcile_queued']}"
+        )
+    except Exception as e:
+        lines.append(f"Outbox: нет данных ({e})")
+    if update_queue is not None:
+        queue = update_queue.queue_stats()
+        lines.append(
+            f"Очереди обновлений: в обработке {queue['in_flight']}/{queue['max_concurrency']}, "
+            f"ждут {queue['backlog']}/{queue['max_backlog']} в {queue['active_chats']} чатах "
+            f"(глубже всего {queue['deepest_chat']}), ожидание среднее {queue['wait_avg'] * 1000:.0f} мс, "
+            f"макс {queue['wait_max'] * 1000:.0f} мс, отброшено {queue['shed']}"
+        )
+    if flood_control is not None:
+        flood = flood_control.stats()
+        lines.append(
+            f"Защита от флуда: на паузе {flood['in_cooldown']} из {flood['users']} пользователей, "
+            f"пауз {flood['cooldowns']}, отброшено {flood['throttled']}, склеено стартов {flood['collapsed']}"
+        )
+    if isinstance(fsm_storage, TTLMemoryStorage):
+        fsm = fsm_storage.stats()
+        lines.append(f"Сценарии FSM: {fsm['records']} активных, удалено по TTL {fsm['evicted']}")
+    elif isinstance(fsm_storage, PostgresStorage):
+        fsm = fsm_storage.stats()
+        lines.append(
+            f"Сценарии FSM (Postgres): в кэше {fsm['cached']}/{fsm['max_cached']}, "
+            f"попаданий {fsm['hit_rate']:.0%}, ждут записи {fsm['pending']}, "
+            f"записано {fsm['flushed']} за {fsm['flushes']} пачек, ошибок {fsm['failures']}, "
+            f"сброшено по NOTIFY {fsm['invalidations']}, удалено по TTL {fsm['expired']}"
+        )
+    await message.answer("\n".join(lines))
+
+def _parse_profile_args(args: Optional[str]) -> Dict[str, Any]:
+    """Разбирает «mode=cprofile seconds=60» или «updates=200»."""
+    params: Dict[str, Any] = {"mode": "sample"}
+    for token in (args or "").split():
+        name, _, value = token.partition("=")
+        if name == "mode" and value in PROFILE_MODES:
+            params["mode"] = value
+        elif name == "seconds" and value.isdigit() and int(value) > 0:
+            params["seconds"] = int(value)
+        elif name == "updates" and value.isdigit() and int(value) > 0:
+            params["updates"] = int(value)
+        else:
+            raise ValueError(f"непонятный параметр «{token}»")
+    if "seconds" not in params and "updates" not in params:
+        params["seconds"] = 30
+    return params
+
+async def _start_profiling(message: types.Message, params: Dict[str, Any]):
+    bot, chat_id = message.bot, message.chat.id
+
+    async def send_result(filename: str, data: bytes, summary: str):
+        await bot.send_message(chat_id, summary[:4000])
+        await bot.send_document(chat_id, types.BufferedInputFile(data, filename=filename))
+
+    try:
+        update_profiler.start(on_done=send_result, **params)
+    except RuntimeError as e:
+        await message.answer(f"❌ {e}")
+        return
+    limit = f"{params['updates']} обновлений" if "updates" in params else f"{params['seconds']} с"
+    await message.answer(f"🔬 Профилирование ({params['mode']}) запущено: {limit}. Результат пришлю файлом.")
+
+@router.message(AdminMenu.main, F.text == "🔬 Профилирование (30 с)")
+async def trigger_profiling(message: types.Message, state: FSMContext):
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    await _start_profiling(message, {"mode": "sample", "seconds": 30})
+
+@router.message(Command("profile"))
+async def profile_bot(message: types.Message, command: CommandObject):
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    try:
+        params = _parse_profile_args(command.args)
+    except ValueError as e:
+        await message.answer(
+            f"❌ Ошибка в параметрах: {e}\n"
+            "Формат: /profile mode=sample|cprofile seconds=N updates=N"
+        )
+        return
+    await _start_profiling(message, params)
+
+RECONCILE_ACTIONS = {"sent": "sent", "resend": "pending", "failed": "failed"}
+
+@router.message(Command("reconcile"))
+async def reconcile_payments(message: types.Message, command: CommandObject):
+    """Платежи с неизвестным исходом отправки: список и итог сверки с Report.Finance."""
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    args = (command.args or "").split()
+    if not args:
+        try:
+            rows = await get_reconcile_payments()
+        except Exception as e:
+            await message.answer(f"❌ Ошибка при получении платежей: {e}")
+            return
+        if not rows:
+            await message.answer("✅ Платежей, требующих сверки, нет.")
+            return
+        lines = ["⚠️ Платежи, требующие сверки (найдите externalId в Report.Finance):\n"]
+        for row in rows:
+            payload = row["payload"]
+            lines.append(
+                f"{row['external_id']} — {payload.get('sourcePaymentSum')} ₽ от {payload.get('paymentDate', '')}, "
+                f"пользователь {row['telegram_id']}, попыток {row['attempts']}: {row['last_error']}"
+            )
+        lines.append("\nИтог: /reconcile <externalId> sent|resend|failed")
+        await message.answer("\n".join(lines))
+        return
+    if len(args) != 2 or args[1] not in RECONCILE_ACTIONS:
+        await message.answer("❌ Формат: /reconcile <externalId> sent|resend|failed")
+        return
+    try:
+        found = await payment_outbox.resolve(args[0], RECONCILE_ACTIONS[args[1]])
+    except Exception as e:
+        await message.answer(f"❌ Ошибка при сверке: {e}")
+        return
+    if found:
+        await message.answer(f"✅ Платёж {args[0]}: {args[1]}.")
+    else:
+        await message.answer(f"❌ Платёж {args[0]} не найден среди требующих сверки.")
+
+@router.message(AdminMenu.main, F.text == "🔄 Сбросить кэш справочников")
+async def invalidate_reference_cache(message: types.Message, state: FSMContext):
+    if message.from_user.id not in TELEGRAM_ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    removed = reference_cache.invalidate()
+    await message.answer(f"✅ Кэш справочников сброшен (удалено записей: {removed}).")
+
 @router.message(AdminMenu.main, F.text == "⬅️ Назад")
 async def back_to_main(message: types.Message, state: FSMContext):
     from handlers.start import get_main_menu
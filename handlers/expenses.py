@@ -1,18 +1,27 @@
 # handlers/expenses.py
 from aiogram import Router, F
-from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from api_client import ReportFinanceAPI
+from payment_outbox import payment_outbox
+from reference_cache import reference_cache
+from search_index import catalog_search
 from keyboards import (
-    get_project_keyboard,
-    get_account_keyboard,
+    NO_PROJECT,
+    CatalogCallback,
+    catalog_keyboards,
+    catalog_label,
     get_confirmation_keyboard,
-    get_organisation_keyboard
+    get_search_results_keyboard,
 )
 from handlers.start import get_main_menu
-from database import get_user_info, log_simple_operation
+from database import get_user_info
+from typing import Any, Dict, List, Tuple
+from config import FSM_FLOW_TTL
+import asyncio
 import datetime
+import time
 import uuid
 
 router = Router()
@@ -26,6 +35,44 @@ class OperationForm(StatesGroup):
     entering_purpose = State()
     confirming = State()
 
+# Справочники сценария загружаются параллельно сразу при его старте;
+# шаги ждут уже запущенную задачу. user_id -> (время старта, {вид справочника: задача})
+_prefetch_tasks: Dict[int, Tuple[float, Dict[str, asyncio.Task]]] = {}
+PREFETCH_KINDS = ("projects", "organisations", "accounts")
+
+def _retrieve_exception(task: asyncio.Task):
+    # Ошибку покажет шаг, которому нужны данные; здесь только помечаем её полученной
+    if not task.cancelled():
+        task.exception()
+
+def _start_prefetch(user_id: int, api_key: str):
+    _drop_prefetch(user_id)
+    # Брошенные сценарии не должны держать задачи вечно
+    now = time.monotonic()
+    for stale_user in [u for u, (started, _) in _prefetch_tasks.items() if now - started > FSM_FLOW_TTL]:
+        _drop_prefetch(stale_user)
+    tasks = {}
+    for kind in PREFETCH_KINDS:
+        task = asyncio.create_task(reference_cache.get(api_key, kind))
+        task.add_done_callback(_retrieve_exception)
+        tasks[kind] = task
+    _prefetch_tasks[user_id] = (now, tasks)
+
+def _drop_prefetch(user_id: int):
+    _, tasks = _prefetch_tasks.pop(user_id, (0, {}))
+    for task in tasks.values():
+        task.cancel()
+
+async def _prefetched(user_id: int, api_key: str, kind: str) -> List[Dict[str, Any]]:
+    task = _prefetch_tasks.get(user_id, (0, {}))[1].get(kind)
+    if task is None or task.cancelled():
+        return await reference_cache.get(api_key, kind)
+    return await asyncio.shield(task)
+
+async def _end_flow(state: FSMContext):
+    _drop_prefetch(state.key.user_id)
+    await state.clear()
+
 @router.message(F.text == "➕ Добавить расход")
 async def add_expense_start(message: Message, state: FSMContext):
     user_info = await get_user_info(message.from_user.id)
@@ -52,117 +99,202 @@ async def add_income_start(message: Message, state: FSMContext):
     )
     await _start_operation_flow(message, state)
 
+async def _catalog_items(user_id: int, data: Dict[str, Any], kind: str) -> List[Dict[str, Any]]:
+    """Записи справочника в том виде, в каком они показаны на клавиатуре шага."""
+    items = await _prefetched(user_id, data["api_key"], kind)
+    if kind == "projects":
+        return [{"projectName": NO_PROJECT, "id": None}, *items]
+    if kind == "accounts":
+        return [a for a in items if a.get("organisationId") == data.get("organisation_id")]
+    return items
+
+def _catalog_scope(data: Dict[str, Any], kind: str) -> Any:
+    return data.get("organisation_id") if kind == "accounts" else None
+
 async def _proceed_to_organisation(message: Message, state: FSMContext):
     data = await state.get_data()
     api_key = data.get("api_key")
-    api = ReportFinanceAPI(api_key=api_key)
     try:
-        organisations = await api.fetch_all_organisations()
+        organisations = await _catalog_items(state.key.user_id, data, "organisations")
         if not organisations:
             await message.answer("Нет доступных организаций.")
-            await state.clear()
+            await _end_flow(state)
             return
-        org_map = {org.get("organisationName") or f"Орг {org['id']}": org["id"] for org in organisations}
-        await state.update_data(organisations=org_map, organisations_full=organisations)
-        await message.answer("Выберите организацию:", reply_markup=get_organisation_keyboard(organisations))
+        await message.answer(
+            "Выберите организацию:",
+            reply_markup=catalog_keyboards.render(api_key, "organisations", organisations)
+        )
         await state.set_state(OperationForm.choosing_organisation)
     except Exception as e:
         await message.answer(f"❌ Ошибка загрузки организаций: {e}")
-        await state.clear()
+        await _end_flow(state)
 
 async def _start_operation_flow(message: Message, state: FSMContext):
     data = await state.get_data()
     api_key = data.get("api_key")
     if not api_key:
         await message.answer("❌ Ошибка: API-ключ не найден.")
-        await state.clear()
+        await _end_flow(state)
         return
 
-    api = ReportFinanceAPI(api_key=api_key)
+    _start_prefetch(state.key.user_id, api_key)
     try:
-        projects = await api.fetch_all_projects()
-        project_map = {"Без проекта": None}
-        projects_with_placeholder = [{"projectName": "Без проекта", "id": None}]
-        if projects:
-            project_map.update({p["projectName"]: p["id"] for p in projects})
-            projects_with_placeholder.extend(projects)
-        await state.update_data(
-            projects=project_map,
-            projects_full=projects_with_placeholder
-        )
-        if not projects:
-            await state.update_data(project_id=None, project_name="Без проекта")
+        projects = await _catalog_items(state.key.user_id, data, "projects")
+        if len(projects) == 1:
+            # Только «Без проекта» — шаг пропускаем
+            await state.update_data(project_id=None, project_name=NO_PROJECT)
             await _proceed_to_organisation(message, state)
         else:
-            await message.answer("Выберите проект:", reply_markup=get_project_keyboard(projects_with_placeholder))
+            await message.answer(
+                "Выберите проект или напишите часть названия:",
+                reply_markup=catalog_keyboards.render(api_key, "projects", projects)
+            )
             await state.set_state(OperationForm.choosing_project)
     except Exception as e:
         await message.answer(f"❌ Ошибка загрузки проектов: {e}")
-        await state.clear()
+        await _end_flow(state)
 
-@router.message(OperationForm.choosing_project)
-async def process_project_choice(message: Message, state: FSMContext):
-    user_data = await state.get_data()
-    project_name = message.text
-    project_id = user_data["projects"].get(project_name)
-    if project_id is None and project_name != "Без проекта":
-        await message.answer("Неверный выбор. Выберите проект из списка.")
+async def _proceed_to_account(message: Message, state: FSMContext):
+    data = await state.get_data()
+    api_key = data["api_key"]
+    try:
+        # Только счета, принадлежащие выбранной организации
+        accounts = await _catalog_items(state.key.user_id, data, "accounts")
+        if not accounts:
+            await message.answer("У выбранной организации нет доступных счетов.")
+            await _end_flow(state)
+            return
+        await message.answer(
+            "Выберите счёт или напишите часть названия либо последние цифры номера:",
+            reply_markup=catalog_keyboards.render(
+                api_key, "accounts", accounts, scope=_catalog_scope(data, "accounts")
+            )
+        )
+        await state.set_state(OperationForm.choosing_account)
+    except Exception as e:
+        await message.answer(f"❌ Ошибка загрузки счетов: {e}")
+        await _end_flow(state)
+
+@router.callback_query(CatalogCallback.filter(F.action == "page"))
+async def turn_catalog_page(callback: CallbackQuery, callback_data: CatalogCallback, state: FSMContext):
+    data = await state.get_data()
+    if not data.get("api_key"):
+        await callback.answer("Этот список уже неактуален.", show_alert=True)
+        return
+    kind = callback_data.kind
+    try:
+        items = await _catalog_items(callback.from_user.id, data, kind)
+    except Exception as e:
+        await callback.answer()
+        await callback.message.answer(f"❌ Ошибка загрузки справочника: {e}")
+        await _end_flow(state)
         return
+    markup = catalog_keyboards.render(
+        data["api_key"], kind, items, page=callback_data.page, scope=_catalog_scope(data, kind)
+    )
+    try:
+        await callback.message.edit_reply_markup(reply_markup=markup)
+    except TelegramBadRequest:
+        pass  # двойное нажатие: страница уже показана
+    await callback.answer()
+
+@router.callback_query(CatalogCallback.filter(F.action == "noop"))
+async def ignore_catalog_counter(callback: CallbackQuery):
+    await callback.answer()
+
+@router.callback_query(
+    OperationForm.choosing_project,
+    CatalogCallback.filter((F.kind == "projects") & (F.action == "pick"))
+)
+async def process_project_pick(callback: CallbackQuery, callback_data: CatalogCallback, state: FSMContext):
+    user_data = await state.get_data()
+    project_id = callback_data.item
+    if project_id is None:
+        project_name = NO_PROJECT
+    else:
+        project = await reference_cache.get_by_id(user_data["api_key"], "projects", project_id)
+        if project is None:
+            await callback.answer("Проект не найден. Выберите другой.", show_alert=True)
+            return
+        project_name = catalog_label("projects", project)
     await state.update_data(project_id=project_id, project_name=project_name)
-    await _proceed_to_organisation(message, state)
+    await callback.answer()
+    await callback.message.edit_text(f"Проект: {project_name}")
+    await _proceed_to_organisation(callback.message, state)
 
-@router.message(OperationForm.choosing_organisation)
-async def process_organisation_choice(message: Message, state: FSMContext):
+@router.callback_query(
+    OperationForm.choosing_organisation,
+    CatalogCallback.filter((F.kind == "organisations") & (F.action == "pick"))
+)
+async def process_organisation_pick(callback: CallbackQuery, callback_data: CatalogCallback, state: FSMContext):
+    user_data = await state.get_data()
+    organisation = await reference_cache.get_by_id(user_data["api_key"], "organisations", callback_data.item)
+    if organisation is None:
+        await callback.answer("Организация не найдена. Выберите другую.", show_alert=True)
+        return
+    org_name = catalog_label("organisations", organisation)
+    await state.update_data(organisation_id=organisation["id"], organisation_name=org_name)
+    await callback.answer()
+    await callback.message.edit_text(f"Организация: {org_name}")
+    await _proceed_to_account(callback.message, state)
+
+@router.callback_query(
+    OperationForm.choosing_account,
+    CatalogCallback.filter((F.kind == "accounts") & (F.action == "pick"))
+)
+async def process_account_pick(callback: CallbackQuery, callback_data: CatalogCallback, state: FSMContext):
     user_data = await state.get_data()
-    org_name = message.text
-    organisation_id = user_data["organisations"].get(org_name)
-    if organisation_id is None:
-        await message.answer("Неверный выбор. Выберите организацию из списка.")
+    account = await reference_cache.get_by_id(user_data["api_key"], "accounts", callback_data.item)
+    if account is None or account.get("organisationId") != user_data.get("organisation_id"):
+        await callback.answer("Счёт не найден. Выберите другой.", show_alert=True)
         return
+    account_name = catalog_label("accounts", account)
+    await state.update_data(account_id=account["id"], account_name=account_name)
+    await callback.answer()
+    await callback.message.edit_text(f"Счёт: {account_name}")
+    await callback.message.answer("Введите сумму (в рублях):")
+    await state.set_state(OperationForm.entering_amount)
 
-    await state.update_data(organisation_id=organisation_id, organisation_name=org_name)
-    api_key = user_data["api_key"]
-    api = ReportFinanceAPI(api_key=api_key)
+@router.callback_query(CatalogCallback.filter())
+async def reject_stale_catalog(callback: CallbackQuery):
+    # Кнопка из старого сообщения: сценарий уже на другом шаге или завершён
+    await callback.answer("Этот список уже неактуален.", show_alert=True)
 
+async def _search_catalog(message: Message, state: FSMContext, kind: str, hint: str):
+    """Текст на шаге выбора — поисковый запрос по справочнику."""
+    data = await state.get_data()
+    if kind == "accounts":
+        organisation_id = data.get("organisation_id")
+        where = lambda account: account.get("organisationId") == organisation_id
+    else:
+        where = None
     try:
-        all_accounts = await api.fetch_all_accounts()
-        # Фильтруем только счета, принадлежащие выбранной организации
-        filtered_accounts = [
-            acc for acc in all_accounts
-            if acc.get("organisationId") == organisation_id
-        ]
-        if not filtered_accounts:
-            await message.answer("У выбранной организации нет доступных счетов.")
-            await state.clear()
-            return
-
-        account_map = {
-            f"{a['accountName']} ({a['number'][-4:]})": a["id"]
-            for a in filtered_accounts
-        }
-        await state.update_data(accounts=account_map, accounts_full=filtered_accounts)
-        await message.answer("Выберите счёт:", reply_markup=get_account_keyboard(filtered_accounts))
-        await state.set_state(OperationForm.choosing_account)
+        # Обычно справочник уже в кэше. Если его вытеснили, get() загрузит его заново,
+        # и подписка reference_cache перестроит индекс поиска до запроса
+        await reference_cache.get(data["api_key"], kind)
     except Exception as e:
-        await message.answer(f"❌ Ошибка загрузки счетов: {e}")
-        await state.clear()
+        await message.answer(f"❌ Ошибка загрузки справочника: {e}")
+        return
+    matches = catalog_search.search(data["api_key"], kind, message.text or "", where)
+    if not matches:
+        await message.answer(f"Ничего не найдено. Уточните запрос или {hint} кнопкой в списке выше.")
+        return
+    await message.answer(
+        f"Найдено: {len(matches)}. Выберите:",
+        reply_markup=get_search_results_keyboard(kind, matches)
+    )
+
+@router.message(OperationForm.choosing_project)
+async def process_project_choice(message: Message, state: FSMContext):
+    await _search_catalog(message, state, "projects", "выберите проект")
+
+@router.message(OperationForm.choosing_organisation)
+async def process_organisation_choice(message: Message, state: FSMContext):
+    await message.answer("Выберите организацию кнопкой в списке выше.")
 
 @router.message(OperationForm.choosing_account)
 async def process_account_choice(message: Message, state: FSMContext):
-    user_data = await state.get_data()
-    account_key = message.text
-    account_id = user_data["accounts"].get(account_key)
-    if account_id is None:
-        await message.answer("Неверный выбор. Выберите счёт из списка.")
-        return
-
-    account_name = next(
-        (a["accountName"] for a in user_data["accounts_full"] if a["id"] == account_id),
-        account_key
-    )
-    await state.update_data(account_id=account_id, account_name=account_name)
-    await message.answer("Введите сумму (в рублях):")
-    await state.set_state(OperationForm.entering_amount)
+    await _search_catalog(message, state, "accounts", "выберите счёт")
 
 @router.message(OperationForm.entering_amount)
 async def process_amount(message: Message, state: FSMContext):
@@ -200,7 +332,7 @@ async def confirm_operation(message: Message, state: FSMContext):
         return
 
     if message.text == "❌ Нет":
-        await state.clear()
+        await _end_flow(state)
         await message.answer("Операция отменена.", reply_markup=get_main_menu())
         return
 
@@ -208,10 +340,9 @@ async def confirm_operation(message: Message, state: FSMContext):
     user_info = await get_user_info(message.from_user.id)
     if not user_info or not user_info.get("api_key"):
         await message.answer("❌ Ошибка: API-ключ не найден.", reply_markup=get_main_menu())
-        await state.clear()
+        await _end_flow(state)
         return
 
-    api = ReportFinanceAPI(api_key=user_info["api_key"])
     direction_id = data["direction_id"]
     operation_date = datetime.date.today()
 
@@ -234,15 +365,21 @@ async def confirm_operation(message: Message, state: FSMContext):
         payment_data["projectId"] = data["project_id"]
 
     try:
-        await api.create_payment(payment_data)
-        await log_simple_operation(
+        # Платёж сохраняется в outbox и отправляется в фоне; итог придёт отдельным сообщением
+        await payment_outbox.enqueue(
+            chat_id=message.chat.id,
             telegram_id=message.from_user.id,
+            api_key=user_info["api_key"],
+            payload=payment_data,
             operation_type="expense" if direction_id == 510 else "income",
             operation_date=operation_date
         )
         word = "расход" if direction_id == 510 else "приход"
-        await message.answer(f"✅ {word.capitalize()} успешно добавлен!", reply_markup=get_main_menu())
+        await message.answer(
+            f"⏳ {word.capitalize()} принят и отправляется в Report.Finance. Сообщу о результате.",
+            reply_markup=get_main_menu()
+        )
     except Exception as e:
         await message.answer(f"❌ Ошибка при отправке: {e}", reply_markup=get_main_menu())
     finally:
-        await state.clear()
\ No newline at end of file
+        await _end_flow(state)
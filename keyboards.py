@@ -1,32 +1,115 @@
 # keyboards.py
-from aiogram.types import ReplyKeyboardMarkup
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
-from typing import List, Dict, Any
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+from config import CATALOG_PAGE_SIZE, CATALOG_CACHE_MAX_PAGES
+from reference_cache import reference_cache
 
-def get_project_keyboard(projects: List[Dict[str, str]]) -> ReplyKeyboardMarkup:
-    builder = ReplyKeyboardBuilder()
-    for p in projects:
-        builder.button(text=p["projectName"])
-    builder.adjust(2)
-    return builder.as_markup(
-        resize_keyboard=True,
-        one_time_keyboard=True,
-        input_field_placeholder="Выберите проект"
-    )
+NO_PROJECT = "Без проекта"
 
-def get_account_keyboard(accounts: List[Dict[str, Any]]) -> ReplyKeyboardMarkup:
-    builder = ReplyKeyboardBuilder()
-    for a in accounts:
-        name = a.get("accountName", "Без названия")
-        number = a.get("number", "")
-        display = f"{name} ({number[-4:]})" if number else name
-        builder.button(text=display)
-    builder.adjust(2)
-    return builder.as_markup(
-        resize_keyboard=True,
-        one_time_keyboard=True,
-        input_field_placeholder=""
-    )
+class CatalogCallback(CallbackData, prefix="cat"):
+    kind: str  # projects | organisations | accounts
+    action: str  # page | pick | noop
+    page: int = 0
+    item: Optional[int] = None  # id записи; для «Без проекта» — None
+
+def catalog_label(kind: str, item: Dict[str, Any]) -> str:
+    """Подпись записи справочника — одна и та же на кнопке и в тексте сценария."""
+    if kind == "projects":
+        return item.get("projectName") or NO_PROJECT
+    if kind == "organisations":
+        return item.get("organisationName") or item.get("name") or f"Организация {item['id']}"
+    name = item.get("accountName", "Без названия")
+    number = item.get("number", "")
+    return f"{name} ({number[-4:]})" if number else name
+
+class CatalogKeyboards:
+    """Страницы инлайн-клавиатур справочников, закэшированные по API-ключу.
+
+    Страница строится один раз на (ключ, справочник, область, номер) и живёт,
+    пока reference_cache не сообщит об изменении справочника. Область отделяет
+    подмножества одного списка — например, счета разных организаций.
+    """
+
+    def __init__(self, page_size: int, max_pages: int):
+        self.page_size = max(1, page_size)
+        self._max_pages = max_pages
+        self._pages: "OrderedDict[Tuple[str, str, Any, int], InlineKeyboardMarkup]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def render(
+        self,
+        api_key: str,
+        kind: str,
+        items: List[Dict[str, Any]],
+        page: int = 0,
+        scope: Any = None,
+    ) -> InlineKeyboardMarkup:
+        pages = max(1, -(-len(items) // self.page_size))
+        page = min(max(page, 0), pages - 1)
+        key = (api_key, kind, scope, page)
+        markup = self._pages.get(key)
+        if markup is not None:
+            self._pages.move_to_end(key)
+            self._stats["hits"] += 1
+            return markup
+
+        self._stats["misses"] += 1
+        builder = InlineKeyboardBuilder()
+        start = page * self.page_size
+        for item in items[start:start + self.page_size]:
+            builder.button(
+                text=catalog_label(kind, item),
+                callback_data=CatalogCallback(kind=kind, action="pick", item=item.get("id")),
+            )
+        builder.adjust(2)
+        if pages > 1:
+            builder.row(
+                InlineKeyboardButton(
+                    text="◀️",
+                    callback_data=CatalogCallback(kind=kind, action="page", page=(page - 1) % pages).pack(),
+                ),
+                InlineKeyboardButton(
+                    text=f"{page + 1}/{pages}",
+                    callback_data=CatalogCallback(kind=kind, action="noop", page=page).pack(),
+                ),
+                InlineKeyboardButton(
+                    text="▶️",
+                    callback_data=CatalogCallback(kind=kind, action="page", page=(page + 1) % pages).pack(),
+                ),
+            )
+        markup = builder.as_markup()
+        self._pages[key] = markup
+        while len(self._pages) > self._max_pages:
+            self._pages.popitem(last=False)
+        return markup
+
+    def invalidate(self, api_key: str, kind: str, items: Optional[List[Dict[str, Any]]] = None):
+        """Подписчик reference_cache: справочник ключа изменился или удалён."""
+        keys = [k for k in self._pages if k[0] == api_key and k[1] == kind]
+        for k in keys:
+            del self._pages[k]
+        if keys:
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "pages": len(self._pages), "max_pages": self._max_pages}
+
+def get_search_results_keyboard(kind: str, items: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    """Найденные по запросу записи — те же кнопки выбора, что и в списке справочника."""
+    builder = InlineKeyboardBuilder()
+    for item in items:
+        builder.button(
+            text=catalog_label(kind, item),
+            callback_data=CatalogCallback(kind=kind, action="pick", item=item.get("id")),
+        )
+    builder.adjust(1)
+    return builder.as_markup()
+
+catalog_keyboards = CatalogKeyboards(page_size=CATALOG_PAGE_SIZE, max_pages=CATALOG_CACHE_MAX_PAGES)
+reference_cache.subscribe(catalog_keyboards.invalidate)
 
 def get_confirmation_keyboard() -> ReplyKeyboardMarkup:
     builder = ReplyKeyboardBuilder()
@@ -38,14 +121,3 @@ def get_confirmation_keyboard() -> ReplyKeyboardMarkup:
         one_time_keyboard=True,
         input_field_placeholder="Подтвердите операцию"
     )
-def get_organisation_keyboard(organisations: List[Dict[str, Any]]) -> ReplyKeyboardMarkup:
-    builder = ReplyKeyboardBuilder()
-    for org in organisations:
-        name = org.get("organisationName") or org.get("name") or f"Организация {org['id']}"
-        builder.button(text=name)
-    builder.adjust(2)
-    return builder.as_markup(
-        resize_keyboard=True,
-        one_time_keyboard=True,
-        input_field_placeholder="Выберите организацию"
-    )
\ No newline at end of file
@@ -1,23 +1,154 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher
-from config import TELEGRAM_BOT_TOKEN
+from contextlib import asynccontextmanager
+from typing import Optional
+from aiogram import Bot, F
+from aiogram.client.session.base import BaseSession
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    FSM_FLOW_TTL,
+    FSM_STORAGE,
+    BOT_MODE,
+    METRICS_HOST,
+    METRICS_PORT,
+    UPDATE_CONCURRENCY,
+    UPDATE_MAX_BACKLOG,
+    UPDATE_CHAT_BACKLOG,
+    FLOOD_RATE,
+    FLOOD_BURST,
+    FLOOD_NAVIGATION_RATE,
+    FLOOD_NAVIGATION_BURST,
+    FLOOD_COOLDOWN,
+    FLOOD_DEBOUNCE,
+    FLOOD_MAX_USERS,
+    SLOW_LOG_PATH,
+)
 from handlers import start, expenses
 from handlers.admin import router as admin_router
-from database import init_db  # ← новое
+from database import init_db, init_operation_partitions, create_pool, close_pool, start_user_listener, stop_user_listener
+from api_client import report_api
+from resilience import SharedRateLimits
+from keyboards import CatalogCallback
+from fsm_storage import TTLMemoryStorage, postgres_storage
+from operation_log import operation_log
+from payment_batcher import payment_batcher
+from payment_outbox import payment_outbox
+from warmup import reference_warmup
+from update_queue import QueuedDispatcher
+from webhook import run_webhook, set_webhook
+from metrics import start_metrics_server
+from middlewares import (
+    UpdateMetricsMiddleware,
+    HandlerMetricsMiddleware,
+    FloodControlMiddleware,
+    ProfilingMiddleware,
+    TracingMiddleware,
+    TelegramTracingMiddleware,
+)
+from profiler import update_profiler
+from tracing import slow_update_log
 
 logging.basicConfig(level=logging.INFO)
 
-async def main():
-    await init_db()  # ← создаём таблицу при старте
-
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    dp = Dispatcher()
+def build_dispatcher(**kwargs) -> QueuedDispatcher:
+    dp = QueuedDispatcher(
+        # ← сценарии в Postgres переживают перезапуск и видны всем экземплярам
+        storage=postgres_storage if FSM_STORAGE == "postgres" else TTLMemoryStorage(ttl=FSM_FLOW_TTL),
+        max_concurrency=UPDATE_CONCURRENCY,  # ← порядок внутри чата, общий лимит обработчиков
+        max_backlog=UPDATE_MAX_BACKLOG,
+        max_chat_backlog=UPDATE_CHAT_BACKLOG,
+        **kwargs
+    )
+    if slow_update_log.enabled:
+        dp.update.outer_middleware(TracingMiddleware(slow_update_log))  # ← первым: трасса всего обновления
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    flood_control = FloodControlMiddleware(
+        rate=FLOOD_RATE,
+        burst=FLOOD_BURST,
+        cooldown=FLOOD_COOLDOWN,
+        debounce=FLOOD_DEBOUNCE,
+        flow_starts=("➕ Добавить расход", "➕ Добавить приход"),  # ← повторные старты склеиваются
+        max_users=FLOOD_MAX_USERS,
+        navigation_rate=FLOOD_NAVIGATION_RATE,
+        navigation_burst=FLOOD_NAVIGATION_BURST,
+        is_navigation=CatalogCallback.filter(F.action.in_({"page", "noop"})),  # ← ◀️/▶️ — свой лимит
+    )
+    dp.message.outer_middleware(flood_control)
+    dp.callback_query.outer_middleware(flood_control)
+    dp["flood_control"] = flood_control
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    dp.message.middleware(ProfilingMiddleware(update_profiler))  # ← профилирование из админки
+    dp.callback_query.middleware(ProfilingMiddleware(update_profiler))
     dp.include_router(start.router)
     dp.include_router(expenses.router)
     dp.include_router(admin_router)  # ← админка
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    return dp
+
+@asynccontextmanager
+async def bot_services(
+    init_schema: bool = True,
+    metrics_port: int = METRICS_PORT,
+    session: Optional[BaseSession] = None,
+    slow_log_path: str = SLOW_LOG_PATH,
+    worker_index: int = 0,
+    workers: int = 1,
+    rate_limits: Optional[SharedRateLimits] = None,
+):
+    """Общие ресурсы процесса бота: пул БД, HTTP-сессия, бот и фоновые задачи.
+
+    В многопроцессном режиме лимиты Report.Finance по ключам общие для всех
+    воркеров (rate_limits), каждый воркер прогревает кэш справочников своих
+    чатов, а отправку outbox ведёт только воркер 0.
+    """
+    await create_pool()  # ← один пул соединений на весь процесс
+    await report_api.start()  # ← общая keep-alive сессия к Report.Finance
+    if rate_limits is not None:
+        report_api.use_shared_limits(rate_limits)  # ← вместе воркеры не превышают лимит ключа
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, session=session)
+    if slow_update_log.enabled:
+        slow_update_log.configure(slow_log_path)
+        bot.session.middleware(TelegramTracingMiddleware())  # ← отправки в Telegram — в трассу
+    metrics_runner = None
+    try:
+        if metrics_port:
+            metrics_runner = await start_metrics_server(METRICS_HOST, metrics_port)  # ← /metrics
+        if init_schema:
+            await init_db()  # ← создаём таблицу при старте
+        else:
+            await init_operation_partitions()  # ← схему создал супервизор; нужен горизонт секций
+        await start_user_listener()  # ← сброс кэша пользователей от других экземпляров
+        if FSM_STORAGE == "postgres":
+            await postgres_storage.start()  # ← пакетная запись сценариев, сброс кэша по NOTIFY
+        operation_log.start()  # ← пакетная запись статистики операций
+        payment_outbox.set_bot(bot)  # ← уведомления по итогам /reconcile в любом воркере
+        if worker_index == 0:
+            payment_outbox.start(bot)  # ← фоновая отправка подтверждённых платежей
+        reference_warmup.start(worker_index, workers)  # ← прогрев справочников активных пользователей своих чатов
+        yield bot
+    finally:
+        await reference_warmup.stop()
+        await payment_outbox.stop()
+        await payment_batcher.stop()
+        await operation_log.stop()
+        await postgres_storage.stop()
+        await stop_user_listener()
+        await report_api.close()
+        await bot.session.close()
+        await close_pool()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        slow_update_log.stop()
+
+async def main():
+    async with bot_services() as bot:
+        dp = build_dispatcher()
+        if BOT_MODE == "webhook":
+            await set_webhook(bot)
+            await run_webhook(bot, dp)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
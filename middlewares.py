@@ -0,0 +1,229 @@
+# middlewares.py
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+from metrics import Counter, Histogram
+from profiler import UpdateProfiler
+from resilience import TokenBucket
+from tracing import SlowUpdateLog, current_trace, span, start_trace
+
+logger = logging.getLogger(__name__)
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Длительность обработчиков", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Полная обработка обновления", ["type"])
+UPDATES = Counter("bot_updates_total", "Полученные обновления", ["type"])
+FLOOD_DROPPED = Counter("bot_flood_dropped_total", "Обновления, отброшенные защитой от флуда", ["reason"])
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: время обработки обновления целиком."""
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        UPDATES.inc(type=update_type)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, type=update_type)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время и ошибки конкретного обработчика (по имени функции)."""
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        trace = current_trace()
+        if trace is not None:
+            trace.handler = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+class TracingMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: трасса обновления, медленные — в журнал.
+
+    Спаны открывают report_api, database._query и TelegramTracingMiddleware;
+    время ожидания в очереди чата передаёт QueuedDispatcher (queue_wait).
+    """
+
+    def __init__(self, log: SlowUpdateLog):
+        self._log = log
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        with start_trace() as trace:
+            trace.queue_wait = data.get("queue_wait", 0.0)
+            started = time.perf_counter()
+            error = None
+            try:
+                return await handler(event, data)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                user = data.get("event_from_user")
+                chat = data.get("event_chat")
+                self._log.record(trace, time.perf_counter() - started, {
+                    "update_id": getattr(event, "update_id", None),
+                    "type": event.event_type if isinstance(event, Update) else type(event).__name__,
+                    "user_id": user.id if user is not None else None,
+                    "chat_id": chat.id if chat is not None else None,
+                }, error)
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: спан на каждый вызов Bot API внутри обновления."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        with span("telegram", getattr(method, "__api_method__", type(method).__name__)):
+            return await make_request(bot, method)
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Внутренний middleware: пока идёт профилирование, отдаёт профайлеру время обработчиков."""
+
+    def __init__(self, profiler: UpdateProfiler):
+        self._profiler = profiler
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if not self._profiler.active:
+            return await handler(event, data)
+        handler_object = data.get("handler")
+        name = "unknown"
+        if handler_object is not None:
+            name = handler_object.callback.__name__
+            self._profiler.register_handler(handler_object.callback)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self._profiler.record(name, time.perf_counter() - started)
+
+class _FloodState:
+    __slots__ = ("bucket", "navigation", "cooldown_until", "flow_text", "flow_started")
+
+    def __init__(self, rate: float, burst: int, navigation_rate: float, navigation_burst: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.navigation = TokenBucket(navigation_rate, navigation_burst)
+        self.cooldown_until = 0.0
+        # Кнопка последнего старта сценария и время его окончания; inf — старт ещё обрабатывается
+        self.flow_text: Optional[str] = None
+        self.flow_started: Optional[float] = None
+
+class FloodControlMiddleware(BaseMiddleware):
+    """Внешний middleware на сообщения и нажатия кнопок: защита от флуда по пользователю.
+
+    Каждому пользователю — ограничитель rate/burst. Кто его исчерпал, получает
+    один ответ о паузе и cooldown секунд игнорируется; отброшенные нажатия кнопок
+    всё равно получают ответ, иначе у кнопки крутятся часики. Листание списков
+    (is_navigation) дёшево и расходует отдельный ограничитель navigation_rate/burst
+    без паузы. Повторное нажатие той же кнопки старта сценария, пока первый старт
+    обрабатывается или закончился меньше debounce секунд назад, склеивается с ним —
+    второй раз справочники не грузятся.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        cooldown: float,
+        debounce: float,
+        flow_starts: Iterable[str],
+        max_users: int,
+        navigation_rate: float,
+        navigation_burst: int,
+        is_navigation: Optional[Callable[[TelegramObject], Awaitable[Any]]] = None,
+    ):
+        self._rate = rate
+        self._burst = burst
+        self._navigation_rate = navigation_rate
+        self._navigation_burst = navigation_burst
+        self._is_navigation = is_navigation
+        self._cooldown = cooldown
+        self._debounce = debounce
+        self._flow_starts = frozenset(flow_starts)
+        self._max_users = max_users
+        self._users: "OrderedDict[int, _FloodState]" = OrderedDict()
+        self._stats = {"throttled": 0, "cooldowns": 0, "collapsed": 0}
+
+    def _state(self, user_id: int) -> _FloodState:
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _FloodState(
+                self._rate, self._burst, self._navigation_rate, self._navigation_burst
+            )
+            while len(self._users) > self._max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        state = self._state(user.id)
+        now = time.monotonic()
+
+        if now < state.cooldown_until:
+            self._drop("cooldown")
+            if isinstance(event, CallbackQuery):
+                await event.answer(f"⏳ Подождите {math.ceil(state.cooldown_until - now)} с.")
+            return None
+        if self._is_navigation is not None and await self._is_navigation(event):
+            if not state.navigation.try_acquire():
+                self._drop("navigation")
+                await event.answer()
+                return None
+            return await handler(event, data)
+        if not state.bucket.try_acquire():
+            state.cooldown_until = now + self._cooldown
+            self._stats["cooldowns"] += 1
+            self._drop("throttled")
+            logger.warning("Флуд от пользователя %s: пауза %d с", user.id, self._cooldown)
+            if isinstance(event, (Message, CallbackQuery)):
+                await event.answer(f"⏳ Слишком много запросов. Подождите {int(self._cooldown)} с.")
+            return None
+
+        if isinstance(event, Message) and event.text in self._flow_starts:
+            if (
+                event.text == state.flow_text
+                and state.flow_started is not None
+                and now - state.flow_started < self._debounce
+            ):
+                self._stats["collapsed"] += 1
+                FLOOD_DROPPED.inc(reason="collapsed")
+                return None
+            state.flow_text = event.text
+            state.flow_started = math.inf
+            try:
+                return await handler(event, data)
+            finally:
+                state.flow_started = time.monotonic()
+        return await handler(event, data)
+
+    def _drop(self, reason: str):
+        self._stats["throttled"] += 1
+        FLOOD_DROPPED.inc(reason=reason)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "users": len(self._users), "in_cooldown": sum(
+            1 for state in self._users.values() if state.cooldown_until > time.monotonic()
+        )}
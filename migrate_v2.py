@@ -0,0 +1,83 @@
+# migrate_v2.py
+import asyncio
+import datetime
+import asyncpg
+from config import DATABASE_URL, OPERATIONS_PARTITIONS_AHEAD
+from database import (
+    OPERATIONS_TABLE_SQL,
+    OPERATIONS_INDEXES_SQL,
+    DAILY_ROLLUP_SQL,
+    _add_months,
+    is_operations_partitioned,
+)
+
+async def migrate():
+    conn = await asyncpg.connect(DATABASE_URL)
+
+    print("🔧 Переводим user_operations на секционирование по месяцам...")
+
+    if await is_operations_partitioned(conn):
+        print("ℹ️ Таблица 'user_operations' уже секционирована")
+    else:
+        async with conn.transaction():
+            # 1. Старая таблица остаётся под именем user_operations_v1
+            await conn.execute("ALTER TABLE user_operations RENAME TO user_operations_v1")
+            await conn.execute("ALTER SEQUENCE IF EXISTS user_operations_id_seq RENAME TO user_operations_v1_id_seq")
+            # Имена индексов общие на схему — освобождаем их для новой таблицы
+            await conn.execute("ALTER INDEX IF EXISTS user_operations_pkey RENAME TO user_operations_v1_pkey")
+            await conn.execute("ALTER INDEX IF EXISTS user_operations_user_date_idx RENAME TO user_operations_v1_user_date_idx")
+            await conn.execute("ALTER INDEX IF EXISTS user_operations_date_id_idx RENAME TO user_operations_v1_date_id_idx")
+            await conn.execute(OPERATIONS_TABLE_SQL)
+            print("✅ Создана секционированная таблица 'user_operations'")
+
+            # 2. Секции на все месяцы с данными и на OPERATIONS_PARTITIONS_AHEAD вперёд
+            first_date = await conn.fetchval("SELECT MIN(operation_date) FROM user_operations_v1")
+            today = datetime.date.today()
+            month = _add_months(first_date or today, 0)
+            until = _add_months(today, OPERATIONS_PARTITIONS_AHEAD + 1)
+            while month < until:
+                next_month = _add_months(month, 1)
+                await conn.execute(
+                    f"CREATE TABLE user_operations_y{month.year}m{month.month:02d} "
+                    f"PARTITION OF user_operations "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}')"
+                )
+                month = next_month
+            await conn.execute("CREATE TABLE user_operations_default PARTITION OF user_operations DEFAULT")
+            print("✅ Созданы месячные секции")
+
+            # 3. Перенос данных с сохранением id
+            moved = await conn.execute("""
+                INSERT INTO user_operations (id, telegram_id, operation_type, operation_date)
+                SELECT id, telegram_id, operation_type, operation_date FROM user_operations_v1
+            """)
+            await conn.execute("""
+                SELECT setval(
+                    pg_get_serial_sequence('user_operations', 'id'),
+                    COALESCE((SELECT MAX(id) FROM user_operations), 0) + 1,
+                    false
+                )
+            """)
+            print(f"✅ Перенесены данные ({moved})")
+
+    # 4. Индексы и дневные агрегаты
+    for sql in OPERATIONS_INDEXES_SQL:
+        await conn.execute(sql)
+    print("✅ Созданы индексы (telegram_id, operation_date) и (operation_date, id)")
+
+    await conn.execute(DAILY_ROLLUP_SQL)
+    async with conn.transaction():
+        await conn.execute("TRUNCATE user_operations_daily")
+        await conn.execute("""
+            INSERT INTO user_operations_daily (operation_date, telegram_id, operation_type, operations_count)
+            SELECT operation_date, telegram_id, operation_type, COUNT(*)
+            FROM user_operations
+            GROUP BY operation_date, telegram_id, operation_type
+        """)
+    print("✅ Пересчитана таблица 'user_operations_daily'")
+
+    await conn.close()
+    print("✅ Миграция завершена. Старые данные сохранены в 'user_operations_v1' — удалите её после проверки.")
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -0,0 +1,121 @@
+# operation_log.py
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from config import OPLOG_BATCH_SIZE, OPLOG_FLUSH_INTERVAL, OPLOG_MAX_PENDING
+from database import insert_operations
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+OPLOG_FLUSH_SECONDS = Histogram("oplog_flush_seconds", "Запись пачки user_operations через COPY")
+
+class OperationLogWriter:
+    """Отложенная запись user_operations пачками.
+
+    submit() только кладёт строку в буфер, поэтому подтверждение операции не
+    ждёт Postgres. Буфер сбрасывается через COPY при накоплении batch_size строк
+    или раз в flush_interval секунд; при ошибке строки остаются в буфере до
+    следующей попытки (не больше max_pending, самые старые отбрасываются).
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._buffer: List[Tuple[int, str, Any]] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "failures": 0,
+            "flush_last_ms": 0.0,
+            "flush_max_ms": 0.0,
+            "flush_total_ms": 0.0,
+        }
+
+    def submit(self, telegram_id: int, operation_type: str, operation_date):
+        self._buffer.append((telegram_id, operation_type, operation_date))
+        self._stats["submitted"] += 1
+        if len(self._buffer) >= self._batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый цикл и дописывает всё, что осталось в буфере.
+
+        Цикл не отменяется: он заканчивает текущий COPY и выходит сам, иначе
+        пачка, уже снятая с буфера, потерялась бы.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._buffer:
+            logger.error("При остановке не записано операций: %d", len(self._buffer))
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._buffer:
+                batch = self._buffer[:self._batch_size]
+                del self._buffer[:self._batch_size]
+                started = time.perf_counter()
+                try:
+                    await insert_operations(batch)
+                except asyncio.CancelledError:
+                    # Отменили посреди COPY — пачка возвращается в буфер для финального сброса
+                    self._buffer[0:0] = batch
+                    raise
+                except Exception as e:
+                    self._stats["failures"] += 1
+                    logger.warning("Не удалось записать %d операций: %s", len(batch), e)
+                    self._buffer[0:0] = batch
+                    overflow = len(self._buffer) - self._max_pending
+                    if overflow > 0:
+                        del self._buffer[:overflow]
+                        self._stats["dropped"] += overflow
+                        logger.error("Буфер операций переполнен, отброшено: %d", overflow)
+                    return
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                OPLOG_FLUSH_SECONDS.observe(elapsed_ms / 1000)
+                self._stats["flushes"] += 1
+                self._stats["written"] += len(batch)
+                self._stats["flush_last_ms"] = elapsed_ms
+                self._stats["flush_total_ms"] += elapsed_ms
+                self._stats["flush_max_ms"] = max(self._stats["flush_max_ms"], elapsed_ms)
+
+    def stats(self) -> Dict[str, Any]:
+        flushes = self._stats["flushes"]
+        return {
+            **self._stats,
+            "queue_depth": len(self._buffer),
+            "flush_avg_ms": self._stats["flush_total_ms"] / flushes if flushes else 0.0,
+        }
+
+operation_log = OperationLogWriter(
+    batch_size=OPLOG_BATCH_SIZE,
+    flush_interval=OPLOG_FLUSH_INTERVAL,
+    max_pending=OPLOG_MAX_PENDING,
+)
+Gauge("oplog_queue_depth", "Строк user_operations в буфере", lambda: operation_log.stats()["queue_depth"])
@@ -0,0 +1,110 @@
+# payment_batcher.py
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+from api_client import ReportFinanceAPI, PaymentRejectedError, report_api
+from config import PAYMENT_BATCH_WINDOW, PAYMENT_BATCH_MAX
+
+logger = logging.getLogger(__name__)
+
+PendingPayment = Tuple[Dict[str, Any], "asyncio.Future[str]"]
+
+class PaymentBatcher:
+    """Собирает платежи одного API-ключа за window секунд (или до max_items)
+    и отправляет их одним POST /api/Payments.
+
+    Каждый вызов submit() получает свой результат: если API вернуло JSON-массив
+    той же длины — свой элемент, иначе весь ответ. Если пачку отклонили (4xx),
+    платежи отправляются по одному, чтобы ошибку получил только виновный.
+    """
+
+    def __init__(self, api: ReportFinanceAPI, window: float, max_items: int):
+        self._api = api
+        self._window = window
+        self._max_items = max_items
+        self._pending: Dict[str, List[PendingPayment]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._sending: Set[asyncio.Task] = set()
+        self._stats = {"payments": 0, "requests": 0, "split_batches": 0}
+
+    async def submit(self, api_key: str, payment: Dict[str, Any]) -> str:
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[str]" = loop.create_future()
+        batch = self._pending.setdefault(api_key, [])
+        batch.append((payment, future))
+        self._stats["payments"] += 1
+        if len(batch) >= self._max_items:
+            self._flush(api_key)
+        elif len(batch) == 1:
+            self._timers[api_key] = loop.call_later(self._window, self._flush, api_key)
+        # shield: платёж уйдёт, даже если ожидающий обработчик отменён
+        return await asyncio.shield(future)
+
+    def _flush(self, api_key: str):
+        timer = self._timers.pop(api_key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(api_key, None)
+        if batch:
+            task = asyncio.create_task(self._send(api_key, batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, api_key: str, batch: List[PendingPayment]):
+        self._stats["requests"] += 1
+        try:
+            response = await self._api.create_payments(api_key, [payment for payment, _ in batch])
+        except PaymentRejectedError as e:
+            if len(batch) == 1:
+                _set_exception(batch[0][1], e)
+                return
+            self._stats["split_batches"] += 1
+            logger.warning("Пачка из %d платежей отклонена, отправляем по одному: %s", len(batch), e)
+            await asyncio.gather(*(self._send(api_key, [item]) for item in batch))
+            return
+        except Exception as e:
+            for _, future in batch:
+                _set_exception(future, e)
+            return
+        for (_, future), result in zip(batch, _split_response(response, len(batch))):
+            if not future.done():
+                future.set_result(result)
+
+    async def stop(self):
+        """Отправляет всё, что ждёт окна, и дожидается ответов."""
+        for api_key in list(self._pending):
+            self._flush(api_key)
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self._stats["requests"]
+        return {
+            **self._stats,
+            "waiting": sum(len(b) for b in self._pending.values()),
+            "avg_batch": self._stats["payments"] / requests if requests else 0.0,
+        }
+
+def _set_exception(future: "asyncio.Future[str]", error: BaseException):
+    if not future.done():
+        future.set_exception(error)
+        # Если ожидающий уже отменён, исключение никто не заберёт — помечаем полученным
+        future.exception()
+
+def _split_response(response: str, count: int) -> List[str]:
+    if count == 1:
+        return [response]
+    try:
+        items: Optional[Any] = json.loads(response)
+    except ValueError:
+        items = None
+    if isinstance(items, list) and len(items) == count:
+        return [item if isinstance(item, str) else json.dumps(item, ensure_ascii=False) for item in items]
+    return [response] * count
+
+payment_batcher = PaymentBatcher(
+    api=report_api,
+    window=PAYMENT_BATCH_WINDOW,
+    max_items=PAYMENT_BATCH_MAX,
+)
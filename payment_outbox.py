@@ -0,0 +1,232 @@
+# payment_outbox.py
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Set
+from aiogram import Bot
+from api_client import PaymentOutcomeUnknownError, PaymentRejectedError
+from config import (
+    API_BACKOFF_MAX,
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_CLAIM_SIZE,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_LEASE_SECONDS,
+)
+from database import (
+    enqueue_outbox_payment,
+    claim_outbox_payments,
+    finish_outbox_payment,
+    retry_outbox_payment,
+    reconcile_outbox_payment,
+    resolve_outbox_payment,
+    get_outbox_stats,
+)
+from handlers.start import get_main_menu
+from metrics import Counter, Histogram
+from operation_log import operation_log
+from payment_batcher import payment_batcher
+from resilience import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+OPERATION_WORDS = {"expense": "расход", "income": "приход"}
+
+OUTBOX_LAG_SECONDS = Histogram(
+    "outbox_delivery_lag_seconds", "От подтверждения до успешной отправки платежа",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+OUTBOX_RESULTS = Counter("outbox_payments_total", "Итоги отправки платежей из outbox", ["result"])
+
+class PaymentOutbox:
+    """Фоновая отправка платежей из таблицы payment_outbox.
+
+    Подтверждение только записывает платёж в таблицу; воркер забирает готовые
+    строки, отправляет их (через PaymentBatcher) конкурентно и сообщает
+    пользователю итог. Ошибки, при которых платёж точно не создан (нет
+    соединения, 429, предохранитель), повторяются с backoff до max_attempts,
+    отказ API (4xx) — сразу окончательный. Если исход неизвестен (таймаут,
+    обрыв после отправки, 5xx, истёкшая аренда после падения процесса), платёж
+    не отправляется повторно: строка переходит в reconcile, и администратор
+    сверяет её с Report.Finance (/reconcile) — повтор вслепую создал бы дубль.
+    """
+
+    def __init__(self, poll_interval: float, claim_size: int, max_attempts: int, lease_seconds: int):
+        self._poll_interval = poll_interval
+        self._claim_size = claim_size
+        self._max_attempts = max_attempts
+        self._lease_seconds = lease_seconds
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+        self._bot: Optional[Bot] = None
+        self._stats = {"sent": 0, "failed": 0, "retried": 0, "reconcile": 0, "lag_total": 0.0, "lag_max": 0.0}
+
+    async def enqueue(self, chat_id: int, telegram_id: int, api_key: str,
+                      payload: Dict[str, Any], operation_type: str, operation_date):
+        await enqueue_outbox_payment(
+            external_id=payload["externalId"],
+            telegram_id=telegram_id,
+            chat_id=chat_id,
+            api_key=api_key,
+            payload=payload,
+            operation_type=operation_type,
+            operation_date=operation_date,
+        )
+        self._wakeup.set()
+
+    def set_bot(self, bot: Bot):
+        """Бот для уведомлений; нужен и там, где цикл отправки не запущен (/reconcile)."""
+        self._bot = bot
+
+    def start(self, bot: Bot):
+        self.set_bot(bot)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Перестаёт забирать новые строки и дожидается уже начатых отправок."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                free = self._claim_size - len(self._sending)
+                rows = await claim_outbox_payments(free, self._lease_seconds) if free > 0 else []
+            except Exception as e:
+                logger.warning("Не удалось прочитать payment_outbox: %s", e)
+                continue
+            for row in rows:
+                task = asyncio.create_task(self._deliver(row))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+            if len(rows) == free:
+                self._wakeup.set()  # возможно, в очереди есть ещё
+
+    async def _deliver(self, row: Dict[str, Any]):
+        external_id = row["external_id"]
+        if row["previous_status"] == "sending":
+            # Процесс умер посреди отправки — платёж мог дойти до API
+            await self._reconcile(row, "аренда истекла во время отправки")
+            return
+        try:
+            await payment_batcher.submit(row["api_key"], row["payload"])
+        except PaymentOutcomeUnknownError as e:
+            await self._reconcile(row, str(e))
+            return
+        except Exception as e:
+            final = isinstance(e, PaymentRejectedError) or row["attempts"] >= self._max_attempts
+            try:
+                if final:
+                    await finish_outbox_payment(external_id, "failed", str(e))
+                else:
+                    delay = backoff_delay(row["attempts"], 1.0, max(API_BACKOFF_MAX, 60.0))
+                    await retry_outbox_payment(external_id, delay, str(e))
+            except Exception as db_error:
+                # Строка останется в sending и будет подобрана после истечения аренды
+                logger.error("Не удалось обновить платёж %s: %s", external_id, db_error)
+                return
+            OUTBOX_RESULTS.inc(result="failed" if final else "retried")
+            if final:
+                self._stats["failed"] += 1
+                await self._notify(row["chat_id"], f"❌ Ошибка при отправке: {e}")
+            else:
+                self._stats["retried"] += 1
+                logger.warning("Платёж %s: попытка %d не удалась: %s", external_id, row["attempts"], e)
+            return
+
+        try:
+            await finish_outbox_payment(external_id, "sent")
+        except Exception as db_error:
+            logger.error("Платёж %s отправлен, но статус не сохранён: %s", external_id, db_error)
+        lag = time.time() - row["created_at"].timestamp()
+        self._stats["sent"] += 1
+        OUTBOX_LAG_SECONDS.observe(lag)
+        OUTBOX_RESULTS.inc(result="sent")
+        self._stats["lag_total"] += lag
+        self._stats["lag_max"] = max(self._stats["lag_max"], lag)
+        await self._confirm(row)
+
+    async def _confirm(self, row: Dict[str, Any]):
+        operation_log.submit(
+            telegram_id=row["telegram_id"],
+            operation_type=row["operation_type"],
+            operation_date=row["operation_date"],
+        )
+        word = OPERATION_WORDS[row["operation_type"]]
+        await self._notify(row["chat_id"], f"✅ {word.capitalize()} успешно добавлен!")
+
+    async def _reconcile(self, row: Dict[str, Any], reason: str):
+        external_id = row["external_id"]
+        try:
+            await reconcile_outbox_payment(external_id, reason)
+        except Exception as db_error:
+            # Строка останется в sending; после аренды снова попадёт сюда, а не в отправку
+            logger.error("Не удалось отправить платёж %s на сверку: %s", external_id, db_error)
+            return
+        self._stats["reconcile"] += 1
+        OUTBOX_RESULTS.inc(result="reconcile")
+        logger.error("Платёж %s требует сверки с Report.Finance: %s", external_id, reason)
+        word = OPERATION_WORDS[row["operation_type"]]
+        await self._notify(
+            row["chat_id"],
+            f"⚠️ Не удалось подтвердить, что {word} создан в Report.Finance. "
+            "Повторно он не отправляется — администратор проверит платёж и сообщит итог.",
+        )
+
+    async def resolve(self, external_id: str, status: str) -> bool:
+        """Итог сверки: sent — платёж есть в Report.Finance, failed — нет и не нужен,
+        pending — нет, отправить ещё раз. False — платежа в reconcile не найдено.
+        """
+        row = await resolve_outbox_payment(external_id, status)
+        if row is None:
+            return False
+        if status == "sent":
+            self._stats["sent"] += 1
+            OUTBOX_RESULTS.inc(result="sent")
+            await self._confirm(row)
+        elif status == "failed":
+            self._stats["failed"] += 1
+            OUTBOX_RESULTS.inc(result="failed")
+            word = OPERATION_WORDS[row["operation_type"]]
+            await self._notify(row["chat_id"], f"❌ {word.capitalize()} не создан. Добавьте его заново.")
+        else:
+            self._wakeup.set()
+        return True
+
+    async def _notify(self, chat_id: int, text: str):
+        if self._bot is None:
+            return
+        try:
+            await self._bot.send_message(chat_id, text, reply_markup=get_main_menu())
+        except Exception as e:
+            logger.warning("Не удалось уведомить чат %s: %s", chat_id, e)
+
+    async def stats(self) -> Dict[str, Any]:
+        db = await get_outbox_stats()
+        sent = self._stats["sent"]
+        return {
+            **self._stats,
+            "queued": db["queued"],
+            "oldest_age": float(db["oldest_age"]),
+            "failed_day": db["failed_day"],
+            "reconcile_queued": db["reconcile"],
+            "in_flight": len(self._sending),
+            "lag_avg": self._stats["lag_total"] / sent if sent else 0.0,
+        }
+
+payment_outbox = PaymentOutbox(
+    poll_interval=OUTBOX_POLL_INTERVAL,
+    claim_size=OUTBOX_CLAIM_SIZE,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    lease_seconds=OUTBOX_LEASE_SECONDS,
+)
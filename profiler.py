@@ -0,0 +1,184 @@
+# profiler.py
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from types import CodeType, FrameType
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from config import PROFILE_SAMPLE_INTERVAL, PROFILE_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("sample", "cprofile")
+OUTSIDE_HANDLERS = "(вне обработчиков)"
+# Кадры ожидания событий цикла — это простой, а не работа
+IDLE_FUNCTIONS = {"select"}
+MAX_STACK_DEPTH = 64
+
+# (имя файла, содержимое, текстовая сводка)
+ProfileCallback = Callable[[str, bytes, str], Awaitable[None]]
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})"
+
+class UpdateProfiler:
+    """Профилирование работающего бота по команде администратора.
+
+    sample — поток раз в sample_interval секунд снимает стек потока событий;
+    сэмпл относится к обработчику, чей кадр есть в стеке. Итог — collapsed
+    stacks («обработчик;кадр;…;кадр N»), их понимают flamegraph.pl и speedscope.
+    cprofile — cProfile на потоке событий; итог — файл pstats (snakeviz, pstats).
+    В обоих режимах ProfilingMiddleware считает вызовы и время по обработчикам.
+    Профилирование идёт seconds секунд или до updates обработанных обновлений.
+    """
+
+    def __init__(self, sample_interval: float, max_seconds: float):
+        self._sample_interval = sample_interval
+        self._max_seconds = max_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._done = asyncio.Event()
+        self._mode = "sample"
+        self._updates_limit: Optional[int] = None
+        self._handler_codes: Dict[CodeType, str] = {}
+        self._handler_times: Dict[str, List[float]] = defaultdict(list)
+        self._samples: Dict[Tuple[str, ...], int] = defaultdict(int)
+        self._idle_samples = 0
+        self._sampler: Optional[threading.Thread] = None
+        self._sampler_stop = threading.Event()
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._top_text = ""
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, mode: str, on_done: ProfileCallback, seconds: Optional[float] = None, updates: Optional[int] = None):
+        if self.active:
+            raise RuntimeError("Профилирование уже идёт")
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode}")
+        self._mode = mode
+        self._updates_limit = updates
+        self._handler_times.clear()
+        self._samples.clear()
+        self._idle_samples = 0
+        self._done.clear()
+        duration = min(seconds or self._max_seconds, self._max_seconds)
+        if mode == "sample":
+            self._sampler_stop.clear()
+            self._sampler = threading.Thread(
+                target=self._sample_loop, args=(threading.get_ident(),), name="profiler", daemon=True
+            )
+            self._sampler.start()
+        else:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._task = asyncio.create_task(self._run(duration, on_done))
+
+    def register_handler(self, callback: Callable[..., Any]):
+        code = getattr(callback, "__code__", None)
+        if code is not None and code not in self._handler_codes:
+            self._handler_codes[code] = callback.__name__
+
+    def record(self, handler_name: str, elapsed: float):
+        times = self._handler_times[handler_name]
+        times.append(elapsed)
+        if self._updates_limit and sum(len(t) for t in self._handler_times.values()) >= self._updates_limit:
+            self._done.set()
+
+    async def _run(self, duration: float, on_done: ProfileCallback):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout=duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            filename, data = self._stop()
+        summary = self._summary(time.monotonic() - started)
+        try:
+            await on_done(filename, data, summary)
+        except Exception:
+            logger.exception("Не удалось отправить результат профилирования")
+
+    def _stop(self) -> Tuple[str, bytes]:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        if self._mode == "sample":
+            self._sampler_stop.set()
+            if self._sampler is not None:
+                self._sampler.join(timeout=1)
+                self._sampler = None
+            lines = [f"{';'.join(stack)} {count}" for stack, count in sorted(self._samples.items())]
+            return f"profile-{stamp}.collapsed", ("\n".join(lines) + "\n").encode("utf-8")
+        profile, self._cprofile = self._cprofile, None
+        profile.disable()
+        profile.create_stats()
+        # Тот же формат, что пишет pstats.Stats.dump_stats; снимаем до pstats.Stats,
+        # который забирает profile.stats себе
+        data = marshal.dumps(profile.stats)
+        self._top_text = self._top_functions(profile)
+        return f"profile-{stamp}.pstats", data
+
+    def _sample_loop(self, thread_id: int):
+        while not self._sampler_stop.wait(self._sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            if frame.f_code.co_name in IDLE_FUNCTIONS:
+                self._idle_samples += 1
+                continue
+            stack: List[str] = []
+            handler = None
+            depth = 0
+            while frame is not None and depth < MAX_STACK_DEPTH:
+                name = self._handler_codes.get(frame.f_code)
+                if name is not None:
+                    handler = name
+                    break  # всё ниже обработчика — диспетчер и цикл событий
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+                depth += 1
+            stack.reverse()
+            if handler is not None:
+                stack.insert(0, _frame_label(frame))
+            self._samples[(handler or OUTSIDE_HANDLERS, *stack)] += 1
+
+    @staticmethod
+    def _top_functions(profile: cProfile.Profile, limit: int = 15) -> str:
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        lines = [line for line in out.getvalue().splitlines() if line.strip()]
+        return "\n".join(lines[-limit - 1:])
+
+    def _summary(self, elapsed: float) -> str:
+        lines = [f"🔬 Профилирование ({self._mode}) за {elapsed:.0f} с"]
+        ranked = sorted(self._handler_times.items(), key=lambda pair: sum(pair[1]), reverse=True)
+        for name, times in ranked:
+            times = sorted(times)
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            lines.append(
+                f"{name}: {len(times)} вызовов, всего {sum(times):.2f} с, "
+                f"среднее {sum(times) / len(times) * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс"
+            )
+        if not ranked:
+            lines.append("Обработчики не вызывались")
+        if self._mode == "sample":
+            busy = sum(self._samples.values())
+            per_handler: Dict[str, int] = defaultdict(int)
+            for stack, count in self._samples.items():
+                per_handler[stack[0]] += count
+            lines.append(f"\nСэмплов: {busy} в работе, {self._idle_samples} простоя")
+            for name, count in sorted(per_handler.items(), key=lambda pair: pair[1], reverse=True):
+                lines.append(f"{name}: {count / busy:.0%} CPU" if busy else name)
+        else:
+            lines.append("\nТоп функций по cumtime:\n" + self._top_text)
+        return "\n".join(lines)
+
+update_profiler = UpdateProfiler(sample_interval=PROFILE_SAMPLE_INTERVAL, max_seconds=PROFILE_MAX_SECONDS)
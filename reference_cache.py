@@ -0,0 +1,162 @@
+# reference_cache.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from api_client import report_api
+from config import REF_CACHE_TTL, REF_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[str], Awaitable[List[Dict[str, Any]]]]
+# (api_key, вид справочника, новый список или None, если запись удалена)
+Listener = Callable[[str, str, Optional[List[Dict[str, Any]]]], None]
+CacheKey = Tuple[str, str]
+
+class ReferenceCache:
+    """Справочники Report.Finance в памяти, по API-ключу.
+
+    Свежие записи отдаются сразу; устаревшие тоже отдаются сразу, а обновление
+    идёт в фоне (stale-while-revalidate). Одновременные загрузки одного и того же
+    справочника для одного ключа объединяются в одну. Число записей ограничено LRU.
+    Подписчики (subscribe) узнают о каждом изменении содержимого справочника.
+    """
+
+    def __init__(self, loaders: Dict[str, Loader], ttl: float, max_entries: int):
+        self._loaders = loaders
+        self._ttl = ttl
+        self._max_entries = max_entries
+        # ключ -> (время загрузки, список записей, индекс записей по id)
+        self._entries: "OrderedDict[CacheKey, Tuple[float, List[Dict[str, Any]], Dict[Any, Dict[str, Any]]]]" = OrderedDict()
+        self._inflight: Dict[CacheKey, asyncio.Task] = {}
+        self._listeners: List[Listener] = []
+        # Частота обращений по ключам — по ней фоновый прогрев выбирает горячие справочники;
+        # ключ забывается вместе с последней его записью в кэше
+        self._access: Dict[str, float] = {}
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refresh_errors": 0}
+
+    async def get(self, api_key: str, kind: str) -> List[Dict[str, Any]]:
+        key = (api_key, kind)
+        self._access[api_key] = self._access.get(api_key, 0.0) + 1
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            # shield: отмена одного ожидающего не должна прерывать общую загрузку
+            return await asyncio.shield(self._refresh(key))
+
+        self._entries.move_to_end(key)
+        fetched_at, value, _ = entry
+        if time.monotonic() - fetched_at < self._ttl:
+            self._stats["hits"] += 1
+        else:
+            self._stats["stale_hits"] += 1
+            self._refresh(key)
+        return value
+
+    def _refresh(self, key: CacheKey) -> "asyncio.Task[List[Dict[str, Any]]]":
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._on_loaded(k, t))
+        return task
+
+    async def _load(self, key: CacheKey) -> List[Dict[str, Any]]:
+        api_key, kind = key
+        value = await self._loaders[kind](api_key)
+        if self._inflight.get(key) is not asyncio.current_task():
+            return value  # справочник сбросили, пока он грузился: результат устарел
+        previous = self._entries.get(key)
+        if previous is not None and previous[1] == value:
+            # Содержимое не изменилось — оставляем прежний список, подписчикам сообщать нечего
+            self._entries[key] = (time.monotonic(), previous[1], previous[2])
+            self._entries.move_to_end(key)
+            return previous[1]
+        by_id = {item.get("id"): item for item in value}
+        self._entries[key] = (time.monotonic(), value, by_id)
+        self._entries.move_to_end(key)
+        self._notify(api_key, kind, value)
+        while len(self._entries) > self._max_entries:
+            self._forget(next(iter(self._entries)))
+        return value
+
+    def _forget(self, key: CacheKey):
+        del self._entries[key]
+        self._notify(*key, None)
+        if not any((key[0], kind) in self._entries for kind in self._loaders):
+            self._access.pop(key[0], None)
+
+    async def refresh(self, api_key: str, kind: str) -> List[Dict[str, Any]]:
+        """Загружает справочник заново (объединяясь с уже идущей загрузкой), не считая обращением."""
+        return await asyncio.shield(self._refresh((api_key, kind)))
+
+    def age(self, api_key: str, kind: str) -> Optional[float]:
+        """Сколько секунд назад загружен справочник; None — его нет в кэше."""
+        entry = self._entries.get((api_key, kind))
+        return time.monotonic() - entry[0] if entry else None
+
+    def hot_keys(self, limit: int) -> List[str]:
+        return sorted(self._access, key=self._access.__getitem__, reverse=True)[:limit]
+
+    def decay_access(self, factor: float = 0.5):
+        """Старые обращения весят всё меньше; совсем редкие ключи забываются."""
+        for api_key in list(self._access):
+            self._access[api_key] *= factor
+            if self._access[api_key] < 0.5:
+                del self._access[api_key]
+
+    def subscribe(self, listener: Listener):
+        """Вызывается синхронно при смене содержимого справочника или его удалении из кэша."""
+        self._listeners.append(listener)
+
+    def _notify(self, api_key: str, kind: str, items: Optional[List[Dict[str, Any]]]):
+        for listener in self._listeners:
+            try:
+                listener(api_key, kind, items)
+            except Exception:
+                logger.exception("Подписчик справочника %s упал", kind)
+
+    def _on_loaded(self, key: CacheKey, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self._stats["refresh_errors"] += 1
+            logger.warning("Не удалось обновить справочник %s: %s", key[1], task.exception())
+
+    async def get_by_id(self, api_key: str, kind: str, item_id: Any) -> Optional[Dict[str, Any]]:
+        """Полная запись справочника по id (без линейного поиска)."""
+        await self.get(api_key, kind)
+        entry = self._entries.get((api_key, kind))
+        return entry[2].get(item_id) if entry else None
+
+    def invalidate(self, api_key: Optional[str] = None) -> int:
+        """Сбрасывает записи одного ключа (или все) и возвращает их число.
+
+        Идущие загрузки этих справочников отцепляются: их результат в кэш не попадёт,
+        а следующее обращение начнёт загрузку заново.
+        """
+        for k in [k for k in self._inflight if api_key is None or k[0] == api_key]:
+            del self._inflight[k]
+        keys = [k for k in self._entries if api_key is None or k[0] == api_key]
+        for k in keys:
+            self._forget(k)
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "entries": len(self._entries),
+            "max_entries": self._max_entries,
+            "inflight": len(self._inflight),
+        }
+
+reference_cache = ReferenceCache(
+    loaders={
+        "projects": report_api.fetch_all_projects,
+        "organisations": report_api.fetch_all_organisations,
+        "accounts": report_api.fetch_all_accounts,
+    },
+    ttl=REF_CACHE_TTL,
+    max_entries=REF_CACHE_MAX_ENTRIES,
+)
@@ -0,0 +1,240 @@
+# resilience.py
+import asyncio
+import email.utils
+import hashlib
+import multiprocessing
+import random
+import time
+from typing import Optional
+
+class UpstreamUnavailableError(RuntimeError):
+    """Предохранитель разомкнут: внешний сервис недавно отказывал, запрос не отправлялся."""
+
+class TokenBucket:
+    """Ограничитель частоты: rate запросов в секунду, всплеск до burst.
+
+    pause() останавливает выдачу для всех ожидающих (например, по Retry-After).
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Берёт один токен и возвращает, сколько секунд пришлось ждать."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+    def try_acquire(self) -> bool:
+        """Берёт токен, если он есть прямо сейчас; не ждёт."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def available(self) -> float:
+        """Сколько токенов можно взять прямо сейчас, не ожидая (ничего не расходует)."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return 0.0
+        return min(self.burst, self._tokens + (now - self._updated) * self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+class SharedRateLimits:
+    """Ограничители частоты по ключам в общей памяти процессов (воркеров супервизора).
+
+    Таблица на slots ключей создаётся до запуска воркеров и передаётся им при
+    старте, так что лимит rate/burst действует на ключ в целом, в каком бы
+    процессе ни шёл запрос. Ключ ищется среди WAYS соседних слотов; если все
+    заняты, забирается слот, дольше всех не обновлявшийся. Время — time.monotonic(),
+    оно общее для процессов одной машины.
+    """
+
+    WAYS = 8
+
+    def __init__(self, rate: float, burst: int, slots: int, ctx=multiprocessing):
+        self.rate = rate
+        self.burst = burst
+        self._slots = slots
+        self._keys = ctx.RawArray("q", slots)  # хэш ключа; 0 — слот свободен
+        # На слот: токены, время обновления, пауза до
+        self._values = ctx.RawArray("d", slots * 3)
+        self._lock = ctx.Lock()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little", signed=True) or 1
+
+    def _slot(self, key: str, claim: bool) -> int:
+        """Слот ключа (вызывается под _lock); -1 — ключа нет и claim не задан."""
+        key_hash = self._hash(key)
+        first = key_hash % self._slots
+        oldest = -1
+        for i in range(min(self.WAYS, self._slots)):
+            slot = (first + i) % self._slots
+            if self._keys[slot] == key_hash:
+                return slot
+            if self._keys[slot] == 0:
+                oldest = slot
+                break
+            if oldest < 0 or self._values[slot * 3 + 1] < self._values[oldest * 3 + 1]:
+                oldest = slot
+        if not claim:
+            return -1
+        self._keys[oldest] = key_hash
+        self._values[oldest * 3:oldest * 3 + 3] = [float(self.burst), time.monotonic(), 0.0]
+        return oldest
+
+    def _refill(self, slot: int, now: float) -> float:
+        tokens, updated, _ = self._values[slot * 3:slot * 3 + 3]
+        if now > updated:
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            self._values[slot * 3:slot * 3 + 2] = [tokens, now]
+        return tokens
+
+    def reserve(self, key: str) -> float:
+        """Берёт токен в счёт будущего; возвращает, сколько секунд подождать до него."""
+        with self._lock:
+            slot = self._slot(key, claim=True)
+            now = time.monotonic()
+            start = max(now, self._values[slot * 3 + 2])
+            tokens = self._refill(slot, start) - 1
+            self._values[slot * 3] = tokens
+        return start - now + max(-tokens, 0.0) / self.rate
+
+    def try_take(self, key: str) -> bool:
+        with self._lock:
+            slot = self._slot(key, claim=True)
+            now = time.monotonic()
+            if now < self._values[slot * 3 + 2] or self._refill(slot, now) < 1:
+                return False
+            self._values[slot * 3] -= 1
+            return True
+
+    def available(self, key: str) -> float:
+        with self._lock:
+            slot = self._slot(key, claim=False)
+            if slot < 0:
+                return float(self.burst)
+            now = time.monotonic()
+            if now < self._values[slot * 3 + 2]:
+                return 0.0
+            return max(self._refill(slot, now), 0.0)
+
+    def pause(self, key: str, seconds: float):
+        with self._lock:
+            slot = self._slot(key, claim=True)
+            self._values[slot * 3 + 2] = max(self._values[slot * 3 + 2], time.monotonic() + seconds)
+
+    def bucket(self, key: str) -> "SharedTokenBucket":
+        return SharedTokenBucket(self, key)
+
+class SharedTokenBucket:
+    """TokenBucket одного ключа поверх SharedRateLimits (тот же интерфейс)."""
+
+    def __init__(self, limits: SharedRateLimits, key: str):
+        self.rate = limits.rate
+        self.burst = limits.burst
+        self._limits = limits
+        self._key = key
+
+    async def acquire(self) -> float:
+        delay = self._limits.reserve(self._key)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def try_acquire(self) -> bool:
+        return self._limits.try_take(self._key)
+
+    def available(self) -> float:
+        return self._limits.available(self._key)
+
+    def pause(self, seconds: float):
+        self._limits.pause(self._key, seconds)
+
+class CircuitBreaker:
+    """Размыкается после threshold отказов подряд; через reset_timeout пропускает
+    один пробный запрос (half-open) и по его итогу замыкается или снова размыкается."""
+
+    def __init__(self, threshold: int, reset_timeout: float, name: str = "upstream"):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        # Время начала пробного запроса; если он потерялся (отмена), через
+        # reset_timeout разрешается следующий
+        self._trial_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def check(self):
+        state = self.state
+        if state == "closed":
+            return
+        now = time.monotonic()
+        trial_pending = self._trial_started is not None and now - self._trial_started < self.reset_timeout
+        if state == "open" or trial_pending:
+            raise UpstreamUnavailableError(f"Сервис {self.name} временно недоступен, попробуйте позже")
+        self._trial_started = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_started is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self._trial_started = None
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[float] = None) -> float:
+    """Экспоненциальная задержка с полным джиттером, но не меньше Retry-After."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(moment.timestamp() - time.time(), 0.0)
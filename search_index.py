@@ -0,0 +1,172 @@
+# search_index.py
+import bisect
+import heapq
+import re
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from config import SEARCH_RESULTS_LIMIT, SEARCH_MIN_SIMILARITY
+from keyboards import catalog_label
+from reference_cache import reference_cache
+
+SEARCH_KINDS = ("projects", "accounts")
+_NON_WORD = re.compile(r"[^\w]+")
+
+def normalize(text: str) -> str:
+    return _NON_WORD.sub(" ", text.lower().replace("ё", "е")).strip()
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class _TenantIndex:
+    """Индекс одного справочника одного ключа: токены для префиксов, триграммы, хвосты номеров."""
+
+    def __init__(self):
+        # id -> (нормализованный текст, запись, хвост номера)
+        self.docs: Dict[Any, Tuple[str, Dict[str, Any], str]] = {}
+        self.tokens: List[Tuple[str, Any]] = []  # отсортирован: префиксный поиск через bisect
+        self.trigrams: Dict[str, Set[Any]] = defaultdict(set)
+        self.suffixes: Dict[str, Set[Any]] = defaultdict(set)
+
+    def add(self, item_id: Any, text: str, item: Dict[str, Any], suffix: str):
+        self.docs[item_id] = (text, item, suffix)
+        # Список токенов досортировывает вызывающий (sort_tokens) — одна сортировка на пачку
+        for token in set(text.split()):
+            self.tokens.append((token, item_id))
+        for trigram in _trigrams(text):
+            self.trigrams[trigram].add(item_id)
+        if suffix:
+            self.suffixes[suffix].add(item_id)
+
+    def remove(self, item_id: Any):
+        text, _, suffix = self.docs.pop(item_id)
+        for token in set(text.split()):
+            pos = bisect.bisect_left(self.tokens, (token, item_id))
+            if pos < len(self.tokens) and self.tokens[pos] == (token, item_id):
+                del self.tokens[pos]
+        for trigram in _trigrams(text):
+            postings = self.trigrams.get(trigram)
+            if postings is not None:
+                postings.discard(item_id)
+                if not postings:
+                    del self.trigrams[trigram]
+        if suffix:
+            self.suffixes[suffix].discard(item_id)
+            if not self.suffixes[suffix]:
+                del self.suffixes[suffix]
+
+    def sort_tokens(self):
+        self.tokens.sort()
+
+    def prefix_matches(self, prefix: str) -> Set[Any]:
+        found = set()
+        pos = bisect.bisect_left(self.tokens, (prefix,))
+        while pos < len(self.tokens) and self.tokens[pos][0].startswith(prefix):
+            found.add(self.tokens[pos][1])
+            pos += 1
+        return found
+
+class CatalogSearch:
+    """Поиск по фрагменту названия проекта/счёта и последним цифрам номера счёта.
+
+    Индексы строятся по событиям reference_cache: при загрузке справочника и при
+    изменении его содержимого — инкрементально, только по изменившимся записям.
+    """
+
+    def __init__(self, limit: int, min_similarity: float):
+        self._limit = limit
+        self._min_similarity = min_similarity
+        self._indexes: Dict[Tuple[str, str], _TenantIndex] = {}
+        self._stats = {"searches": 0, "updates": 0, "added": 0, "removed": 0}
+
+    def update(self, api_key: str, kind: str, items: Optional[List[Dict[str, Any]]]):
+        """Подписчик reference_cache."""
+        if kind not in SEARCH_KINDS:
+            return
+        key = (api_key, kind)
+        if items is None:
+            self._indexes.pop(key, None)
+            return
+        index = self._indexes.setdefault(key, _TenantIndex())
+        fresh = {}
+        for item in items:
+            number = item.get("number") or ""
+            text = normalize(f"{catalog_label(kind, item)} {number}")
+            fresh[item.get("id")] = (text, item, number[-4:])
+        stale = [
+            item_id for item_id, doc in index.docs.items()
+            if item_id not in fresh or fresh[item_id][0] != doc[0] or fresh[item_id][2] != doc[2]
+        ]
+        for item_id in stale:
+            index.remove(item_id)
+        added = 0
+        for item_id, doc in fresh.items():
+            if item_id in index.docs:
+                # Текст не изменился — в индексе меняется только ссылка на запись
+                index.docs[item_id] = doc
+            else:
+                index.add(item_id, *doc)
+                added += 1
+        if added:
+            index.sort_tokens()
+        self._stats["updates"] += 1
+        self._stats["added"] += added
+        self._stats["removed"] += len(stale)
+
+    def search(
+        self,
+        api_key: str,
+        kind: str,
+        query: str,
+        where: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    ) -> List[Dict[str, Any]]:
+        """До limit лучших записей: хвост номера счёта, начала слов, при промахе — похожесть по триграммам."""
+        index = self._indexes.get((api_key, kind))
+        query = normalize(query or "")
+        if index is None or not query:
+            return []
+        self._stats["searches"] += 1
+
+        docs = index.docs
+        scores: Dict[Any, float] = {}
+        if query.isdigit() and len(query) <= 4:
+            for item_id in index.suffixes.get(query, ()):
+                scores[item_id] = 3.0
+        # Каждое слово запроса должно быть началом какого-нибудь слова записи
+        candidates: Optional[Set[Any]] = None
+        for word in query.split():
+            found = index.prefix_matches(word)
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                break
+        for item_id in candidates or ():
+            text = docs[item_id][0]
+            bonus = 1.0 if text.startswith(query) else 0.5 if query in text else 0.0
+            scores[item_id] = max(scores.get(item_id, 0.0), 2.0 + bonus)
+        if not scores:
+            # Опечатки: похожесть по доле совпавших триграмм запроса
+            query_trigrams = _trigrams(query)
+            overlap: Dict[Any, int] = defaultdict(int)
+            for trigram in query_trigrams:
+                for item_id in index.trigrams.get(trigram, ()):
+                    overlap[item_id] += 1
+            for item_id, count in overlap.items():
+                similarity = count / len(query_trigrams)
+                if similarity >= self._min_similarity:
+                    scores[item_id] = similarity
+
+        matches = [
+            (score, item_id) for item_id, score in scores.items()
+            if where is None or where(docs[item_id][1])
+        ]
+        best = heapq.nsmallest(self._limit, matches, key=lambda pair: (-pair[0], docs[pair[1]][0]))
+        return [docs[item_id][1] for _, item_id in best]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "indexes": len(self._indexes),
+            "documents": sum(len(index.docs) for index in self._indexes.values()),
+        }
+
+catalog_search = CatalogSearch(limit=SEARCH_RESULTS_LIMIT, min_similarity=SEARCH_MIN_SIMILARITY)
+reference_cache.subscribe(catalog_search.update)
@@ -0,0 +1,254 @@
+# supervisor.py
+"""Многопроцессный режим: N воркеров принимают webhook на одном порту (SO_REUSEPORT).
+
+Ядро раскидывает соединения Telegram по воркерам случайно, поэтому каждый чат
+закреплён за одним воркером (chat_id % N): чужие обновления пересылаются
+владельцу по локальному HTTP. Так обновления одного чата обрабатываются по
+порядку одним процессом, и его FSM-состояние не разъезжается между процессами.
+
+Запуск: python supervisor.py (нужен WEBHOOK_BASE_URL).
+"""
+import asyncio
+import logging
+import multiprocessing
+import secrets
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+from typing import Any, Dict, Set
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    HEALTH_PATH,
+    METRICS_PORT,
+    API_RATE_LIMIT,
+    API_RATE_BURST,
+    SLOW_LOG_PATH,
+    WORKERS,
+    WORKER_INTERNAL_PORT_BASE,
+    WORKER_SHUTDOWN_TIMEOUT,
+)
+from api_client import MAX_LIMITERS
+from database import create_pool, close_pool, init_db
+from main import bot_services, build_dispatcher
+from resilience import SharedRateLimits
+from webhook import health, set_webhook
+
+logger = logging.getLogger(__name__)
+
+INTERNAL_PATH = "/internal/update"
+INTERNAL_TOKEN_HEADER = "X-Internal-Token"
+
+def route_key(update: Dict[str, Any]) -> int:
+    """Чат (или пользователь), к которому относится обновление."""
+    for name, payload in update.items():
+        if name == "update_id" or not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        user = payload.get("from") or payload.get("user")
+        if user and "id" in user:
+            return user["id"]
+    return update.get("update_id", 0)
+
+class ChatRoutingRequestHandler(SimpleRequestHandler):
+    """Обрабатывает обновления своих чатов, чужие пересылает воркеру-владельцу."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, index: int, workers: int, internal_token: str):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=WEBHOOK_SECRET)
+        self.index = index
+        self.workers = workers
+        self.internal_token = internal_token
+        self.inflight: Set[asyncio.Task] = set()
+        self._forward_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=self.bot.session.json_loads)
+        owner = route_key(update) % self.workers
+        if owner == self.index:
+            self._feed(update)
+            return web.json_response({})
+        return await self._forward(owner, update)
+
+    async def handle_internal(self, request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get(INTERNAL_TOKEN_HEADER, ""), self.internal_token):
+            return web.Response(body="Unauthorized", status=401)
+        self._feed(await request.json(loads=self.bot.session.json_loads))
+        return web.json_response({})
+
+    async def _forward(self, owner: int, update: Dict[str, Any]) -> web.Response:
+        try:
+            async with self._forward_session.post(
+                f"http://127.0.0.1:{WORKER_INTERNAL_PORT_BASE + owner}{INTERNAL_PATH}",
+                json=update,
+                headers={INTERNAL_TOKEN_HEADER: self.internal_token},
+            ) as resp:
+                if resp.status == 200:
+                    return web.json_response({})
+                logger.warning("Воркер %d ответил %d на пересылку", owner, resp.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Воркер %d недоступен: %s", owner, e)
+        # Владелец перезапускается — пусть Telegram повторит доставку позже
+        return web.Response(status=503)
+
+    def _feed(self, update: Dict[str, Any]):
+        task = asyncio.create_task(self._process(update))
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    async def _process(self, update: Dict[str, Any]):
+        result = await self.dispatcher.feed_raw_update(bot=self.bot, update=update, **self.data)
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+
+    async def drain(self, timeout: float):
+        if self.inflight:
+            logger.info("Ожидаем завершения обновлений: %d", len(self.inflight))
+            await asyncio.wait(set(self.inflight), timeout=timeout)
+        await self._forward_session.close()
+
+def _reuseport_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+async def _run_worker(index: int, workers: int, internal_token: str, rate_limits: SharedRateLimits):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    # У каждого воркера свой /metrics: METRICS_PORT + номер воркера, и свой журнал медленных обновлений
+    metrics_port = METRICS_PORT + index if METRICS_PORT else 0
+    slow_log_path = f"{SLOW_LOG_PATH}.{index}" if SLOW_LOG_PATH else ""
+    async with bot_services(
+        init_schema=False,
+        metrics_port=metrics_port,
+        slow_log_path=slow_log_path,
+        worker_index=index,  # ← outbox — только в воркере 0, прогрев — своих чатов
+        workers=workers,
+        rate_limits=rate_limits,  # ← лимиты Report.Finance общие для воркеров
+    ) as bot:
+        dp = build_dispatcher(events_isolation=SimpleEventIsolation())
+        handler = ChatRoutingRequestHandler(dp, bot, index, workers, internal_token)
+
+        public_app = web.Application()
+        public_app.router.add_post(WEBHOOK_PATH, handler.handle)
+        public_app.router.add_get(HEALTH_PATH, health)
+        internal_app = web.Application()
+        internal_app.router.add_post(INTERNAL_PATH, handler.handle_internal)
+
+        public_runner = web.AppRunner(public_app)
+        internal_runner = web.AppRunner(internal_app)
+        await public_runner.setup()
+        await internal_runner.setup()
+        await web.SockSite(public_runner, _reuseport_socket(WEBHOOK_HOST, WEBHOOK_PORT)).start()
+        await web.TCPSite(internal_runner, "127.0.0.1", WORKER_INTERNAL_PORT_BASE + index).start()
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        logger.info("Воркер %d/%d запущен", index, workers)
+        try:
+            await stop.wait()
+        finally:
+            # Сначала перестаём принимать новые обновления, затем дожидаемся начатых
+            await public_runner.cleanup()
+            await internal_runner.cleanup()
+            await handler.drain(max(WORKER_SHUTDOWN_TIMEOUT - 5, 1))
+            await dp.emit_shutdown(bot=bot, dispatcher=dp)
+            await dp.storage.close()
+            logger.info("Воркер %d остановлен", index)
+
+def _worker_entry(index: int, workers: int, internal_token: str, rate_limits: SharedRateLimits):
+    # Ctrl+C получает вся группа процессов; останавливает воркеры только супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s")
+    asyncio.run(_run_worker(index, workers, internal_token, rate_limits))
+
+async def _prepare():
+    await create_pool()
+    try:
+        await init_db()
+    finally:
+        await close_pool()
+    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    try:
+        await set_webhook(bot)
+    finally:
+        await bot.session.close()
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if not WEBHOOK_BASE_URL:
+        raise ValueError("WEBHOOK_BASE_URL не задан в .env (обязателен для supervisor.py)")
+    asyncio.run(_prepare())
+
+    ctx = multiprocessing.get_context("spawn")
+    internal_token = secrets.token_urlsafe(32)
+    # Чаты распределены по воркерам без учёта API-ключа — лимит ключа держим в общей памяти
+    rate_limits = SharedRateLimits(API_RATE_LIMIT, API_RATE_BURST, slots=MAX_LIMITERS * 4, ctx=ctx)
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def spawn(index: int) -> multiprocessing.Process:
+        process = ctx.Process(
+            target=_worker_entry,
+            args=(index, WORKERS, internal_token, rate_limits),
+            name=f"finance-bot-worker-{index}",
+        )
+        process.start()
+        return process
+
+    processes = {index: spawn(index) for index in range(WORKERS)}
+    restarts: Dict[int, float] = {}
+    logger.info("Запущено воркеров: %d", WORKERS)
+
+    while not stopping:
+        wait([p.sentinel for p in processes.values()], timeout=1)
+        for index, process in list(processes.items()):
+            if process.is_alive() or stopping:
+                continue
+            logger.error("Воркер %d завершился с кодом %s, перезапуск", index, process.exitcode)
+            # Не перезапускаем чаще раза в секунду, если воркер падает сразу
+            delay = 1 - (time.monotonic() - restarts.get(index, 0))
+            if delay > 0:
+                time.sleep(delay)
+            restarts[index] = time.monotonic()
+            processes[index] = spawn(index)
+
+    logger.info("Останавливаем воркеры...")
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    for process in processes.values():
+        process.join(max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            logger.error("Воркер %s не остановился вовремя, принудительное завершение", process.name)
+            process.kill()
+            process.join()
+
+if __name__ == "__main__":
+    main()
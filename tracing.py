@@ -0,0 +1,212 @@
+# tracing.py
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from config import SLOW_UPDATE_THRESHOLD, SLOW_LOG_PATH, SLOW_LOG_MAX_BYTES, SLOW_LOG_BACKUPS, TRACE_MAX_SPANS
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+SLOW_UPDATES = Counter("bot_slow_updates_total", "Обновления дольше порога, записанные в журнал", ["bottleneck"])
+
+class Trace:
+    """Спаны одного обновления: вызовы Report.Finance, запросы к БД, отправки в Telegram."""
+
+    __slots__ = ("started", "handler", "queue_wait", "spans", "dropped", "finished")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.handler: Optional[str] = None
+        self.queue_wait = 0.0
+        # (id родителя, вид, имя, начало, длительность, атрибуты, ошибка)
+        self.spans: List[list] = []
+        self.dropped = 0
+        self.finished = False
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_parent: ContextVar[Optional[int]] = ContextVar("trace_parent", default=None)
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+@contextmanager
+def start_trace() -> Iterator[Trace]:
+    """Открывает трассу обновления; задачи, созданные внутри, пишут в неё же."""
+    trace = Trace()
+    token = _trace.set(trace)
+    parent_token = _parent.set(None)
+    try:
+        yield trace
+    finally:
+        trace.finished = True
+        _parent.reset(parent_token)
+        _trace.reset(token)
+
+@contextmanager
+def span(kind: str, name: str, **attrs: Any) -> Iterator[Optional[Dict[str, Any]]]:
+    """Вложенный спан текущей трассы; вне обновления ничего не делает.
+
+    Отдаёт словарь атрибутов — вызывающий может дописать в него итог (статус и т. п.).
+    """
+    trace = _trace.get()
+    if trace is None or trace.finished:
+        yield None
+        return
+    if len(trace.spans) >= TRACE_MAX_SPANS:
+        trace.dropped += 1
+        yield attrs
+        return
+    span_id = len(trace.spans)
+    started = time.perf_counter()
+    record = [_parent.get(), kind, name, started - trace.started, None, attrs, None]
+    trace.spans.append(record)
+    token = _parent.set(span_id)
+    try:
+        yield attrs
+    except BaseException as e:
+        record[6] = type(e).__name__
+        raise
+    finally:
+        record[4] = time.perf_counter() - started
+        try:
+            _parent.reset(token)
+        except ValueError:
+            pass  # закрыт в другом контексте — финализация async-генератора
+
+def _wall_time(intervals: List[Tuple[float, float]]) -> float:
+    """Сколько времени шёл хотя бы один спан (параллельные страницы не складываются)."""
+    total = 0.0
+    end = -1.0
+    for start, stop in sorted(intervals):
+        if stop > end:
+            total += stop - max(start, end)
+            end = stop
+    return total
+
+def summarize(trace: Trace, total: float) -> Dict[str, Any]:
+    """Разбивка по видам спанов: число, суммарное и «настенное» время, узкое место."""
+    by_kind: Dict[str, List[Tuple[float, float]]] = {}
+    for _, kind, _, start, duration, _, _ in trace.spans:
+        # Незакрытый спан (задача ещё работает) считаем до конца обновления
+        by_kind.setdefault(kind, []).append((start, start + duration if duration is not None else total))
+    breakdown = {
+        kind: {
+            "count": len(intervals),
+            "sum_ms": round(sum(stop - start for start, stop in intervals) * 1000, 1),
+            "wall_ms": round(_wall_time(intervals) * 1000, 1),
+        }
+        for kind, intervals in by_kind.items()
+    }
+    # Пагинация — обёртка над запросами api, в узкие места её не выдвигаем
+    leaves = {kind: info for kind, info in breakdown.items() if kind != "pagination"}
+    bottleneck = max(leaves, key=lambda kind: leaves[kind]["wall_ms"]) if leaves else "handler"
+    if trace.queue_wait > max((info["wall_ms"] for info in leaves.values()), default=0.0) / 1000:
+        bottleneck = "queue"
+    return {"breakdown": breakdown, "bottleneck": bottleneck}
+
+class SlowUpdateLog:
+    """Журнал медленных обновлений: JSON-строка на обновление дольше threshold секунд.
+
+    Запись в файл идёт из отдельного потока (QueueHandler/QueueListener), файл
+    ротируется по размеру. Файл открывается при первой записи.
+    """
+
+    def __init__(self, threshold: float, path: str, max_bytes: int, backups: int):
+        self.threshold = threshold
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._logger = logging.getLogger("slow_updates")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._handler: Optional[logging.Handler] = None
+        self._stats = {"traced": 0, "written": 0, "dropped_spans": 0, "slowest_ms": 0.0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0 and bool(self._path)
+
+    def configure(self, path: str):
+        """Путь к журналу до первой записи (у воркеров супервизора — свой файл)."""
+        self.stop()
+        self._path = path
+
+    def _ensure_started(self):
+        if self._listener is not None:
+            return
+        file_handler = logging.handlers.RotatingFileHandler(
+            self._path, maxBytes=self._max_bytes, backupCount=self._backups, encoding="utf-8", delay=True
+        )
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._handler = logging.handlers.QueueHandler(records)
+        self._logger.addHandler(self._handler)
+        self._listener = logging.handlers.QueueListener(records, file_handler)
+        self._listener.start()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()  # дописывает очередь и закрывает файл
+            for handler in self._listener.handlers:
+                handler.close()
+            self._logger.removeHandler(self._handler)
+            self._listener = None
+            self._handler = None
+
+    def record(self, trace: Trace, total: float, update: Dict[str, Any], error: Optional[str] = None):
+        self._stats["traced"] += 1
+        # Пользователь ждал и очередь чата, и обработку
+        if not self.enabled or total + trace.queue_wait < self.threshold:
+            return
+        summary = summarize(trace, total)
+        entry = {
+            "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            **update,
+            "handler": trace.handler,
+            "total_ms": round(total * 1000, 1),
+            "queue_wait_ms": round(trace.queue_wait * 1000, 1),
+            **summary,
+            "spans": [
+                {
+                    "id": span_id,
+                    "parent": parent,
+                    "kind": kind,
+                    "name": name,
+                    "start_ms": round(start * 1000, 1),
+                    "ms": round(duration * 1000, 1) if duration is not None else None,
+                    **attrs,
+                    **({"error": span_error} if span_error else {}),
+                }
+                for span_id, (parent, kind, name, start, duration, attrs, span_error) in enumerate(trace.spans)
+            ],
+        }
+        if trace.dropped:
+            entry["dropped_spans"] = trace.dropped
+            self._stats["dropped_spans"] += trace.dropped
+        if error:
+            entry["error"] = error
+        self._stats["written"] += 1
+        self._stats["slowest_ms"] = max(self._stats["slowest_ms"], entry["total_ms"])
+        SLOW_UPDATES.inc(bottleneck=summary["bottleneck"])
+        try:
+            self._ensure_started()
+            self._logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+        except Exception:
+            logger.exception("Не удалось записать медленное обновление в %s", self._path)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "threshold": self.threshold, "path": self._path}
+
+slow_update_log = SlowUpdateLog(
+    threshold=SLOW_UPDATE_THRESHOLD,
+    path=SLOW_LOG_PATH,
+    max_bytes=SLOW_LOG_MAX_BYTES,
+    backups=SLOW_LOG_BACKUPS,
+)
@@ -0,0 +1,134 @@
+# update_queue.py
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, Tuple
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+UPDATE_QUEUE_WAIT_SECONDS = Histogram("update_queue_wait_seconds", "Ожидание обновления в очереди чата")
+UPDATES_SHED = Counter("updates_shed_total", "Обновления, отброшенные при перегрузке", ["reason"])
+_dispatchers: "weakref.WeakSet[QueuedDispatcher]" = weakref.WeakSet()
+Gauge("update_queue_backlog", "Обновлений в очередях чатов", lambda: sum(dp._backlog for dp in _dispatchers))
+Gauge("update_queue_in_flight", "Обновлений в обработке", lambda: sum(dp._in_flight for dp in _dispatchers))
+
+def chat_key(update: Update) -> Hashable:
+    """Чат (или пользователь), в порядке которого обрабатывается обновление."""
+    try:
+        event = update.event
+    except Exception:
+        return ("update", update.update_id)
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    if user is not None:
+        return user.id
+    return ("update", update.update_id)
+
+class QueuedDispatcher(Dispatcher):
+    """Dispatcher, который обрабатывает обновления через очереди чатов.
+
+    Обновления одного чата выполняются строго по очереди и в порядке поступления,
+    разных чатов — параллельно, но не больше max_concurrency одновременно.
+    Ожидающих обновлений не больше max_backlog всего и max_chat_backlog на чат;
+    сверх этого новые обновления отбрасываются (load shedding).
+    feed_update ждёт окончания обработки, поэтому polling, вебхук и воркеры
+    супервизора работают с ним так же, как с обычным Dispatcher.
+    """
+
+    def __init__(self, *args: Any, max_concurrency: int, max_backlog: int, max_chat_backlog: int, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._max_backlog = max_backlog
+        self._max_chat_backlog = max_chat_backlog
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self._max_concurrency = max(1, max_concurrency)
+        # чат -> ожидающие обновления (время постановки, бот, обновление, kwargs, future)
+        self._chats: Dict[Hashable, Deque[Tuple[float, Bot, Update, Dict[str, Any], asyncio.Future]]] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self._backlog = 0
+        self._in_flight = 0
+        self._stats = {"submitted": 0, "processed": 0, "shed": 0, "wait_total": 0.0, "wait_max": 0.0}
+        _dispatchers.add(self)
+        self["update_queue"] = self  # ← обработчикам (состояние бота в админке)
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        key = chat_key(update)
+        queue = self._chats.get(key)
+        reason = None
+        if self._backlog >= self._max_backlog:
+            reason = "backlog"
+        elif queue is not None and len(queue) >= self._max_chat_backlog:
+            reason = "chat_backlog"
+        if reason is not None:
+            self._stats["shed"] += 1
+            UPDATES_SHED.inc(reason=reason)
+            logger.warning("Обновление %s отброшено: очередь переполнена (%s)", update.update_id, reason)
+            return None
+
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку получит вызывающий; если он уже отменён — не ругаемся на неполученное исключение
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if queue is None:
+            queue = self._chats[key] = deque()
+        queue.append((time.monotonic(), bot, update, kwargs, future))
+        self._backlog += 1
+        self._stats["submitted"] += 1
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+        # shield: если вызывающий отменён, обновление всё равно обработается по очереди
+        return await asyncio.shield(future)
+
+    async def _drain(self, key: Hashable):
+        queue = self._chats[key]
+        try:
+            while queue:
+                enqueued_at, bot, update, kwargs, future = queue[0]
+                async with self._semaphore:
+                    queue.popleft()
+                    self._backlog -= 1
+                    waited = time.monotonic() - enqueued_at
+                    self._stats["wait_total"] += waited
+                    self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+                    UPDATE_QUEUE_WAIT_SECONDS.observe(waited)
+                    self._in_flight += 1
+                    try:
+                        # queue_wait — для трассы обновления (TracingMiddleware)
+                        result = await super().feed_update(bot, update, **kwargs, queue_wait=waited)
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                    finally:
+                        self._in_flight -= 1
+                        self._stats["processed"] += 1
+        finally:
+            # Отмена (остановка бота): ожидающим сообщаем об отмене, очередь чата убираем
+            for _, _, _, _, future in queue:
+                future.cancel()
+            self._backlog -= len(queue)
+            del self._chats[key]
+            del self._workers[key]
+
+    def queue_stats(self) -> Dict[str, Any]:
+        processed = self._stats["processed"]
+        return {
+            **self._stats,
+            "wait_avg": self._stats["wait_total"] / processed if processed else 0.0,
+            "backlog": self._backlog,
+            "max_backlog": self._max_backlog,
+            "in_flight": self._in_flight,
+            "max_concurrency": self._max_concurrency,
+            "active_chats": len(self._chats),
+            "deepest_chat": max((len(q) for q in self._chats.values()), default=0),
+        }
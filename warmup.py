@@ -0,0 +1,115 @@
+# warmup.py
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+from api_client import report_api
+from config import (
+    REF_CACHE_TTL,
+    WARMUP_ACTIVE_DAYS,
+    WARMUP_CONCURRENCY,
+    WARMUP_REFRESH_INTERVAL,
+    WARMUP_TENANTS,
+)
+from database import get_active_api_keys
+from reference_cache import reference_cache
+
+logger = logging.getLogger(__name__)
+
+WARMUP_KINDS = ("projects", "organisations", "accounts")
+# Ключ, у которого занято больше половины всплеска лимита, сейчас обслуживает
+# пользователя: прогрев ждёт, пока лимит восстановится, а если не дождался —
+# пропускает ключ до следующего круга
+MIN_SPARE_CAPACITY = 0.5
+
+class ReferenceWarmup:
+    """Фоновый прогрев reference_cache.
+
+    После старта загружает справочники ключей самых активных пользователей
+    (по user_operations_daily), затем раз в refresh_interval секунд обновляет
+    горячие ключи — по частоте обращений к кэшу — до того, как их записи
+    устареют. Справочники одного ключа грузятся по очереди, ключи — не больше
+    concurrency одновременно; запросы идут через общий лимит ключа в report_api.
+    Кэш у каждого процесса свой, поэтому воркер супервизора прогревает ключи
+    пользователей своих чатов.
+    """
+
+    def __init__(self, tenants: int, active_days: int, concurrency: int, refresh_interval: float):
+        self._tenants = tenants
+        self._active_days = active_days
+        self._concurrency = max(1, concurrency)
+        self._refresh_interval = refresh_interval
+        self._task: Optional[asyncio.Task] = None
+        self._workers = 1
+        self._worker_index = 0
+        self._stats = {"rounds": 0, "loaded": 0, "skipped_busy": 0, "errors": 0, "last_round_s": 0.0}
+
+    def start(self, worker_index: int = 0, workers: int = 1):
+        self._worker_index = worker_index
+        self._workers = max(1, workers)
+        if self._task is None and self._refresh_interval > 0 and self._tenants > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        try:
+            api_keys = await get_active_api_keys(
+                self._active_days, self._tenants, self._workers, self._worker_index
+            )
+        except Exception:
+            logger.exception("Не удалось получить активных пользователей для прогрева")
+            api_keys = []
+        await self.warm(api_keys, max_age=None)
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+            hot = reference_cache.hot_keys(self._tenants)
+            reference_cache.decay_access()
+            # Обновляем то, что устареет до следующего круга
+            await self.warm(hot, max_age=max(0.0, REF_CACHE_TTL - self._refresh_interval))
+
+    async def warm(self, api_keys: List[str], max_age: Optional[float]):
+        """Загружает справочники ключей: отсутствующие всегда, остальные — старше max_age."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        semaphore = asyncio.Semaphore(self._concurrency)
+        # Сколько восстанавливается половина всплеска
+        spare_wait = report_api.burst * MIN_SPARE_CAPACITY / report_api.rate if report_api.rate > 0 else 0.0
+
+        async def warm_key(api_key: str):
+            async with semaphore:
+                for kind in WARMUP_KINDS:
+                    if report_api.breaker.state != "closed":
+                        return  # Report.Finance отказывает — прогрев подождёт
+                    if report_api.spare_capacity(api_key) < MIN_SPARE_CAPACITY:
+                        await asyncio.sleep(spare_wait)
+                        if report_api.spare_capacity(api_key) < MIN_SPARE_CAPACITY:
+                            self._stats["skipped_busy"] += 1
+                            return
+                    age = reference_cache.age(api_key, kind)
+                    if age is not None and (max_age is None or age < max_age):
+                        continue
+                    try:
+                        await reference_cache.refresh(api_key, kind)
+                        self._stats["loaded"] += 1
+                    except Exception as e:
+                        self._stats["errors"] += 1
+                        logger.warning("Прогрев справочника %s не удался: %s", kind, e)
+
+        await asyncio.gather(*(warm_key(api_key) for api_key in api_keys))
+        self._stats["rounds"] += 1
+        self._stats["last_round_s"] = loop.time() - started
+        logger.info("Прогрев справочников: %d ключей за %.1f с", len(api_keys), self._stats["last_round_s"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "running": self._task is not None and not self._task.done()}
+
+reference_warmup = ReferenceWarmup(
+    tenants=WARMUP_TENANTS,
+    active_days=WARMUP_ACTIVE_DAYS,
+    concurrency=WARMUP_CONCURRENCY,
+    refresh_interval=WARMUP_REFRESH_INTERVAL,
+)
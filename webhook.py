@@ -0,0 +1,54 @@
+# webhook.py
+import asyncio
+import logging
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import (
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_MAX_CONNECTIONS,
+    HEALTH_PATH,
+)
+
+logger = logging.getLogger(__name__)
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+def build_webhook_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get(HEALTH_PATH, health)
+    # Запуск/остановка dp (startup/shutdown-хуки) вместе с веб-приложением
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def set_webhook(bot: Bot):
+    # Накопившиеся обновления не сбрасываем — Telegram дошлёт их после рестарта
+    await bot.set_webhook(
+        url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=False,
+    )
+    logger.info("Webhook установлен: %s%s", WEBHOOK_BASE_URL, WEBHOOK_PATH)
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Обслуживает webhook до отмены задачи."""
+    runner = web.AppRunner(build_webhook_app(bot, dp))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info("Webhook-сервер слушает %s", site.name)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()